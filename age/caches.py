@@ -0,0 +1,1185 @@
+import calendar
+import hashlib
+import json
+import os
+import re
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+import six
+
+from .entities import DirectedEdgeSet
+from .specs import RuleSpec
+
+
+def _get_allowed_values(filter_spec):
+    """
+    Utility function. Translates the filter on one column into the set of
+    values that pass the filter.
+    Only equality and membership are understood, for everything else
+    None is returned.
+    """
+    if not isinstance(filter_spec, dict):
+        return set([filter_spec])
+    allowed = None
+    for operator, value in filter_spec.items():
+        if operator == '==':
+            values = set([value])
+        elif operator == 'in':
+            values = set(value)
+        else:
+            return None
+        allowed = values if allowed is None else allowed.intersection(values)
+    return allowed
+
+
+def _is_trivial_vertex_filter(filter_spec):
+    """
+    The QueryBuilder adds a filter on the type to every vertex that is a Node.
+    For the base class, this filter matches everything.
+    """
+    if not filter_spec:
+        return True
+    return filter_spec == {'type': {'like': '%'}}
+
+
+def get_local_hop(queryhelp, node_cache=None):
+    """
+    Checks whether the path in the queryhelp is a single hop along links
+    between nodes that can be evaluated with a :class:`LinkTypeAdjacencyCache`,
+    instead of querying the database.
+
+    :param dict queryhelp: The json-compatible queryhelp of an UpdateRule
+    :param node_cache: A :class:`NodeAttributeCache`. If given, filters on the
+        vertices are allowed as long as the node cache can evaluate them.
+    :returns: None if the path cannot be evaluated locally, otherwise a
+        dictionary with the keys *reverse* (whether the hop goes from outputs to
+        inputs), *link_types* and *labels*, which are sets of allowed values or
+        None if every value is allowed, and *source_filters* and
+        *target_filters*, the filters on the vertices (None if there are none).
+    """
+    path = queryhelp['path']
+    if len(path) != 2:
+        return None
+    first, second = path
+    for pathspec in path:
+        if not (pathspec['type'].startswith('node') or
+                pathspec['type'].startswith('data') or
+                pathspec['type'].startswith('calculation')):
+            return None
+    if second.get('outerjoin'):
+        return None
+    if second['joining_value'] != first['tag']:
+        return None
+    if second['joining_keyword'] == 'output_of':
+        reverse = False
+    elif second['joining_keyword'] == 'input_of':
+        reverse = True
+    else:
+        return None
+    filters = queryhelp['filters']
+    vertex_filters = []
+    for pathspec in path:
+        filter_spec = filters.get(pathspec['tag'], {})
+        if _is_trivial_vertex_filter(filter_spec):
+            vertex_filters.append(None)
+        elif node_cache is not None and node_cache.supports(filter_spec):
+            vertex_filters.append(filter_spec)
+        else:
+            return None
+    local_hop = dict(reverse=reverse, link_types=None, labels=None,
+            source_filters=vertex_filters[0], target_filters=vertex_filters[1])
+    for column, filter_spec in filters.get(second['edge_tag'], {}).items():
+        if column not in ('type', 'label'):
+            return None
+        allowed = _get_allowed_values(filter_spec)
+        if allowed is None:
+            return None
+        local_hop['link_types' if column == 'type' else 'labels'] = allowed
+    return local_hop
+
+
+class LinkTypeAdjacencyCache(object):
+    """
+    An in-memory cache of the links between nodes, partitioned by link type.
+    Every partition has a forward index (from the input to the outputs)
+    and a reverse index (from the output to the inputs).
+    A hop that only follows certain link types only touches the partitions
+    of these types.
+
+    The cache is loaded and updated with :meth:`refresh`, which only queries
+    links that were stored since the last refresh.
+    It is the responsibility of the user to refresh the cache when the
+    database has changed.
+    """
+    def __init__(self, link_types=None, store=None):
+        """
+        :param link_types: An iterable of link types (the values stored in the
+            database, e.g. ``LinkType.CREATE.value``) to cache.
+            If None (default), links of every type are cached.
+        :param store: The GraphStore the links are loaded from, by default
+            the database of AiiDA
+        """
+        self._store = store
+        # Called with every link that is added, see add_listener:
+        self._listeners = []
+        if link_types is None:
+            self._link_types = None
+        else:
+            self._link_types = set(link_types)
+        # For every link type, the index of the outputs of a node
+        # and the index of the inputs of a node, with the labels:
+        self._forward = {}
+        self._reverse = {}
+        # The id of the last link loaded into the cache
+        self._last_link_id = 0
+        self._nr_of_links = 0
+
+    def __len__(self):
+        return self._nr_of_links
+
+    @property
+    def link_types(self):
+        """
+        The link types present in the cache
+        """
+        return set(self._forward.keys())
+
+    def covers(self, link_types):
+        """
+        :param link_types: A set of link types, None for every link type
+        :returns: Whether all links of these types are cached
+        """
+        if self._link_types is None:
+            return True
+        return link_types is not None and set(link_types).issubset(self._link_types)
+
+    @property
+    def last_link_id(self):
+        return self._last_link_id
+
+    def add_link(self, input_id, output_id, label, link_type):
+        """
+        Add a single link to the cache.
+        """
+        if self._link_types is not None and link_type not in self._link_types:
+            return
+        self._forward.setdefault(link_type, {}).setdefault(
+                input_id, []).append((output_id, label))
+        self._reverse.setdefault(link_type, {}).setdefault(
+                output_id, []).append((input_id, label))
+        self._nr_of_links += 1
+        for listener in self._listeners:
+            listener(input_id, output_id, label, link_type)
+
+    def add_listener(self, listener):
+        """
+        :param listener: A callable that is given input id, output id, label
+            and type of every link added to the cache, e.g. by :meth:`refresh`
+        """
+        self._listeners.append(listener)
+
+    def refresh(self):
+        """
+        Load the links that were stored since the last refresh into the cache.
+
+        :returns: the number of links added
+        """
+        if self._store is None:
+            from .stores import QueryBuilderStore
+            self._store = QueryBuilderStore()
+        nr_of_links = self._nr_of_links
+        for input_id, output_id, link_id, label, link_type in self._store.get_links(
+                after_id=self._last_link_id, link_types=self._link_types):
+            self.add_link(input_id, output_id, label, link_type)
+            self._last_link_id = max(self._last_link_id, link_id)
+        return self._nr_of_links - nr_of_links
+
+    def empty(self):
+        """
+        Remove everything from the cache
+        """
+        self._forward = {}
+        self._reverse = {}
+        self._last_link_id = 0
+        self._nr_of_links = 0
+
+    def _get_partitions(self, link_types, reverse):
+        index = self._reverse if reverse else self._forward
+        if link_types is None:
+            return index.items()
+        return [(link_type, index[link_type])
+                for link_type in link_types if link_type in index]
+
+    def get_neighbors(self, keys, link_types=None, labels=None, reverse=False):
+        """
+        :param keys: An iterable of node ids
+        :param link_types: The link types to follow, None for all
+        :param labels: The link labels to follow, None for all
+        :param bool reverse: If True, the inputs of the nodes are returned,
+            otherwise the outputs.
+        :returns: a set with the ids of the neighbors
+        """
+        neighbors = set()
+        for _, partition in self._get_partitions(link_types, reverse):
+            for key in keys:
+                for neighbor, label in partition.get(key, ()):
+                    if labels is None or label in labels:
+                        neighbors.add(neighbor)
+        return neighbors
+
+    def get_edges(self, keys, link_types=None, labels=None, reverse=False):
+        """
+        Same as :meth:`get_neighbors`, but returns the edges that are followed.
+
+        :returns: a set of tuples (key, neighbor, label, link_type), where key
+            is the node the hop started from, i.e. the output of the link if
+            reverse is True.
+        """
+        edges = set()
+        for link_type, partition in self._get_partitions(link_types, reverse):
+            for key in keys:
+                for neighbor, label in partition.get(key, ()):
+                    if labels is None or label in labels:
+                        edges.add((key, neighbor, label, link_type))
+        return edges
+
+
+class ChainIndex(object):
+    """
+    Contracts the linear chains in the links of a :class:`LinkTypeAdjacencyCache`.
+    A node is internal if it has exactly one input and one output (over the
+    link types of the index). A maximal sequence of internal nodes is a chain,
+    between the node before it (the head) and the node after it (the tail).
+
+    A hop with :meth:`hop` jumps from the head over the whole chain to the
+    tail, and reports the internal nodes it jumped over, which can be expanded
+    when the traversal is done. A traversal until nothing new is found thus
+    does one iteration per chain instead of one per link.
+
+    The index follows the links added to the cache, and changes only the
+    chains around them. A link that extends a chain at its tail, as new steps
+    of a workflow do, costs the same for any length of the chain.
+    After the cache is emptied, :meth:`build` has to be called.
+    """
+    def __init__(self, adjacency_cache, link_types=None):
+        """
+        :param adjacency_cache: A LinkTypeAdjacencyCache
+        :param link_types: The link types of the chains, None for every
+            link type in the cache. Only hops along exactly these link types
+            can use the index.
+        """
+        self._cache = adjacency_cache
+        self._link_types = None if link_types is None else frozenset(link_types)
+        self.build()
+        adjacency_cache.add_listener(self._add_link)
+
+    @property
+    def link_types(self):
+        return self._link_types
+
+    def __len__(self):
+        return len(self._chains)
+
+    @property
+    def nr_of_internal_nodes(self):
+        return len(self._chain_of)
+
+    def build(self):
+        """
+        Finds all chains in the cache
+        """
+        # The internal nodes of every chain, as a list, by chain id:
+        self._chains = {}
+        # The head and the tail of every chain:
+        self._ends = {}
+        # The chain id and the position of every internal node:
+        self._chain_of = {}
+        # The chains of every head and tail:
+        self._chains_at = {}
+        self._next_chain_id = 0
+        nodes = set()
+        for _, partition in self._cache._get_partitions(self._link_types, False):
+            nodes.update(partition)
+        self._find_chains(nodes)
+
+    def _get_neighbor(self, key, reverse):
+        """
+        :returns: The only neighbor, None if there are none or several
+        """
+        neighbors = self._cache.get_neighbors((key,), link_types=self._link_types,
+                reverse=reverse)
+        return neighbors.pop() if len(neighbors) == 1 else None
+
+    def _is_internal(self, key):
+        return (key is not None and self._get_neighbor(key, False) is not None and
+                self._get_neighbor(key, True) is not None)
+
+    def _dissolve(self, chain_id):
+        chain = self._chains.pop(chain_id)
+        # The head and the tail can be the same node:
+        for end in set(self._ends.pop(chain_id)):
+            self._chains_at[end].discard(chain_id)
+            if not self._chains_at[end]:
+                del self._chains_at[end]
+        for key in chain:
+            del self._chain_of[key]
+        return chain
+
+    def _find_chains(self, keys):
+        """
+        Creates the chains of the internal nodes among the keys.
+        Chains that they reach are dissolved and found again.
+        """
+        pending = set(key for key in keys if key not in self._chain_of and self._is_internal(key))
+
+        def take(key):
+            if key in self._chain_of:
+                pending.update(self._dissolve(self._chain_of[key][0]))
+            pending.discard(key)
+
+        while pending:
+            start = pending.pop()
+            # I walk back to the first internal node:
+            seen = set([start])
+            head = self._get_neighbor(start, True)
+            while head is not None and head not in seen and self._is_internal(head):
+                take(head)
+                seen.add(head)
+                start = head
+                head = self._get_neighbor(start, True)
+            if head in seen:
+                # A cycle of internal nodes, that is not contracted
+                pending.difference_update(seen)
+                continue
+            # The head is not internal, the walk to the tail cannot come back:
+            chain = [start]
+            tail = self._get_neighbor(start, False)
+            while self._is_internal(tail):
+                take(tail)
+                chain.append(tail)
+                tail = self._get_neighbor(tail, False)
+            chain_id = self._next_chain_id
+            self._next_chain_id += 1
+            self._chains[chain_id] = chain
+            self._ends[chain_id] = (head, tail)
+            for end in (head, tail):
+                self._chains_at.setdefault(end, set()).add(chain_id)
+            for position, key in enumerate(chain):
+                self._chain_of[key] = (chain_id, position)
+
+    def _is_duplicate(self, input_id, output_id):
+        """
+        Whether there are several links between the nodes, e.g. with other labels
+        """
+        return sum(1 for _, partition in self._cache._get_partitions(self._link_types, False)
+                for neighbor, _ in partition.get(input_id, ()) if neighbor == output_id) > 1
+
+    def _extend_chain(self, key, tail):
+        """
+        The link from key to a new tail, that has no other input, makes key
+        internal, and extends the chain that ended at key, without walking it.
+
+        :returns: Whether the chain was extended
+        """
+        chain_ids = self._chains_at.get(key, ())
+        if len(chain_ids) != 1 or key in self._chain_of:
+            return False
+        chain_id, = chain_ids
+        head, old_tail = self._ends[chain_id]
+        if (old_tail != key or head == key or self._get_neighbor(key, False) != tail or
+                self._get_neighbor(key, True) is None or tail in self._chain_of or
+                self._get_neighbor(tail, True) != key or self._is_internal(tail)):
+            return False
+        chain = self._chains[chain_id]
+        self._chain_of[key] = (chain_id, len(chain))
+        chain.append(key)
+        self._ends[chain_id] = (head, tail)
+        self._chains_at[key].discard(chain_id)
+        if not self._chains_at[key]:
+            del self._chains_at[key]
+        self._chains_at.setdefault(tail, set()).add(chain_id)
+        return True
+
+    def _add_link(self, input_id, output_id, label, link_type):
+        if self._link_types is not None and link_type not in self._link_types:
+            return
+        if self._is_duplicate(input_id, output_id) or self._extend_chain(input_id, output_id):
+            return
+        keys = set()
+        for key in (input_id, output_id):
+            # The chains through the nodes, or ending at them, can change:
+            chain_ids = set(self._chains_at.get(key, ()))
+            if key in self._chain_of:
+                chain_ids.add(self._chain_of[key][0])
+            for chain_id in chain_ids:
+                keys.update(self._dissolve(chain_id))
+            keys.add(key)
+            # The node can have been in a cycle of internal nodes, that is
+            # not contracted, and that the link breaks:
+            neighbors = self._cache.get_neighbors((key,), link_types=self._link_types)
+            neighbors.update(self._cache.get_neighbors((key,), link_types=self._link_types,
+                    reverse=True))
+            if len(neighbors) <= 3:
+                keys.update(neighbors)
+        self._find_chains(keys)
+
+    def get_chain(self, key):
+        """
+        :returns: The head, the internal nodes and the tail of the chain of
+            an internal node, None for other nodes
+        """
+        if key not in self._chain_of:
+            return None
+        chain_id, _ = self._chain_of[key]
+        head, tail = self._ends[chain_id]
+        return head, tuple(self._chains[chain_id]), tail
+
+    def hop(self, keys, reverse=False):
+        """
+        A hop along the links of the index, that jumps over the chains.
+
+        :param keys: An iterable of node ids
+        :param bool reverse: If True, the hop goes to the inputs
+        :returns: A set with the ids of the nodes reached, and a list of the
+            internal nodes jumped over, as tuples (chain, start, stop) of a
+            chain and the slice of it.
+        """
+        targets = set()
+        jumped = []
+
+        def jump(chain_id, start, stop):
+            chain = self._chains[chain_id]
+            jumped.append((chain, start, len(chain) if stop is None else stop))
+            head, tail = self._ends[chain_id]
+            targets.add(head if reverse else tail)
+
+        others = []
+        for key in keys:
+            if key in self._chain_of:
+                # The only neighbor of an internal node is in its chain, or an end:
+                chain_id, position = self._chain_of[key]
+                if reverse:
+                    jump(chain_id, 0, position)
+                else:
+                    jump(chain_id, position+1, None)
+            else:
+                others.append(key)
+        for neighbor in self._cache.get_neighbors(others, link_types=self._link_types,
+                reverse=reverse):
+            if neighbor in self._chain_of:
+                chain_id, position = self._chain_of[neighbor]
+                if reverse:
+                    jump(chain_id, 0, position+1)
+                else:
+                    jump(chain_id, position, None)
+            else:
+                targets.add(neighbor)
+        return targets, jumped
+
+
+def _to_timestamp(value):
+    """
+    Utility function, converts datetimes to seconds since the epoch.
+    Naive datetimes are taken to be in UTC.
+    """
+    if hasattr(value, 'utctimetuple'):
+        return calendar.timegm(value.utctimetuple()) + 1e-6*value.microsecond
+    return value
+
+
+def _like_to_regex(pattern, ignore_case=False):
+    """
+    Utility function, translates a pattern for SQL's LIKE into a compiled regex.
+    """
+    regex = ''.join(
+            '.*' if char == '%' else '.' if char == '_' else re.escape(char)
+            for char in pattern)
+    return re.compile(regex + '$', re.DOTALL | (re.IGNORECASE if ignore_case else 0))
+
+
+def _get_predicate(operator, value):
+    """
+    Returns a function that evaluates the operator of a QueryBuilder filter
+    on a single value.
+    """
+    if operator == '==':
+        return lambda val: val == value
+    elif operator == 'in':
+        value = set(value)
+        return lambda val: val in value
+    elif operator in ('like', 'ilike'):
+        regex = _like_to_regex(value, ignore_case=(operator == 'ilike'))
+        return lambda val: isinstance(val, six.string_types) and regex.match(val) is not None
+    elif operator in _COMPARISONS:
+        compare = _COMPARISONS[operator]
+        def predicate(val):
+            try:
+                return val is not None and compare(val, value)
+            except TypeError:
+                return False
+        return predicate
+    raise ValueError("Operator {} is not supported".format(operator))
+
+
+_COMPARISONS = {
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+    }
+_CATEGORICAL_OPERATORS = ('==', 'in', 'like', 'ilike') + tuple(_COMPARISONS.keys())
+_NUMERICAL_OPERATORS = ('==', 'in') + tuple(_COMPARISONS.keys())
+
+
+def _split_operator(operator):
+    """
+    Utility function, returns the operator without negation,
+    and whether it was negated.
+    """
+    if operator.startswith('~') or operator.startswith('!'):
+        return operator[1:], True
+    return operator, False
+
+
+class _CategoricalColumn(object):
+    """
+    A column that stores a code for every entry, and every distinct value once.
+    Filters are evaluated on the distinct values, and mapped to the entries
+    with a vectorized lookup of the codes.
+    """
+    def __init__(self):
+        self.codes = np.zeros(0, dtype=np.int64)
+        self.values = []
+        self._value_to_code = {}
+
+    def _encode(self, values):
+        codes = np.empty(len(values), dtype=np.int64)
+        for idx, value in enumerate(values):
+            try:
+                codes[idx] = self._value_to_code[value]
+            except TypeError:
+                # Unhashable values (lists, dictionaries) are not stored.
+                codes[idx] = self._encode([None])[0]
+            except KeyError:
+                code = len(self.values)
+                self._value_to_code[value] = code
+                self.values.append(value)
+                codes[idx] = code
+        return codes
+
+    def append(self, values):
+        self.codes = np.concatenate((self.codes, self._encode(values)))
+
+    def update(self, indices, values):
+        self.codes[indices] = self._encode(values)
+
+    def get_mask(self, indices, operator, value):
+        predicate = _get_predicate(operator, value)
+        matching = [code for code, val in enumerate(self.values) if predicate(val)]
+        return np.isin(self.codes[indices], matching)
+
+
+class NodeAttributeCache(object):
+    """
+    A columnar in-memory cache of node properties, used to evaluate the filters
+    of a QueryBuilder path on the vertices during a traversal, without
+    querying the database.
+
+    The nodes are stored sorted by their id, the position of a node is its
+    dense index in the columns.
+    The type, the ctime and a configurable set of attributes are stored.
+    Type and attributes are stored as codes into a table of distinct values,
+    so that filters (``==``, ``in``, ``like``, comparisons) are evaluated once
+    per distinct value and mapped to the nodes as a vectorized mask.
+    The ctime is stored as seconds since the epoch and compared vectorized.
+
+    The cache is loaded and updated with :meth:`refresh`.
+    """
+    def __init__(self, attributes=(), store=None):
+        """
+        :param attributes: The names of the attributes to cache, e.g.
+            ``('process_state',)``. Filters on ``attributes.<name>`` can then
+            be evaluated.
+        :param store: The GraphStore the nodes are loaded from, by default
+            the database of AiiDA
+        """
+        self._attributes = tuple(attributes)
+        self._store = store
+        self._pks = np.zeros(0, dtype=np.int64)
+        # The mtimes, to tell whether a node returned by a refresh changed:
+        self._mtimes = np.zeros(0, dtype=np.float64)
+        self._columns = {'type': _CategoricalColumn()}
+        for attribute in self._attributes:
+            self._columns['attributes.{}'.format(attribute)] = _CategoricalColumn()
+        self._ctimes = np.zeros(0, dtype=np.float64)
+        self._last_mtime = None
+
+    def __len__(self):
+        return len(self._pks)
+
+    @property
+    def columns(self):
+        """
+        The columns that filters can be evaluated on.
+        """
+        return ('id', 'ctime') + tuple(sorted(self._columns.keys()))
+
+    def refresh(self):
+        """
+        Load the nodes that were stored, and reload the nodes that were
+        modified, since the last refresh.
+
+        Nodes modified at the time of the last refresh are loaded again, since
+        they can have been modified after it within the same time, and are
+        only updated if their mtime changed.
+
+        :returns: the number of nodes added or updated
+        """
+        if self._store is None:
+            from .stores import QueryBuilderStore
+            self._store = QueryBuilderStore()
+        if self._last_mtime is None:
+            rows = self._store.get_nodes(attributes=self._attributes)
+        else:
+            rows = self._store.get_nodes(after_id=int(self._pks[-1]),
+                    modified_since=self._last_mtime, attributes=self._attributes)
+        rows = list(rows)
+        if not rows:
+            return 0
+        mtimes = [row[1] for row in rows]
+        if self._last_mtime is not None:
+            mtimes.append(self._last_mtime)
+        self._last_mtime = max(mtimes)
+        known = self._contains([row[0] for row in rows])
+        new_rows = [row for row, is_known in zip(rows, known) if not is_known]
+        updated_rows = [row for row, is_known in zip(rows, known) if is_known]
+        if updated_rows:
+            indices = self.get_indices(row[0] for row in updated_rows)
+            updated_rows = [row for row, mtime in zip(updated_rows, self._mtimes[indices])
+                    if _to_timestamp(row[1]) != mtime]
+        if new_rows:
+            self._append(new_rows)
+        if updated_rows:
+            self._update(updated_rows)
+        return len(new_rows) + len(updated_rows)
+
+    def _contains(self, keys):
+        keys = np.array(keys, dtype=np.int64)
+        indices = np.searchsorted(self._pks, keys)
+        found = indices < len(self._pks)
+        found[found] = self._pks[indices[found]] == keys[found]
+        return found
+
+    def _append(self, rows):
+        columns = list(zip(*rows))
+        self._pks = np.concatenate((self._pks, np.array(columns[0], dtype=np.int64)))
+        self._mtimes = np.concatenate((self._mtimes,
+                np.array([_to_timestamp(mtime) for mtime in columns[1]], dtype=np.float64)))
+        self._columns['type'].append(columns[2])
+        self._ctimes = np.concatenate((self._ctimes,
+                np.array([_to_timestamp(ctime) for ctime in columns[3]], dtype=np.float64)))
+        for attribute, values in zip(self._attributes, columns[4:]):
+            self._columns['attributes.{}'.format(attribute)].append(values)
+        if (np.diff(self._pks) < 0).any():
+            # Nodes with smaller ids were committed late, I need to sort again:
+            order = np.argsort(self._pks, kind='mergesort')
+            self._pks = self._pks[order]
+            self._mtimes = self._mtimes[order]
+            self._ctimes = self._ctimes[order]
+            for column in self._columns.values():
+                column.codes = column.codes[order]
+
+    def _update(self, rows):
+        columns = list(zip(*rows))
+        indices = self.get_indices(columns[0])
+        self._mtimes[indices] = [_to_timestamp(mtime) for mtime in columns[1]]
+        self._columns['type'].update(indices, columns[2])
+        self._ctimes[indices] = [_to_timestamp(ctime) for ctime in columns[3]]
+        for attribute, values in zip(self._attributes, columns[4:]):
+            self._columns['attributes.{}'.format(attribute)].update(indices, values)
+
+    def get_indices(self, keys):
+        """
+        :param keys: An iterable of node ids
+        :returns: A numpy array with the dense indices of the nodes
+        :raises KeyError: if a node is not in the cache
+        """
+        keys = np.fromiter(keys, dtype=np.int64)
+        indices = np.searchsorted(self._pks, keys)
+        found = self._contains(keys)
+        if not found.all():
+            raise KeyError("Nodes {} are not in the cache, did you refresh it?".format(
+                    ', '.join(map(str, keys[~found][:10]))))
+        return indices
+
+    def supports(self, filters):
+        """
+        :param dict filters: The filters of a vertex, as in a queryhelp
+        :returns: whether the filters can be evaluated with this cache
+        """
+        for column, filter_spec in filters.items():
+            if column in ('and', 'or'):
+                if not all(self.supports(sub_filters) for sub_filters in filter_spec):
+                    return False
+                continue
+            if column in self._columns:
+                allowed_operators = _CATEGORICAL_OPERATORS
+            elif column in ('id', 'ctime'):
+                allowed_operators = _NUMERICAL_OPERATORS
+            else:
+                return False
+            if isinstance(filter_spec, dict):
+                for operator in filter_spec:
+                    if _split_operator(operator)[0] not in allowed_operators:
+                        return False
+        return True
+
+    def _get_mask(self, indices, filters):
+        mask = np.ones(len(indices), dtype=bool)
+        for column, filter_spec in filters.items():
+            if column == 'and':
+                for sub_filters in filter_spec:
+                    mask &= self._get_mask(indices, sub_filters)
+                continue
+            elif column == 'or':
+                sub_mask = np.zeros(len(indices), dtype=bool)
+                for sub_filters in filter_spec:
+                    sub_mask |= self._get_mask(indices, sub_filters)
+                mask &= sub_mask
+                continue
+            if not isinstance(filter_spec, dict):
+                filter_spec = {'==': filter_spec}
+            for operator, value in filter_spec.items():
+                operator, negate = _split_operator(operator)
+                if column in self._columns:
+                    this_mask = self._columns[column].get_mask(indices, operator, value)
+                else:
+                    if column == 'id':
+                        array = self._pks[indices]
+                    else:
+                        array = self._ctimes[indices]
+                        if operator == 'in':
+                            value = [_to_timestamp(val) for val in value]
+                        else:
+                            value = _to_timestamp(value)
+                    if operator == '==':
+                        this_mask = array == value
+                    elif operator == 'in':
+                        this_mask = np.isin(array, list(value))
+                    else:
+                        this_mask = _COMPARISONS[operator](array, value)
+                if negate:
+                    this_mask = ~this_mask
+                mask &= this_mask
+        return mask
+
+    def get_mask(self, keys, filters):
+        """
+        :param keys: A sequence of node ids
+        :param dict filters: The filters of a vertex, as in a queryhelp
+        :returns: A boolean numpy array, whether the node passes the filters
+        """
+        return self._get_mask(self.get_indices(keys), filters)
+
+    def filter_keys(self, keys, filters):
+        """
+        :param keys: An iterable of node ids
+        :param dict filters: The filters of a vertex, as in a queryhelp
+        :returns: A set with the node ids that pass the filters
+        """
+        keys = np.fromiter(keys, dtype=np.int64)
+        return set(keys[self.get_mask(keys, filters)].tolist())
+
+
+class GroupMembershipCache(object):
+    """
+    An in-memory cache of the members of frequently traversed groups.
+    The members of every group are stored as an array of node ids. When the
+    total number of members exceeds the capacity, the groups that were
+    used least recently are evicted.
+    Groups that are not in the cache are loaded in bulk, with a single
+    :class:`~age.querying.MembershipQuery` for all of them.
+
+    It is the responsibility of the user to call :meth:`invalidate` when
+    memberships in the database have changed.
+    """
+    def __init__(self, max_members=1000000, chunk_size=10000, store=None):
+        """
+        :param int max_members: The maximum number of memberships kept in memory.
+            Groups that are larger are never cached.
+        :param int chunk_size: The chunk size of the membership queries
+        :param store: The GraphStore the memberships are loaded from, by
+            default the database of AiiDA
+        """
+        self._store = store
+        self._max_members = max_members
+        self._chunk_size = chunk_size
+        self._query = None
+        # The members by group id, from the least to the most recently used:
+        self._members = OrderedDict()
+        self._nr_of_members = 0
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, group_id):
+        return group_id in self._members
+
+    @property
+    def nr_of_members(self):
+        return self._nr_of_members
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def set_members(self, group_id, node_ids):
+        """
+        Store the members of a group in the cache.
+        """
+        self.invalidate((group_id,))
+        members = np.fromiter(node_ids, dtype=np.int64)
+        if len(members) > self._max_members:
+            return
+        while self._nr_of_members + len(members) > self._max_members:
+            _, evicted = self._members.popitem(last=False)
+            self._nr_of_members -= len(evicted)
+        self._members[group_id] = members
+        self._nr_of_members += len(members)
+
+    def invalidate(self, group_ids=None):
+        """
+        Remove groups from the cache.
+
+        :param group_ids: An iterable of group ids, None to remove every group
+        """
+        if group_ids is None:
+            self._members = OrderedDict()
+            self._nr_of_members = 0
+            return
+        for group_id in group_ids:
+            members = self._members.pop(group_id, None)
+            if members is not None:
+                self._nr_of_members -= len(members)
+
+    def _load(self, group_ids):
+        if self._query is None:
+            if self._store is None:
+                from .stores import QueryBuilderStore
+                self._store = QueryBuilderStore()
+            self._query = self._store.get_membership_query(chunk_size=self._chunk_size)
+        members = dict((group_id, []) for group_id in group_ids)
+        for node_id, group_id in self._query.execute(group_ids, by_group=True):
+            members[group_id].append(node_id)
+        return members
+
+    def get_members(self, group_ids):
+        """
+        :param group_ids: An iterable of group ids
+        :returns: A dictionary with an array of the ids of the members of every group
+        """
+        result = {}
+        missing = []
+        for group_id in group_ids:
+            members = self._members.pop(group_id, None)
+            if members is None:
+                missing.append(group_id)
+            else:
+                # Moving the group to the end, as the most recently used:
+                self._members[group_id] = members
+                result[group_id] = members
+        self._hits += len(result)
+        self._misses += len(missing)
+        if missing:
+            for group_id, node_ids in self._load(missing).items():
+                self.set_members(group_id, node_ids)
+                result[group_id] = np.array(node_ids, dtype=np.int64)
+        return result
+
+
+def _get_stores(rule):
+    """
+    :returns: The GraphStores of the UpdateRules in an Operation, sorted by
+        their identity, every store once
+    """
+    stores = {}
+    store = getattr(rule, '_store', None)
+    if store is not None:
+        stores[store.get_identity()] = store
+    for sub_rule in getattr(rule, '_rules', ()):
+        for store in _get_stores(sub_rule):
+            stores.setdefault(store.get_identity(), store)
+    return [stores[identity] for identity in sorted(stores)]
+
+
+def get_basket_digest(basket):
+    """
+    :returns: A canonical hash (hexdigest) of the keys in a Basket
+    """
+    digest = hashlib.sha256()
+    for set_key in sorted(basket.dict):
+        keys = sorted(repr(key) for key in basket[set_key].get_keys())
+        digest.update(json.dumps([set_key, keys]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    """
+    Stores the results of complete traversals on disk, so that a traversal
+    that was done before returns without a single hop::
+
+        cache = ResultCache('/path/to/cache', max_bytes=2**30)
+        results = cache.run(rule, walkers)
+
+    An entry is identified by the digest of the specification of the rule
+    (see :class:`~age.specs.RuleSpec`), by the digest of the walkers and by the
+    identity of the stores the rule traverses (see :mod:`age.stores`).
+    Every set of the results is written as arrays of its columns in a
+    compressed numpy archive, one file per entry.
+
+    Every entry stores the watermarks of the stores when the traversal
+    started (e.g. :func:`~age.querying.get_watermark` for the database).
+    An entry with different watermarks than the current ones is stale, and
+    deleted when it is read. Deletions in the database are not seen by the
+    watermark, in that case the cache has to be cleared.
+
+    When the files exceed the disk budget, the entries that were used
+    least recently are deleted.
+    Rules are cached as if they were built from their specification:
+    the state of stashes from earlier runs is not part of the key.
+    """
+    SUFFIX = '.npz'
+
+    def __init__(self, folder, max_bytes=2**30, with_mtime=False, get_watermark=None):
+        """
+        :param str folder: The folder of the files, created if it does not exist
+        :param int max_bytes: The disk budget of the cache
+        :param bool with_mtime: Whether the watermark includes the last
+            modification time of the nodes, needed if rules filter on columns
+            or attributes of nodes that can change
+        :param get_watermark: A callable that returns the current watermark,
+            by default the watermarks of the stores of the rule
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self._folder = folder
+        self._max_bytes = max_bytes
+        self._with_mtime = with_mtime
+        self._get_watermark = get_watermark
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @property
+    def stale(self):
+        """
+        The number of entries that were stale when they were read
+        """
+        return self._stale
+
+    def get_watermark(self, rule):
+        """
+        :returns: The watermarks of the stores of the rule
+        """
+        if self._get_watermark is not None:
+            return self._get_watermark()
+        return [store.get_watermark(with_mtime=self._with_mtime)
+                for store in _get_stores(rule)]
+
+    def get_path(self, rule, walkers, max_results=None):
+        """
+        :returns: The path of the file of the results of the rule for the walkers
+        """
+        digest = hashlib.sha256(json.dumps([RuleSpec.from_rule(rule).get_digest(),
+                get_basket_digest(walkers), max_results,
+                [store.get_identity() for store in _get_stores(rule)]]).encode('utf-8')
+                ).hexdigest()
+        return os.path.join(self._folder, digest + self.SUFFIX)
+
+    def _get_entries(self):
+        entries = []
+        for name in os.listdir(self._folder):
+            if name.endswith(self.SUFFIX):
+                path = os.path.join(self._folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Deleted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def get_size(self):
+        """
+        :returns: The number of bytes of all entries
+        """
+        return sum(size for _, size, _ in self._get_entries())
+
+    def __len__(self):
+        return len(self._get_entries())
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            # Removed by another process
+            pass
+
+    def clear(self):
+        """
+        Deletes all entries
+        """
+        for _, _, path in self._get_entries():
+            self._remove(path)
+
+    def _evict(self):
+        entries = self._get_entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _write(self, path, results, watermark, iterations, visits):
+        arrays = dict(watermark=np.array(json.dumps(watermark)),
+                iterations=np.array(iterations, dtype=np.int64))
+        self._add_arrays(arrays, results)
+        if visits is not None:
+            arrays['visits'] = np.array(True)
+            self._add_arrays(arrays, visits, prefix='visits-')
+        # Written to a temporary file first, readers never see a partial file:
+        file_descriptor, temporary_path = tempfile.mkstemp(suffix='.tmp', dir=self._folder)
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file_:
+                np.savez_compressed(file_, **arrays)
+            os.rename(temporary_path, path)
+        except Exception:
+            self._remove(temporary_path)
+            raise
+
+    @staticmethod
+    def _add_arrays(arrays, basket, prefix=''):
+        """
+        Adds the arrays of the columns of every set of the basket
+        """
+        for set_key, set_ in basket.dict.items():
+            set_key = prefix + set_key
+            keys = set_.get_keys()
+            if isinstance(set_, DirectedEdgeSet):
+                columns = list(zip(*keys)) if keys else [()]*set_._len_all_identifiers
+                for index, column in enumerate(columns):
+                    if index < 2:
+                        array = np.array(column, dtype=np.int64)
+                    else:
+                        # Labels and types are stored as text, not as objects,
+                        # and where they are None:
+                        array = np.array([u'' if value is None else six.text_type(value)
+                                for value in column], dtype='U')
+                        nulls = np.array([value is None for value in column], dtype=bool)
+                        if nulls.any():
+                            arrays['{}-{}-null'.format(set_key, index)] = nulls
+                    arrays['{}-{}'.format(set_key, index)] = array
+            else:
+                arrays[set_key] = np.fromiter(keys, dtype=np.int64, count=len(keys))
+
+    def _read(self, path, walkers, watermark):
+        """
+        :returns: The results, the number of iterations and the visits (None
+            if they were not tracked) stored in the file, None if there is no
+            valid entry
+        """
+        try:
+            data = np.load(path, allow_pickle=False)
+        except (IOError, OSError):
+            return None
+        try:
+            if str(data['watermark'][()]) != json.dumps(watermark):
+                self._stale += 1
+                self._remove(path)
+                return None
+            results = self._load_basket(data, walkers.copy(with_data=False))
+            visits = None
+            if 'visits' in data.files:
+                visits = self._load_basket(data, walkers.copy(with_data=False),
+                        prefix='visits-')
+            return results, int(data['iterations'][()]), visits
+        finally:
+            data.close()
+
+    @staticmethod
+    def _load_basket(data, basket, prefix=''):
+        """
+        Loads the arrays written by :meth:`_add_arrays` into the empty basket
+        """
+        for set_key, set_ in basket.dict.items():
+            set_key = prefix + set_key
+            if isinstance(set_, DirectedEdgeSet):
+                columns = []
+                for index in range(set_._len_all_identifiers):
+                    column = data['{}-{}'.format(set_key, index)].tolist()
+                    null_name = '{}-{}-null'.format(set_key, index)
+                    if null_name in data.files:
+                        column = [None if null else value
+                                for value, null in zip(column, data[null_name].tolist())]
+                    columns.append(column)
+                set_._set_key_set_nocheck(set(zip(*columns)))
+            else:
+                set_._set_key_set_nocheck(set(data[set_key].tolist()))
+        return basket
+
+    def run(self, rule, walkers, max_results=None):
+        """
+        Returns the results of the rule for the walkers from the cache,
+        or runs the rule and stores its results.
+
+        :param rule: An Operation that can be described by a RuleSpec
+        :param walkers: A Basket with the entities to start from
+        :param int max_results: See :meth:`~age.rules.Operation.run`
+        :returns: The results of the rule
+
+        Also on a hit, the iterations done and, if the rule tracks visits, the
+        visits of the rule are those of the run that was stored. As the
+        results, the visits are those of a rule built from its specification:
+        a run starts with the walkers as visits, also if the rule visited
+        entities before. The iterations and visits of the rules of a
+        RuleSequence are not stored, they are undefined after a hit.
+        """
+        path = self.get_path(rule, walkers, max_results=max_results)
+        # The watermark is taken before a traversal, entries are never newer
+        # than the database state they were computed from:
+        watermark = list(self.get_watermark(rule))
+        entry = self._read(path, walkers, watermark)
+        if entry is not None:
+            self._hits += 1
+            # The time of the file tells when the entry was used last:
+            os.utime(path, None)
+            results, rule._iterations_done, visits = entry
+            if visits is not None:
+                rule.set_visits(visits)
+            return results
+        self._misses += 1
+        track_visits = rule._track_visits
+        results = rule.run(walkers.copy(), visits=walkers.copy() if track_visits else None,
+                max_results=max_results)
+        self._write(path, results, watermark, rule.get_iterations_done(),
+                rule.get_visits() if track_visits else None)
+        self._evict()
+        return results
@@ -1,12 +1,132 @@
 
 from abc import ABCMeta, abstractmethod
-
-from aiida.orm import Node, Group
-from aiida.orm.querybuilder import QueryBuilder
+import base64
+import bisect
+import json
+import numbers
+import sys
 
 import six
 
-VALID_ENTITY_CLASSES = (Node, Group)
+# The AiiDA ORM is slow to import. Entity sets refer to the AiiDA classes
+# by these names, the classes are only imported when they are needed.
+VALID_ENTITY_TYPES = ('node', 'group')
+
+
+def get_aiida_cls(entity_type):
+    """
+    :param str entity_type: One of VALID_ENTITY_TYPES
+    :returns: The AiiDA ORM class for that entity type
+    """
+    from aiida.orm import Node, Group
+    return {'node':Node, 'group':Group}[entity_type]
+
+
+class _LazyEntityClasses(object):
+    """
+    The AiiDA ORM classes of VALID_ENTITY_TYPES, as a read-only sequence
+    that imports them when it is first used.
+    """
+    def _get_classes(self):
+        return tuple(get_aiida_cls(entity_type) for entity_type in VALID_ENTITY_TYPES)
+
+    def __iter__(self):
+        return iter(self._get_classes())
+
+    def __len__(self):
+        return len(VALID_ENTITY_TYPES)
+
+    def __getitem__(self, index):
+        return self._get_classes()[index]
+
+    def __contains__(self, item):
+        return item in self._get_classes()
+
+    def __repr__(self):
+        return repr(self._get_classes())
+
+# Kept for code that checks classes against it, resolved when it is used:
+VALID_ENTITY_CLASSES = _LazyEntityClasses()
+
+
+def get_entity_type(aiida_cls):
+    """
+    :param aiida_cls: A valid AiiDA ORM class, i.e. Node, Group,
+        or the name of the entity type, i.e. 'node', 'group'
+    :returns: The name of the entity type
+    """
+    if isinstance(aiida_cls, six.string_types):
+        if aiida_cls in VALID_ENTITY_TYPES:
+            return aiida_cls
+    else:
+        for entity_type in VALID_ENTITY_TYPES:
+            if aiida_cls is get_aiida_cls(entity_type):
+                return entity_type
+    raise TypeError("aiida_cls has to be among:{} (or their class)".format(
+            VALID_ENTITY_TYPES))
+
+
+def get_key_array(keys):
+    """
+    Converts keys given in bulk to a one-dimensional numpy array of integers.
+    The type is checked once for the whole array, not for every key.
+
+    :param keys: A numpy array of integers, an object supporting the buffer
+        protocol with an integer format (e.g. array.array('l')), or an
+        iterable of integers
+    :returns: A numpy array of integers
+    """
+    # numpy is only needed for keys given in bulk:
+    import numpy as np
+    if isinstance(keys, (six.binary_type, six.text_type)):
+        raise TypeError("Keys cannot be given as a string")
+    if not isinstance(keys, np.ndarray):
+        try:
+            # Buffers are used without copying:
+            keys = np.frombuffer(memoryview(keys), dtype=memoryview(keys).format)
+        except (TypeError, ValueError):
+            keys = np.array(list(keys))
+    if keys.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    if keys.dtype.kind not in 'iu':
+        raise TypeError("Keys have to be integers, not {}".format(keys.dtype))
+    if keys.ndim != 1:
+        raise ValueError("Keys have to be one-dimensional, not of shape {}".format(keys.shape))
+    return keys
+
+
+def get_sort_key(key):
+    """
+    :param key: The key of an entity, or the tuple of an edge
+    :returns: A key to sort by. Fields of edges that are None (e.g. labels)
+        come first, without comparing None with the values of other edges.
+    """
+    if isinstance(key, tuple):
+        return tuple((value is not None, value) for value in key)
+    return key
+
+
+def encode_page_token(key):
+    """
+    :param key: The last key of a page
+    :returns: An opaque string that gives the next page
+    """
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(token):
+    """
+    :returns: The key encoded by :func:`encode_page_token`
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(token)).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise ValueError("{} is not a valid page token".format(token))
+    # Edges are tuples, that json turns into lists:
+    if isinstance(key, list):
+        key = tuple(key)
+    return key
+
 
 @six.add_metaclass(ABCMeta)
 class AbstractSetContainer(set):
@@ -116,6 +236,63 @@ class AbstractSetContainer(set):
         """
         self._set = set()
 
+    def get_sorted_keys(self):
+        """
+        :returns: A list with my keys in ascending order. It must not be changed.
+            My set is never changed in place, but replaced, so the list is
+            sorted only once for every state of my set.
+        """
+        return self._get_sorted()[1]
+
+    def _get_sorted(self):
+        """
+        :returns: My set, my keys in ascending order and their sort keys
+            (see :func:`get_sort_key`), in the same order
+        """
+        sorted_keys = getattr(self, '_sorted_keys', None)
+        if sorted_keys is None or sorted_keys[0] is not self._set:
+            keys = sorted(self._set, key=get_sort_key)
+            if keys and isinstance(keys[0], tuple):
+                sorted_keys = (self._set, keys, [get_sort_key(key) for key in keys])
+            else:
+                # Integers are their own sort keys:
+                sorted_keys = (self._set, keys, keys)
+            self._sorted_keys = sorted_keys
+        return sorted_keys
+
+    def get_page(self, page_size, token=None):
+        """
+        A page of my keys, in ascending order.
+        The token gives the last key of the previous page, a page starts after it
+        also if keys were added or removed since the previous page.
+
+        :param int page_size: The maximum number of keys of the page
+        :param str token: The token returned with the previous page,
+            None for the first page
+        :returns: A list of keys, and the token of the next page
+            (None after the last page)
+        """
+        if page_size < 1:
+            raise ValueError("The page size has to be positive")
+        _, keys, sort_keys = self._get_sorted()
+        start = 0 if token is None else bisect.bisect_right(sort_keys,
+                get_sort_key(decode_page_token(token)))
+        page = keys[start:start+page_size]
+        if start + page_size < len(keys):
+            return page, encode_page_token(page[-1])
+        return page, None
+
+    def iter_pages(self, page_size, token=None):
+        """
+        Yields the pages of my keys, see :meth:`get_page`
+        """
+        while True:
+            page, token = self.get_page(page_size, token)
+            if page:
+                yield page
+            if token is None:
+                return
+
 class AiidaEntitySet(AbstractSetContainer):
     """
     Instances of this class reference a subset of entities in a databases
@@ -127,13 +304,11 @@ class AiidaEntitySet(AbstractSetContainer):
     """
     def __init__(self, aiida_cls):
         """
-        :param aiida_cls: A valid AiiDA ORM class, i.e. Node, Group, Computer
+        :param aiida_cls: A valid AiiDA ORM class, i.e. Node, Group,
+            or the name of its entity type, i.e. 'node', 'group'.
         """
-        if not aiida_cls in VALID_ENTITY_CLASSES:
-            raise TypeError("aiida_cls has to be among:{}".format(
-                    VALID_ENTITY_CLASSES))
         # Done with checks, saving to attributes:
-        self._aiida_cls = aiida_cls
+        self._entity_type = get_entity_type(aiida_cls)
         # The _set is the set where keys are set:
         self._set = set()
         # the identifier for the key, when I get instance classes
@@ -150,7 +325,7 @@ class AiidaEntitySet(AbstractSetContainer):
         """
         if not isinstance(other, AiidaEntitySet):
             raise TypeError("Other class is not an instance of AiidaEntitySet")
-        if self.aiida_cls != other.aiida_cls:
+        if self.entity_type != other.entity_type:
             raise TypeError("The two instances do not have the same aiida type!")
         if self.identifier != other.identifier:
             raise ValueError("The two instances do not have the same identifier!")
@@ -163,9 +338,13 @@ class AiidaEntitySet(AbstractSetContainer):
     def identifier(self):
         return self._identifier
 
+    @property
+    def entity_type(self):
+        return self._entity_type
+
     @property
     def aiida_cls(self):
-        return self._aiida_cls
+        return get_aiida_cls(self._entity_type)
 
 
     def _check_input_for_set(self, input_for_set):
@@ -173,10 +352,11 @@ class AiidaEntitySet(AbstractSetContainer):
         When giving me something to the set, this utility function can be used
         to do the right thing.
         """
-        if isinstance(input_for_set, self._aiida_cls):
-            return getattr(input_for_set, self._identifier)
-        elif isinstance(input_for_set, self._identifier_type):
+        # Keys are checked first, they do not require to import the ORM:
+        if isinstance(input_for_set, self._identifier_type):
             return input_for_set
+        elif isinstance(input_for_set, self.aiida_cls):
+            return getattr(input_for_set, self._identifier)
         else:
             raise ValueError("{} is not a valid input\n"
                 "You can either pass an AiiDA instance or a key to an instance that"
@@ -185,25 +365,73 @@ class AiidaEntitySet(AbstractSetContainer):
                         self._identifier_type))
 
 
+    def set_keys(self, keys):
+        """
+        Replacing my set with keys given in bulk. Instead of checking every key,
+        the type of all keys is checked once.
+
+        :param keys: Integer keys, see :func:`get_key_array`
+        """
+        self._set = set(get_key_array(keys).tolist())
+
+    def add_keys(self, keys):
+        """
+        Adding keys given in bulk to my set, see :meth:`set_keys`.
+        """
+        self._set = self._set.union(get_key_array(keys).tolist())
+
     def copy(self, with_data=True):
         """
         Create a new instance, with the attributes defining being the same.
         :param bool with_data: Whether to copy also the data.
         """
-        new = AiidaEntitySet(aiida_cls=self.aiida_cls) #
+        new = AiidaEntitySet(aiida_cls=self.entity_type) #
         #  , identifier=self.identifier, identifier_type=self._identifier_type)
         if with_data:
             new._set_key_set_nocheck(self._set.copy())
         return new
 
-    def get_entities(self):
+    def get_entities(self, page_size=None, store=None):
         """
         Return the AiiDA entities
-        """
-        for entity, in  QueryBuilder().append(self._aiida_cls, project='*', 
-                filters={self._identifier:{'in':self._set}}).iterall():
+
+        :param int page_size: If given, the entities are loaded page by page
+            (see :meth:`get_entities_page`) and returned in the order of their keys.
+        :param store: The GraphStore to load the entities from, by default the
+            database of AiiDA. Other stores can return other objects than
+            AiiDA entities.
+        """
+        if page_size is not None:
+            for page in self.iter_pages(page_size):
+                for entity in self._get_entities_by_keys(page, store):
+                    yield entity
+            return
+        for entity in self._get_store(store).get_entities(self._entity_type,
+                self._identifier, self._set):
             yield entity
 
+    def _get_store(self, store):
+        if store is None:
+            from .stores import QueryBuilderStore
+            store = QueryBuilderStore()
+        return store
+
+    def _get_entities_by_keys(self, keys, store):
+        return list(self._get_store(store).get_entities(self._entity_type,
+                self._identifier, keys, ordered=True))
+
+    def get_entities_page(self, page_size, token=None, store=None):
+        """
+        A page of the AiiDA entities, in the order of their keys.
+        The keys of the page are found in the sorted keys, the database is only
+        asked for the entities of that page.
+
+        :returns: A list of entities, and the token of the next page,
+            see :meth:`~AbstractSetContainer.get_page`
+        """
+        page, token = self.get_page(page_size, token)
+        return self._get_entities_by_keys(page, store), token
+
 class DirectedEdgeSet(AbstractSetContainer):
     """
     Instances of this class reference a subset of edges in a databases
@@ -213,15 +441,13 @@ class DirectedEdgeSet(AbstractSetContainer):
     """
     def __init__(self, aiida_cls_to, aiida_cls_from, additional_identifiers=None):
         """
-        :param aiida_cls: A valid AiiDA ORM class, i.e. Node, Group, Computer
+        :param aiida_cls_to: A valid AiiDA ORM class, i.e. Node, Group,
+            or the name of its entity type, i.e. 'node', 'group'.
+        :param aiida_cls_from: Same as aiida_cls_to
         """
-        for aiida_cls in (aiida_cls_to,  aiida_cls_from):
-            if not aiida_cls in VALID_ENTITY_CLASSES:
-                raise TypeError("aiida_cls has to be among:{}".format(
-                        VALID_CLASSES))
         # Done with checks, saving to attributes:
-        self._aiida_cls_to = aiida_cls_to
-        self._aiida_cls_from = aiida_cls_from
+        self._aiida_cls_to = get_entity_type(aiida_cls_to)
+        self._aiida_cls_from = get_entity_type(aiida_cls_from)
         # The _set is the set where keys are set:
         self._set = set()
 
@@ -269,6 +495,33 @@ class DirectedEdgeSet(AbstractSetContainer):
                 "It has to be a tuple".format(input_for_set))
 
 
+    def _get_edges_from_columns(self, columns):
+        if len(columns) != self._len_all_identifiers:
+            raise ValueError("{} columns were passed, {} are needed".format(
+                    len(columns), self._len_all_identifiers))
+        # The keys of the vertices are checked as arrays, the additional
+        # identifiers (e.g. labels) are taken as they are:
+        columns = [get_key_array(column).tolist() for column in columns[:2]] + [
+                list(column) for column in columns[2:]]
+        if len(set(len(column) for column in columns)) > 1:
+            raise ValueError("The columns do not have the same length")
+        return set(zip(*columns))
+
+    def set_columns(self, *columns):
+        """
+        Replacing my set with edges given in bulk, as one column per identifier:
+        the keys of the vertices the edges come from, the keys of the vertices
+        they go to, and every additional identifier.
+        The columns are checked once, instead of every edge.
+        """
+        self._set = self._get_edges_from_columns(columns)
+
+    def add_columns(self, *columns):
+        """
+        Adding edges given in bulk to my set, see :meth:`set_columns`
+        """
+        self._set = self._set.union(self._get_edges_from_columns(columns))
+
     def copy(self, with_data=True):
         """
         Create a new instance, with the attributes defining being the same.
@@ -289,16 +542,21 @@ class Basket():
     In the current implementation, they contain a Node "set" and a Group "set".
     :TODO: Computers and Users!
     """
-    def __init__(self, nodes=None, groups=None, nodes_nodes=None):
+    def __init__(self, nodes=None, groups=None, nodes_nodes=None, nodes_groups=None):
         """
         :param nodes: An AiidaEntitySet of Node
         :param groups: An AiidaEntitySet of Group
+        :param nodes_nodes: A DirectedEdgeSet of links between nodes, the
+            tuples are (id the hop started from, id it reached, label, type),
+            i.e. (output id, input id, ...) for hops to the inputs
+        :param nodes_groups: A DirectedEdgeSet of group memberships,
+            the tuples are (node id, group id), for hops in both directions.
         """
         def get_check_set_entity_set(var, keyword, cls):
             if var is None:
                 return AiidaEntitySet(cls)
             if isinstance(var, AiidaEntitySet):
-                if var.aiida_cls is cls:
+                if var.entity_type == cls:
                     return var
                 else:
                     raise TypeError("{}  has to  have {} as aiida_cls".format(keyword, cls))
@@ -311,19 +569,21 @@ class Basket():
                 return DirectedEdgeSet(aiida_cls_to=cls_to, aiida_cls_from=cls_from, 
                         additional_identifiers=additional_identifiers)
             if isinstance(var, DirectedEdgeSet):
-                if var._aiida_cls_from is not cls_from:
+                if var._aiida_cls_from != cls_from:
                     raise TypeError("{} has to  have {} as aiida_cls_from".format(keyword, cls_from))
-                elif var._aiida_cls_to is not cls_to:
+                elif var._aiida_cls_to != cls_to:
                     raise TypeError("{} has to  have {} as aiida_cls_to".format(keyword, cls_to))
                 else:
                     return var
             else:
                 raise TypeError("{} has to be an instance of DirectedEdgeSet".format(keyword))
 
-        nodes = get_check_set_entity_set(nodes, 'nodes', Node)
-        groups = get_check_set_entity_set(groups, 'groups', Group)
-        nodes_nodes = get_check_set_directed_edge_set(nodes_nodes, 'nodes-nodes', Node, Node, 
+        nodes = get_check_set_entity_set(nodes, 'nodes', 'node')
+        groups = get_check_set_entity_set(groups, 'groups', 'group')
+        nodes_nodes = get_check_set_directed_edge_set(nodes_nodes, 'nodes-nodes', 'node', 'node', 
                 additional_identifiers=('label', 'type'))
+        nodes_groups = get_check_set_directed_edge_set(nodes_groups, 'nodes-groups', 'node', 'group',
+                additional_identifiers=())
 
 
         # ~ if nodes is None:
@@ -343,12 +603,12 @@ class Basket():
         # ~ nodes_nodes = AiidaEdgeSet(Node, Node, additional_identifiers=('type', 'label'))
         # ~ nodes_groups = AiidaEdgeSet(Node, Group, additional_identifiers=())
         self._dict = dict(nodes=nodes, groups=groups, 
-                nodes_nodes=nodes_nodes, #nodes_groups=nodes_groups
+                nodes_nodes=nodes_nodes, nodes_groups=nodes_groups,
             )
 
     @property
     def sets(self):
-        return zip(*sorted(self.dict.items()))[1]
+        return tuple(self._dict[key] for key in sorted(self._dict))
 
     @property
     def dict(self):
@@ -425,10 +685,132 @@ class Basket():
 
 
 
+class VersionedStash(object):
+    """
+    A stash for the walkers of a RuleSequence (see
+    :class:`~age.rules.RuleSaveWalkers` and :class:`~age.rules.RuleSetWalkers`)
+    that keeps a version for every save.
+
+    A save only stores what is new since the last save, as an immutable
+    segment. Only the segments are kept, a version is the union of the
+    segments that were saved up to it. Stashes created with :meth:`branch`
+    share the segments they have in common with the stash they were branched
+    from, the keys of these segments are never copied.
+
+    To find what is new, a save takes the difference of the walkers with
+    every segment, which costs up to O(len(walkers)) per segment, and less
+    as the remaining keys get fewer. A restore gives the walkers the segment
+    itself if the version has only one, and otherwise builds the union of
+    its segments, O(len(stash)). The set containers never change their sets
+    in place, but replace them, so the last snapshot that was restored is
+    kept: restoring it again, and saving walkers that were restored and not
+    changed since, is free.
+    """
+    def __init__(self):
+        # For every key of the sets of a basket, the segments of keys
+        # added by every save:
+        self._segments = {}
+        # For every version, the number of segments for every key:
+        self._versions = []
+        # The last snapshot that was restored, with its number of segments,
+        # for every key:
+        self._snapshots = {}
+
+    @property
+    def version(self):
+        """
+        The version of the last save, None if nothing was saved
+        """
+        return len(self._versions) - 1 if self._versions else None
+
+    def __len__(self):
+        return sum(sum(len(segment) for segment in segments)
+                for segments in self._segments.values())
+
+    def _get_snapshot(self, key, version):
+        segments = self._segments.get(key, [])
+        nr_of_segments = len(segments) if version is None else self._versions[version].get(key, 0)
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None and snapshot[0] == nr_of_segments:
+            return snapshot[1]
+        if nr_of_segments == 1:
+            keys = segments[0]
+        else:
+            keys = frozenset().union(*segments[:nr_of_segments])
+        self._snapshots[key] = (nr_of_segments, keys)
+        return keys
+
+    def save(self, basket):
+        """
+        Adds the keys of the basket to the stash, as a new version.
+
+        :param basket: A Basket
+        :returns: The new version
+        """
+        for key, set_ in basket.dict.items():
+            new = set_.get_keys()
+            segments = self._segments.setdefault(key, [])
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None and new is snapshot[1]:
+                # Nothing is new, the walkers were restored and not changed since
+                continue
+            for segment in segments:
+                if not new:
+                    break
+                new = new.difference(segment)
+            if new:
+                segments.append(frozenset(new))
+        self._versions.append(dict((key, len(segments))
+                for key, segments in self._segments.items()))
+        return self.version
+
+    def restore(self, basket, version=None):
+        """
+        Replaces the keys of the basket with the keys of the stash.
+
+        :param basket: A Basket
+        :param int version: The version to restore, by default the last one
+        """
+        if version is not None and not 0 <= version < len(self._versions):
+            raise ValueError("No version {} in the stash".format(version))
+        for key, set_ in basket.dict.items():
+            set_._set_key_set_nocheck(self._get_snapshot(key, version))
+
+    def branch(self, version=None):
+        """
+        :param int version: The version to branch from, by default the last one
+        :returns: A new stash with the versions of this stash up to the given
+            one, sharing their segments. Saves to either stash are not seen
+            by the other.
+        """
+        if version is None:
+            version = self.version
+        new = VersionedStash()
+        if version is None:
+            return new
+        new._versions = [dict(counts) for counts in self._versions[:version+1]]
+        for key, nr_of_segments in new._versions[-1].items():
+            new._segments[key] = self._segments[key][:nr_of_segments]
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None and snapshot[0] == nr_of_segments:
+                new._snapshots[key] = snapshot
+        return new
+
+
+def _is_array(obj):
+    """
+    :returns: Whether obj is a numpy array. numpy is not imported for this,
+        if it was not imported, obj cannot be an array.
+    """
+    np = sys.modules.get('numpy')
+    return np is not None and isinstance(obj, np.ndarray)
+
+
 def get_basket(node_ids=None, group_ids=None, *args):
     """
     Utility function to get an instance of Basket.
-    :param node_ids: An iterable of node-ids (pks) that are wanted
+    :param node_ids: An iterable of node-ids (pks) that are wanted,
+        numpy arrays are added in bulk
     :param group_ids: An iterable group-ids (pks) that are wanted in the set
     :param args:
         Additional arguments can be groups and/or nodes, that will be added to the
@@ -439,16 +821,26 @@ def get_basket(node_ids=None, group_ids=None, *args):
         aiida_entitiy_sets = get_entit_sets(node_ids=(1,2), group_ids=8)
     """
 
-    node_set = AiidaEntitySet(Node) #, identifier='id', identifier_type=int)
-    if node_ids:
-        node_set.set_entities(node_ids)
-    group_set = AiidaEntitySet(Group) #, identifier='id', identifier_type=int)
-    if group_ids:
-        group_set.set_entities(group_ids)
+    node_set = AiidaEntitySet('node') #, identifier='id', identifier_type=int)
+    group_set = AiidaEntitySet('group') #, identifier='id', identifier_type=int)
+    for entity_set, ids in ((node_set, node_ids), (group_set, group_ids)):
+        if ids is None:
+            continue
+        if isinstance(ids, numbers.Integral):
+            # Also a numpy integer is a single key:
+            ids = (int(ids),)
+        if _is_array(ids) or isinstance(ids, memoryview):
+            # Arrays are checked at once:
+            entity_set.set_keys(ids)
+        else:
+            entity_set.set_entities(ids)
 
-    nodes = [a for a in args if isinstance(a,Node)]
-    node_set.add_entities(nodes)
+    if args:
+        # Only if instances are passed, the ORM is needed:
+        from aiida.orm import Node, Group
+        nodes = [a for a in args if isinstance(a,Node)]
+        node_set.add_entities(nodes)
 
-    groups = [a for a in args if isinstance(a,Group)]
-    group_set.add_entities(nodes)
+        groups = [a for a in args if isinstance(a,Group)]
+        group_set.add_entities(groups)
     return Basket(nodes=node_set, groups=group_set)
@@ -0,0 +1,123 @@
+import math
+import random
+
+from .entities import AiidaEntitySet, Basket
+from .rules import MODES, Operation
+from .specs import RuleSpec
+
+
+def _get_hop_rule(rule, **kwargs):
+    """
+    :returns: The rule (an Operation or a RuleSpec) rebuilt to do a single
+        iteration, returning only the entities that were not given.
+    """
+    if isinstance(rule, Operation):
+        rule = RuleSpec.from_rule(rule)
+    if not isinstance(rule, RuleSpec) or rule.kind not in ('update', 'sequence'):
+        raise TypeError("rule has to be an UpdateRule, a RuleSequence or the RuleSpec of one")
+    spec = rule.to_dict()
+    spec.update(mode=MODES.REPLACE, max_iterations=1)
+    return RuleSpec.from_dict(spec).build(**kwargs), rule.max_iterations
+
+
+def _get_ratio_error(counts, sizes, ratio):
+    """
+    :returns: The standard error of the ratio estimator sum(counts)/sum(sizes),
+        from the spread of the counts of the batches.
+    """
+    nr_of_batches = len(sizes)
+    if nr_of_batches < 2:
+        return 0.
+    mean_size = float(sum(sizes)) / nr_of_batches
+    variance = sum((count - ratio*size)**2 for count, size in zip(counts, sizes))
+    return math.sqrt(variance / (nr_of_batches-1) / nr_of_batches) / mean_size
+
+
+def estimate_closure(rule, walkers, sample_size=1000, nr_of_batches=10, seed=None,
+        **kwargs):
+    """
+    Estimates how many entities a rule visits, without running it.
+    At every iteration, only a uniform sample of (at most sample_size) entities
+    of the frontier is expanded, in batches. The number of new entities the
+    batches reach, each counted once, is scaled to the estimated size of the
+    frontier, and the spread between the batches gives the error.
+    As long as the frontier fits in the sample, the results are exact.
+
+    The estimate is biased upwards when many entities of the frontier share
+    their results, or when the rule walks back to entities that were visited
+    but not sampled, since these are counted as new.
+
+    :param rule: An UpdateRule, a RuleSequence or the RuleSpec of one
+    :param walkers: A Basket with the entities to start from
+    :param int sample_size: The number of entities expanded per iteration
+    :param int nr_of_batches: The number of batches the sample is split into
+    :param seed: The seed for the sampling
+    :param kwargs: Additional keyword arguments to build the rule, e.g. caches.
+    :returns: A list with a dictionary for every iteration (starting with the
+        walkers as iteration 0), with the estimated number of new and of
+        visited entities for every set of the Basket, their standard errors,
+        and whether the numbers are exact.
+    """
+    if not isinstance(walkers, Basket):
+        raise TypeError("You need to set the walkers with a Basket")
+    if sample_size < 1 or nr_of_batches < 1:
+        raise ValueError("sample_size and nr_of_batches have to be positive")
+    hop_rule, max_iterations = _get_hop_rule(rule, **kwargs)
+    rng = random.Random(seed)
+    set_keys = sorted(key for key, set_ in walkers.dict.items()
+            if isinstance(set_, AiidaEntitySet))
+    # All the entities that were reached from the samples:
+    seen = dict((key, set(walkers[key].get_keys())) for key in set_keys)
+    new = dict((key, float(len(seen[key]))) for key in set_keys)
+    new_errors = dict((key, 0.) for key in set_keys)
+    total = dict(new)
+    total_variances = dict(new_errors)
+    exact = True
+    estimates = [dict(iteration=0, new=dict(new), new_errors=dict(new_errors),
+            total=dict(total), total_errors=dict(new_errors), exact=exact)]
+    frontier = [(key, pk) for key in set_keys for pk in seen[key]]
+    iterations = 0
+    while frontier and iterations < max_iterations:
+        iterations += 1
+        frontier_size = sum(new.values())
+        frontier_error = math.sqrt(sum(error**2 for error in new_errors.values()))
+        sample = rng.sample(frontier, min(sample_size, len(frontier)))
+        exact = exact and len(sample) == len(frontier)
+        batches = [sample[i::nr_of_batches] for i in range(nr_of_batches)]
+        batches = [batch for batch in batches if batch]
+        counts = dict((key, []) for key in set_keys)
+        found = dict((key, set()) for key in set_keys)
+        for batch in batches:
+            batch_walkers = walkers.copy(with_data=False)
+            for key in set_keys:
+                batch_walkers[key]._set_key_set_nocheck(
+                        set(pk for set_key, pk in batch if set_key == key))
+            results = hop_rule.run(batch_walkers)
+            for key in set_keys:
+                batch_found = results[key].get_keys() - seen[key]
+                counts[key].append(len(batch_found))
+                found[key].update(batch_found)
+        sizes = [len(batch) for batch in batches]
+        for key in set_keys:
+            seen[key].update(found[key])
+            # Entities reached from several batches are counted once:
+            ratio = float(len(found[key])) / len(sample)
+            new[key] = ratio * frontier_size
+            if exact:
+                new_errors[key] = 0.
+            else:
+                # The finite population correction:
+                correction = math.sqrt(max(0., 1. - len(sample)/frontier_size))
+                batch_ratio = float(sum(counts[key])) / len(sample)
+                ratio_error = _get_ratio_error(counts[key], sizes, batch_ratio) * correction
+                new_errors[key] = math.sqrt((ratio_error*frontier_size)**2 +
+                        (ratio*frontier_error)**2)
+            total[key] += new[key]
+            total_variances[key] += new_errors[key]**2
+        estimates.append(dict(iteration=iterations, new=dict(new),
+                new_errors=dict(new_errors), total=dict(total),
+                total_errors=dict((key, math.sqrt(variance))
+                        for key, variance in total_variances.items()),
+                exact=exact))
+        frontier = [(key, pk) for key in set_keys for pk in found[key]]
+    return estimates
@@ -0,0 +1,278 @@
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+
+from six.moves import queue
+
+from .entities import AiidaEntitySet
+from .rules import MODES
+
+ARCHIVE_VERSION = '0.1'
+ARCHIVE_SUFFIXES = {'.tar':'w', '.tar.gz':'w:gz', '.tgz':'w:gz'}
+
+NODE_PROJECTIONS = ('id', 'uuid', 'type', 'label', 'description', 'ctime', 'mtime')
+GROUP_PROJECTIONS = ('id', 'uuid', 'name', 'type', 'description', 'time')
+
+# Signals the end of the stream to the writing thread:
+_STOP = None
+
+
+def _get_chunks(keys, chunk_size):
+    keys = list(keys)
+    for start in range(0, len(keys), chunk_size):
+        yield keys[start:start+chunk_size]
+
+
+class ArchiveWriter(object):
+    """
+    Writes the entities of Baskets to an archive, batch by batch, while a
+    traversal is running::
+
+        with ArchiveWriter('closure.tar.gz') as writer:
+            rule.run(walkers, consumer=writer.write)
+
+    The keys given to :meth:`write` are split into batches. Every batch is
+    fetched from the database with one query and appended to the files of
+    the archive. By default this is done in a thread, so that writing
+    overlaps with the queries of the traversal. The queue between the two is
+    bounded, a traversal that finds entities faster than they are written
+    waits, so that the memory stays bounded.
+
+    The archive is a directory (or a tar file of it) with:
+
+    * nodes.jsonl: A JSON object per line for every node, with the
+      columns and the attributes of the node.
+    * groups.jsonl: A JSON object per line for every group.
+    * links.jsonl: A JSON object per line for every link (an edge between
+      nodes), with the UUIDs of input and output, label and type.
+    * nodes/: The repository folders of the nodes, sharded by UUID as
+      in the AiiDA export files.
+    * metadata.json: The number of entries, written when closing.
+
+    Baskets given to :meth:`write` are expected to be disjoint, as the
+    consumer of :meth:`~age.rules.Operation.run` receives them.
+    """
+    def __init__(self, path, batch_size=1000, with_files=True, threaded=True,
+            queue_size=10):
+        """
+        :param str path: The directory to write to, or a file ending
+            with one of ARCHIVE_SUFFIXES
+        :param int batch_size: The number of entities fetched per query
+        :param bool with_files: Whether to copy the repository folders of the nodes
+        :param bool threaded: Whether to fetch and write in a separate thread
+        :param int queue_size: The maximum number of batches waiting to be written
+        """
+        self._path = path
+        self._mode = None
+        for suffix, mode in ARCHIVE_SUFFIXES.items():
+            if path.endswith(suffix):
+                self._mode = mode
+        if self._mode is None:
+            if os.path.exists(path) and os.listdir(path):
+                raise ValueError("{} is not an empty directory".format(path))
+            self._folder = path
+            if not os.path.exists(path):
+                os.makedirs(path)
+        else:
+            self._folder = tempfile.mkdtemp()
+        self._batch_size = batch_size
+        self._with_files = with_files
+        self._files = dict((name, open(os.path.join(self._folder, name), 'w'))
+                for name in ('nodes.jsonl', 'groups.jsonl', 'links.jsonl', 'memberships.jsonl'))
+        self._counts = dict(nodes=0, groups=0, links=0, memberships=0)
+        self._error = None
+        self._closed = False
+        if threaded:
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._thread = threading.Thread(target=self._work)
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._queue = None
+            self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError("Writing the archive failed:\n{}".format(self._error))
+
+    def _work(self):
+        import traceback
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is _STOP:
+                    return
+                # After an error, batches are only taken from the queue:
+                if self._error is None:
+                    self._write_batch(*batch)
+            except Exception:
+                self._error = traceback.format_exc()
+            finally:
+                self._queue.task_done()
+
+    def write(self, basket):
+        """
+        Writes the entities and edges of a Basket that have a file in the archive.
+
+        :param basket: A Basket
+        """
+        if self._closed:
+            raise RuntimeError("The archive is closed")
+        self._check_error()
+        for set_key, set_ in basket.dict.items():
+            if isinstance(set_, AiidaEntitySet):
+                if set_.identifier != 'id':
+                    raise ValueError("Only entities identified by id can be written")
+                kind = set_.entity_type
+            elif set_key == 'nodes_nodes':
+                kind = 'link'
+            elif set_key == 'nodes_groups':
+                kind = 'membership'
+            else:
+                continue
+            for chunk in _get_chunks(set_.get_keys(), self._batch_size):
+                if self._thread is None:
+                    self._write_batch(kind, chunk)
+                else:
+                    self._queue.put((kind, chunk))
+
+    def _write_batch(self, kind, keys):
+        if kind == 'node':
+            self._write_nodes(keys)
+        elif kind == 'group':
+            self._write_groups(keys)
+        elif kind == 'link':
+            self._write_links(keys)
+        elif kind == 'membership':
+            self._write_memberships(keys)
+        else:
+            raise ValueError("Cannot write {}".format(kind))
+
+    def _dump(self, name, entry):
+        self._files[name].write(json.dumps(entry))
+        self._files[name].write('\n')
+
+    def _write_nodes(self, pks):
+        from aiida.orm import Node
+        from aiida.orm.querybuilder import QueryBuilder
+        from aiida.common.utils import export_shard_uuid
+        from aiida.orm.importexport import serialize_dict
+        qb = QueryBuilder().append(Node, filters={'id':{'in':pks}},
+                project=list(NODE_PROJECTIONS)+['*'])
+        for row in qb.iterall():
+            node = row[-1]
+            entry = serialize_dict(dict(zip(NODE_PROJECTIONS, row[:-1])))
+            entry['attributes'], entry['attributes_conversion'] = serialize_dict(
+                    node.get_attrs(), track_conversion=True)
+            self._dump('nodes.jsonl', entry)
+            if self._with_files and os.path.isdir(node.folder.abspath):
+                shutil.copytree(node.folder.abspath, os.path.join(
+                        self._folder, 'nodes', export_shard_uuid(entry['uuid'])))
+            self._counts['nodes'] += 1
+
+    def _write_groups(self, pks):
+        from aiida.orm import Group
+        from aiida.orm.querybuilder import QueryBuilder
+        from aiida.orm.importexport import serialize_dict
+        qb = QueryBuilder().append(Group, filters={'id':{'in':pks}},
+                project=list(GROUP_PROJECTIONS))
+        for row in qb.iterall():
+            self._dump('groups.jsonl', serialize_dict(dict(zip(GROUP_PROJECTIONS, row))))
+            self._counts['groups'] += 1
+
+    def _write_links(self, edges):
+        from aiida.orm import Node
+        from aiida.orm.querybuilder import QueryBuilder
+        pks = set()
+        for edge in edges:
+            pks.update(edge[:2])
+        qb = QueryBuilder().append(Node, filters={'id':{'in':list(pks)}},
+                project=['id', 'uuid'])
+        uuids = dict((pk, str(uuid)) for pk, uuid in qb.iterall())
+        # The edges go from the entity a hop started from to the one it
+        # reached, which is the output only for hops to the outputs.
+        # The direction of the links is taken from the database:
+        qb = QueryBuilder().append(Node, tag='input', filters={'id':{'in':list(pks)}},
+                project='id')
+        qb.append(Node, output_of='input', filters={'id':{'in':list(pks)}}, project='id',
+                edge_project=['label', 'type'])
+        links = set(tuple(row) for row in qb.iterall())
+        for first_pk, second_pk, label, link_type in edges:
+            if (first_pk, second_pk, label, link_type) in links:
+                input_pk, output_pk = first_pk, second_pk
+            elif (second_pk, first_pk, label, link_type) in links:
+                input_pk, output_pk = second_pk, first_pk
+            else:
+                raise ValueError("There is no link {} between {} and {}".format(
+                        (label, link_type), first_pk, second_pk))
+            self._dump('links.jsonl', {'input':uuids[input_pk],
+                    'output':uuids[output_pk], 'label':label, 'type':link_type})
+            self._counts['links'] += 1
+
+    def _write_memberships(self, memberships):
+        from aiida.orm import Node, Group
+        from aiida.orm.querybuilder import QueryBuilder
+        uuids = {}
+        for index, aiida_cls in enumerate((Node, Group)):
+            qb = QueryBuilder().append(aiida_cls, project=['id', 'uuid'],
+                    filters={'id':{'in':list(set(key[index] for key in memberships))}})
+            uuids[aiida_cls] = dict((pk, str(uuid)) for pk, uuid in qb.iterall())
+        for node_pk, group_pk in memberships:
+            self._dump('memberships.jsonl', {'node':uuids[Node][node_pk],
+                    'group':uuids[Group][group_pk]})
+            self._counts['memberships'] += 1
+
+    def get_counts(self):
+        """
+        :returns: The number of entries written so far, by file
+        """
+        return dict(self._counts)
+
+    def close(self):
+        """
+        Waits for the pending batches, writes the metadata and,
+        if the archive is a file, packs it.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+        for file_ in self._files.values():
+            file_.close()
+        try:
+            self._check_error()
+            with open(os.path.join(self._folder, 'metadata.json'), 'w') as file_:
+                json.dump(dict(version=ARCHIVE_VERSION, counts=self._counts), file_)
+            if self._mode is not None:
+                with tarfile.open(self._path, self._mode) as archive:
+                    archive.add(self._folder, arcname='.')
+        finally:
+            if self._mode is not None:
+                shutil.rmtree(self._folder)
+
+
+def export_closure(rule, walkers, path, **kwargs):
+    """
+    Runs the rule and writes the results to an archive while the rule runs.
+
+    :param rule: An Operation, in APPEND mode
+    :param walkers: A Basket with the entities to start from
+    :param str path: The path of the archive, see ArchiveWriter
+    :param kwargs: Additional keyword arguments for the ArchiveWriter
+    :returns: The results of the rule
+    """
+    if rule._mode != MODES.APPEND:
+        raise ValueError("Only the results of rules in APPEND mode can be streamed")
+    with ArchiveWriter(path, **kwargs) as writer:
+        return rule.run(walkers, consumer=writer.write)
@@ -0,0 +1,193 @@
+import numpy as np
+
+from .entities import AiidaEntitySet
+
+
+class DenseIndex(object):
+    """
+    Maps sparse database keys (e.g. pks) to contiguous integers 0, 1, 2...
+    Keys get their index when they are first encoded, indices never change.
+    Encoding and decoding are vectorized.
+
+    The keys are looked up in a sorted array. New keys are first kept in a
+    dictionary, and inserted into the sorted array (at the positions given by
+    searchsorted) once there are as many of them as half the array. An
+    encode therefore costs O(len(keys)) plus, amortized, O(1) for every new
+    key, and not a sort of all keys.
+    """
+    # The new keys kept in the dictionary before they are always merged:
+    MIN_PENDING = 1024
+
+    def __init__(self):
+        # The key for every index, with space to grow:
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._size = 0
+        # The keys sorted, and their indices, for lookups:
+        self._sorted_keys = np.zeros(0, dtype=np.int64)
+        self._sorted_indices = np.zeros(0, dtype=np.int64)
+        # The index of every key that is not yet in the sorted arrays:
+        self._pending = {}
+
+    def __len__(self):
+        return self._size
+
+    def _lookup(self, keys):
+        positions = np.searchsorted(self._sorted_keys, keys)
+        found = positions < len(self._sorted_keys)
+        found[found] = self._sorted_keys[positions[found]] == keys[found]
+        return positions, found
+
+    def _append(self, new_keys):
+        size = self._size + len(new_keys)
+        if size > len(self._keys):
+            keys = np.zeros(max(size, 2*len(self._keys)), dtype=np.int64)
+            keys[:self._size] = self._keys[:self._size]
+            self._keys = keys
+        self._keys[self._size:size] = new_keys
+        self._size = size
+
+    def _merge(self):
+        pending_keys = np.fromiter(self._pending.keys(), dtype=np.int64,
+                count=len(self._pending))
+        pending_indices = np.fromiter(self._pending.values(), dtype=np.int64,
+                count=len(self._pending))
+        order = np.argsort(pending_keys)
+        positions = np.searchsorted(self._sorted_keys, pending_keys[order])
+        self._sorted_keys = np.insert(self._sorted_keys, positions, pending_keys[order])
+        self._sorted_indices = np.insert(self._sorted_indices, positions,
+                pending_indices[order])
+        self._pending = {}
+
+    def encode(self, keys):
+        """
+        :param keys: An iterable of integer keys
+        :returns: A numpy array with the dense index of every key.
+            Keys that were not seen before get new indices.
+        """
+        keys = np.fromiter(keys, dtype=np.int64)
+        positions, found = self._lookup(keys)
+        indices = np.empty(len(keys), dtype=np.int64)
+        indices[found] = self._sorted_indices[positions[found]]
+        if not found.all():
+            missing = np.flatnonzero(~found)
+            pending = self._pending
+            new_keys = []
+            missing_indices = []
+            for key in keys[missing].tolist():
+                index = pending.get(key)
+                if index is None:
+                    index = pending[key] = self._size + len(new_keys)
+                    new_keys.append(key)
+                missing_indices.append(index)
+            indices[missing] = missing_indices
+            if new_keys:
+                self._append(new_keys)
+            if len(pending) >= max(self.MIN_PENDING, len(self._sorted_keys)//2):
+                self._merge()
+        return indices
+
+    def decode(self, indices):
+        """
+        :param indices: A numpy array of dense indices
+        :returns: A numpy array with the keys
+        """
+        return self._keys[indices]
+
+
+class VisitedBitset(object):
+    """
+    The visited state of entities, given by their dense index, as a boolean array.
+    """
+    def __init__(self):
+        self._mask = np.zeros(0, dtype=bool)
+
+    def __len__(self):
+        return int(np.count_nonzero(self._mask))
+
+    def _grow(self, size):
+        if size > len(self._mask):
+            mask = np.zeros(max(size, 2*len(self._mask)), dtype=bool)
+            mask[:len(self._mask)] = self._mask
+            self._mask = mask
+
+    def get_unvisited(self, indices):
+        """
+        :param indices: A numpy array of dense indices
+        :returns: The distinct indices that have not been visited
+        """
+        indices = np.unique(indices)
+        if len(indices):
+            self._grow(indices[-1]+1)
+        return indices[~self._mask[indices]]
+
+    def add(self, indices):
+        """
+        Marks the indices as visited
+        """
+        if len(indices):
+            self._grow(np.max(indices)+1)
+            self._mask[indices] = True
+
+    def __ior__(self, other):
+        self._grow(len(other._mask))
+        self._mask[:len(other._mask)] |= other._mask
+        return self
+
+    def get_indices(self):
+        """
+        :returns: A numpy array with the visited indices
+        """
+        return np.flatnonzero(self._mask)
+
+
+class DenseVisits(object):
+    """
+    Keeps track of the entities visited during a run of an Operation.
+    The keys of every AiidaEntitySet of the Basket are mapped to dense indices
+    once, and their visited state is stored in a bitset. The frontier minus
+    the visited entities is then a vectorized mask, and the union a bitwise OR.
+    Edges are kept in sets.
+    Keys are converted back only at the boundaries, i.e. for the walkers
+    of the next hop and for the visited Basket at the end of the run.
+    """
+    def __init__(self, visited):
+        """
+        :param visited: A Basket with the entities visited so far.
+            The edges visited are updated in place in this Basket,
+            the other sets with :meth:`load_visited`.
+        """
+        self._visited = visited
+        self._dense_keys = [key for key, set_ in visited.dict.items()
+                if isinstance(set_, AiidaEntitySet)]
+        self._indices = dict((key, DenseIndex()) for key in self._dense_keys)
+        self._bitsets = dict((key, VisitedBitset()) for key in self._dense_keys)
+        for key in self._dense_keys:
+            self._bitsets[key].add(self._indices[key].encode(visited[key].get_keys()))
+
+    def update(self, new_results):
+        """
+        :param new_results: A Basket with the results of a hop
+        :returns: A new Basket with the results not visited yet, that are
+            now marked as visited.
+        """
+        active_walkers = new_results.copy(with_data=False)
+        for key, set_ in new_results.dict.items():
+            if key in self._bitsets:
+                index = self._indices[key]
+                new_indices = self._bitsets[key].get_unvisited(index.encode(set_.get_keys()))
+                self._bitsets[key].add(new_indices)
+                active_walkers[key]._set_key_set_nocheck(
+                        set(index.decode(new_indices).tolist()))
+            else:
+                active_walkers[key] = set_ - self._visited[key]
+                self._visited[key] += active_walkers[key]
+        return active_walkers
+
+    def load_visited(self):
+        """
+        Loads the visited keys into the visited Basket, and returns it.
+        """
+        for key in self._dense_keys:
+            self._visited[key]._set_key_set_nocheck(set(self._indices[key].decode(
+                    self._bitsets[key].get_indices()).tolist()))
+        return self._visited
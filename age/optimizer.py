@@ -0,0 +1,230 @@
+import random
+import time
+
+from .rules import MODES, Operation, UpdateRule, RuleSequence
+
+
+def _is_fusable(rule):
+    """
+    Whether the hop of the rule is a prepared query of the QueryBuilder, that
+    can be fused with others, and whether it runs exactly once in a sequence.
+    """
+    from .stores import QueryBuilderStore
+    return (isinstance(rule, UpdateRule) and rule._mode == MODES.APPEND and
+            rule._maxiter == 1 and rule._local_hop is None and
+            rule._membership_hop is None and isinstance(rule._store, QueryBuilderStore))
+
+
+def _is_commutable(rule):
+    return isinstance(rule, UpdateRule) and rule._mode == MODES.APPEND
+
+
+def _describe(rule):
+    if isinstance(rule, UpdateRule):
+        path = rule._queryhelp['path']
+        return '{}->{} ({})'.format(rule._entity_from, rule._entity_to, ', '.join(
+                '{} {}'.format(pathspec['joining_keyword'],
+                rule._queryhelp['filters'].get(pathspec['edge_tag']) or '')
+                for pathspec in path[1:]).strip())
+    return type(rule).__name__
+
+
+class FusedRules(Operation):
+    """
+    Consecutive UpdateRules of a RuleSequence, done with a single query.
+    The results are the same as running the rules one after the other in
+    the sequence: every rule starts from the walkers, and from the targets
+    of the rules before it that reach the entities it starts from.
+    """
+    def __init__(self, rules):
+        """
+        :param rules: UpdateRules in APPEND mode with max_iterations 1,
+            that do their hops with a query
+        """
+        for rule in rules:
+            if not _is_fusable(rule):
+                raise ValueError("{} cannot be fused".format(_describe(rule)))
+        track_visits = set(rule._track_visits for rule in rules)
+        if len(track_visits) != 1:
+            raise ValueError("Fused rules have to agree on tracking visits")
+        self._rules = tuple(rules)
+        self._fused_queries = {}
+        self._fused_query = None
+        super(FusedRules, self).__init__(MODES.APPEND, 1, track_edges=False,
+                track_visits=track_visits.pop())
+
+    @property
+    def rules(self):
+        return self._rules
+
+    def _init_run(self, entity_set):
+        for rule in self._rules:
+            rule._init_run(entity_set)
+        key = tuple(rule._hop_query.projections for rule in self._rules)
+        try:
+            self._fused_query = self._fused_queries[key]
+        except KeyError:
+            from .querying import FusedHopQuery
+            feeds = [[fed_by for fed_by, other in enumerate(self._rules[:index])
+                    if other._entity_to == rule._entity_from]
+                    for index, rule in enumerate(self._rules)]
+            self._fused_query = FusedHopQuery([rule._hop_query for rule in self._rules],
+                    [rule._target_index for rule in self._rules], feeds)
+            self._fused_queries[key] = self._fused_query
+
+    def _load_results(self, target_set, operational_set):
+        target_set.empty()
+        frontiers = [operational_set[rule._entity_from].get_keys() for rule in self._rules]
+        if self._profiler is not None:
+            start = time.time()
+        results = self._fused_query.execute(frontiers)
+        for rule, rows in zip(self._rules, results):
+            # Several rules can reach the same set, the results are added:
+            target_set[rule._entity_to]._set_key_set_nocheck(
+                    target_set[rule._entity_to].get_keys().union(
+                    row[rule._target_index] for row in rows))
+            if rule._track_edges:
+                target_set[rule._edge_set_key]._set_key_set_nocheck(
+                        target_set[rule._edge_set_key].get_keys().union(rows))
+        if self._profiler is not None:
+            plan = None
+            if self._profiler.explain:
+                plan = self._fused_query.explain(frontiers, analyze=self._profiler.analyze)
+            self._profiler.record_hop('fused_query',
+                    frontier_size=sum(len(frontier) for frontier in frontiers),
+                    rows=sum(len(rows) for rows in results), seconds=time.time()-start,
+                    sql=self._fused_query.get_sql(frontiers),
+                    parameter_size=sum(len(frontier) for frontier in frontiers), plan=plan)
+
+
+class OptimizedSequence(RuleSequence):
+    """
+    A RuleSequence returned by :func:`optimize_sequence`, that gives the same
+    results as the original sequence with fewer queries.
+    """
+    def __init__(self, rules, plan, **kwargs):
+        self._plan = plan
+        super(OptimizedSequence, self).__init__(rules, **kwargs)
+
+    def get_plan(self):
+        """
+        :returns: A dictionary with the order of the rules before and after
+            the optimization, the rules that were fused, the estimated fan-out
+            of the rules, and the number of queries per iteration.
+        """
+        return dict(self._plan)
+
+    def get_queries_saved(self):
+        """
+        :returns: The number of queries saved in the last run
+        """
+        if self._iterations_done is None:
+            return 0
+        return self._iterations_done * self._plan['queries_saved_per_iteration']
+
+
+def _estimate_fan_out(rule, walkers, sample_size, rng):
+    """
+    :returns: The number of entities the rule reaches, per entity it starts
+        from, on a sample of the walkers. None if the walkers have none of
+        the entities the rule starts from.
+    """
+    from .estimate import _get_hop_rule
+    keys = list(walkers[rule._entity_from].get_keys())
+    if not keys:
+        return None
+    sample = rng.sample(keys, min(sample_size, len(keys)))
+    sample_walkers = walkers.copy(with_data=False)
+    sample_walkers[rule._entity_from]._set_key_set_nocheck(set(sample))
+    hop_rule, _ = _get_hop_rule(rule, adjacency_cache=rule._adjacency_cache,
+            node_cache=rule._node_cache, membership_cache=rule._membership_cache,
+            store=rule._store)
+    results = hop_rule.run(sample_walkers)
+    return float(len(results[rule._entity_to])) / len(sample)
+
+
+def optimize_sequence(sequence, walkers=None, fuse=True, reorder=True,
+        sample_size=100, seed=None):
+    """
+    Creates a sequence that gives the same results as the given sequence,
+    with fewer queries:
+
+    * If the sequence is iterated until nothing new is found (in APPEND mode,
+      with max_iterations infinite), and all its rules are UpdateRules in APPEND
+      mode, the order of the rules does not change the results. The rules are
+      sorted by their fan-out (the entities reached per entity a hop starts from),
+      estimated on a sample of the walkers, the most selective first.
+    * Consecutive UpdateRules that do a single hop with a query are fused
+      into a single query, see :class:`FusedRules`.
+
+    :param sequence: A RuleSequence
+    :param walkers: A Basket with the entities the sequence will start from,
+        used to estimate the fan-out of the rules. If None, the rules are not
+        reordered.
+    :param bool fuse: Whether to fuse rules
+    :param bool reorder: Whether to reorder rules
+    :param int sample_size: The number of walkers to estimate the fan-out on
+    :param seed: The seed for the sampling
+    :returns: An OptimizedSequence, see its get_plan method
+    """
+    if not isinstance(sequence, RuleSequence):
+        raise TypeError("sequence has to be a RuleSequence")
+    rules = list(sequence._rules)
+    fan_outs = [None]*len(rules)
+    reordered = (reorder and walkers is not None and sequence._mode == MODES.APPEND and
+            sequence._maxiter == float('inf') and all(_is_commutable(rule) for rule in rules))
+    if reordered:
+        rng = random.Random(seed)
+        fan_outs = [_estimate_fan_out(rule, walkers, sample_size, rng) for rule in rules]
+        # Rules that start from entities that are not in the walkers go last:
+        order = sorted(range(len(rules)), key=lambda index: (fan_outs[index] is None,
+                fan_outs[index], index))
+        rules = [rules[index] for index in order]
+        fan_outs = [fan_outs[index] for index in order]
+    else:
+        order = list(range(len(rules)))
+
+    optimized_rules = []
+    fused = []
+
+    def add_group(group):
+        if len(group) > 1:
+            optimized_rules.append(FusedRules(group))
+            fused.append([_describe(rule) for rule in group])
+        else:
+            optimized_rules.extend(group)
+
+    group = []
+    for rule in rules:
+        if fuse and _is_fusable(rule):
+            if group and rule._track_visits != group[0]._track_visits:
+                add_group(group)
+                group = []
+            group.append(rule)
+        else:
+            add_group(group)
+            group = []
+            optimized_rules.append(rule)
+    add_group(group)
+
+    def count_queries(rules):
+        return sum(1 for rule in rules if isinstance(rule, (UpdateRule, FusedRules)) and (
+                isinstance(rule, FusedRules) or rule._local_hop is None))
+
+    queries_before = count_queries(sequence._rules)
+    queries_after = count_queries(optimized_rules)
+    plan = dict(
+            original_order=[_describe(rule) for rule in sequence._rules],
+            order=[_describe(rule) for rule in rules],
+            permutation=order,
+            reordered=reordered,
+            fan_outs=fan_outs,
+            fused=fused,
+            queries_per_iteration_before=queries_before,
+            queries_per_iteration_after=queries_after,
+            queries_saved_per_iteration=queries_before-queries_after)
+    optimized = OptimizedSequence(optimized_rules, plan, mode=sequence._mode,
+            max_iterations=sequence._maxiter, track_edges=sequence._track_edges,
+            track_visits=sequence._track_visits, dense_visits=sequence._dense_visits)
+    optimized.set_profiler(sequence._profiler)
+    return optimized
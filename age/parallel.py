@@ -0,0 +1,344 @@
+import multiprocessing
+import traceback
+
+import numpy as np
+
+from .entities import AiidaEntitySet, Basket
+from .rules import MODES, UpdateRule
+from .specs import RuleSpec
+
+
+def get_owner(key, nr_of_workers):
+    """
+    :returns: The index of the worker that owns the key.
+    """
+    return key % nr_of_workers
+
+
+def _get_arrays_by_owner(keys, nr_of_workers):
+    """
+    :param keys: A numpy array of keys
+    :returns: A list with the array of the keys owned by every worker
+    """
+    owners = keys % nr_of_workers
+    order = np.argsort(owners, kind='mergesort')
+    return np.split(keys[order], np.cumsum(np.bincount(owners,
+            minlength=nr_of_workers))[:-1])
+
+
+def _get_key_set(parts):
+    """
+    :param parts: A list of numpy arrays of keys, or of lists of edges
+    :returns: A set with all keys
+    """
+    return set().union(*(part.tolist() if isinstance(part, np.ndarray) else part
+            for part in parts))
+
+
+class _TraversalWorker(object):
+    """
+    The state of one worker process of a :class:`PartitionedTraversal`.
+    A worker owns the keys that :func:`get_owner` assigns to it. It keeps the
+    visited state of these keys, and expands the frontier made of them.
+    The keys found when expanding are sent directly to the workers that own
+    them, in one batch of numpy arrays per worker and hop, through the inbox
+    queues of the workers.
+    The edges found when expanding start from keys owned by the worker, they
+    are kept by it.
+    """
+    def __init__(self, spec, index, nr_of_workers, rule_kwargs, inboxes):
+        self._rule = spec.build(**rule_kwargs)
+        self._index = index
+        self._nr_of_workers = nr_of_workers
+        self._inboxes = inboxes
+        self.reset({})
+
+    def reset(self, incoming):
+        """
+        :param dict incoming: The walkers owned by this worker, as lists of
+            keys by the key of the set in the Basket
+        """
+        self._visited = Basket()
+        self._active = Basket()
+        self._found_edges = {}
+        self._incoming = dict((set_key, [keys]) for set_key, keys in incoming.items())
+        self._rule._init_run(self._visited)
+
+    def _add_incoming(self, arrays):
+        for set_key, keys in arrays.items():
+            self._incoming.setdefault(set_key, []).append(keys)
+
+    def step(self, expand):
+        """
+        Takes the keys that were sent to this worker in the last hop (or the
+        walkers) and, if expand is set, expands those that were not visited
+        and exchanges the keys found with the other workers. When expand is
+        set, all workers have to step, since every worker waits for a batch
+        from every other worker.
+
+        :param bool expand: Whether to expand the keys that were not visited
+        :returns: The number of keys and edges not visited before
+        """
+        active = self._visited.copy(with_data=False)
+        for set_key, parts in self._incoming.items():
+            active[set_key]._set_key_set_nocheck(
+                    _get_key_set(parts) - self._visited[set_key].get_keys())
+        # The edges found in the last expansion are kept by me:
+        for set_key, set_ in self._found_edges.items():
+            active[set_key] = set_ - self._visited[set_key]
+        self._found_edges = {}
+        self._incoming = {}
+        self._visited += active
+        self._active = active
+        if not expand:
+            return len(active)
+        outgoing = [{} for _ in range(self._nr_of_workers)]
+        try:
+            if active:
+                new_results = self._visited.copy(with_data=False)
+                self._rule._load_results(new_results, active)
+                for set_key, set_ in new_results.dict.items():
+                    if isinstance(set_, AiidaEntitySet):
+                        keys = np.fromiter(set_.get_keys(), dtype=np.int64, count=len(set_))
+                        for owner, owned in enumerate(_get_arrays_by_owner(keys,
+                                self._nr_of_workers)):
+                            if len(owned):
+                                outgoing[owner][set_key] = owned
+                    elif set_:
+                        self._found_edges[set_key] = set_
+        finally:
+            # Every worker sends a batch to every other one, also if it is
+            # empty or the hop failed, and then waits for theirs. The queues
+            # send in a thread, so that large batches do not block:
+            for owner, arrays in enumerate(outgoing):
+                if owner != self._index:
+                    self._inboxes[owner].put(arrays)
+            self._add_incoming(outgoing[self._index])
+            for _ in range(self._nr_of_workers-1):
+                self._add_incoming(self._inboxes[self._index].get())
+        return len(active)
+
+    def collect(self):
+        """
+        :returns: The keys visited and the keys active at the end of the run,
+            as dictionaries {set key: keys}, numpy arrays for entities
+        """
+        def get_keys(basket):
+            return dict((set_key, np.fromiter(set_.get_keys(), dtype=np.int64, count=len(set_))
+                    if isinstance(set_, AiidaEntitySet) else list(set_.get_keys()))
+                    for set_key, set_ in basket.dict.items())
+        return get_keys(self._visited), get_keys(self._active)
+
+
+def _needs_database(rule_kwargs):
+    """
+    Whether the rule built with the keyword arguments queries the database
+    of AiiDA, and not only another GraphStore
+    """
+    from .stores import QueryBuilderStore
+    store = rule_kwargs.get('store')
+    return store is None or isinstance(store, QueryBuilderStore)
+
+
+def _reset_connection():
+    """
+    Drops the connection to the database inherited from the parent process,
+    if the process was forked, so that the next query opens its own.
+    """
+    from aiida.backends import settings
+    if settings.BACKEND == 'sqlalchemy':
+        from sqlalchemy.orm import scoped_session, sessionmaker
+        from aiida.backends import sqlalchemy as sa
+        sa.engine.dispose()
+        sa.scopedsessionclass = scoped_session(sessionmaker(bind=sa.engine,
+                expire_on_commit=True))
+    else:
+        from django.db import connection as django_connection
+        django_connection.close()
+
+
+def _work(connection, spec, index, nr_of_workers, rule_kwargs, profile, inboxes):
+    """
+    The main loop of a worker process. Every process has its own connection
+    to the database, if the rule queries it.
+    """
+    try:
+        from .stores import SQLiteStore
+        store = rule_kwargs.get('store')
+        if isinstance(store, SQLiteStore) and store.path != ':memory:':
+            # A forked worker must not use the connection of its parent either:
+            rule_kwargs = dict(rule_kwargs, store=SQLiteStore(store.path))
+        if _needs_database(rule_kwargs):
+            from aiida import load_dbenv, is_dbenv_loaded
+            if is_dbenv_loaded():
+                _reset_connection()
+            else:
+                load_dbenv(profile=profile)
+        worker = _TraversalWorker(spec, index, nr_of_workers, rule_kwargs, inboxes)
+    except Exception:
+        connection.send(('error', traceback.format_exc()))
+        return
+    connection.send(('ready', None))
+    while True:
+        command, args = connection.recv()
+        if command == 'close':
+            break
+        try:
+            connection.send(('done', getattr(worker, command)(*args)))
+        except Exception:
+            connection.send(('error', traceback.format_exc()))
+
+
+class PartitionedTraversal(object):
+    """
+    Runs an UpdateRule with a pool of local worker processes.
+    The frontier of every hop is partitioned by the keys (modulo the number
+    of workers), every worker owns a shard of the keys and their visited
+    state, and uses its own connection to the database to expand its part
+    of the frontier.
+    After every hop, the workers send the keys they found directly to the
+    workers that own them, as numpy arrays, one batch per pair of workers.
+    This coordinator only starts the hops and counts the active keys.
+    At the end, the coordinator merges the shards into the result Basket.
+
+    Only UpdateRules are supported. A RuleSequence (with stashes of walkers
+    that are shared by all rules) cannot be partitioned this way.
+    The results are the same as running the rule in a single process.
+    """
+    def __init__(self, rule, nr_of_workers=None, rule_kwargs=None, start_method='spawn'):
+        """
+        :param rule: An UpdateRule, or the RuleSpec of one
+        :param int nr_of_workers: The number of worker processes,
+            defaults to the number of cores
+        :param dict rule_kwargs: Additional keyword arguments to build the
+            rule in the workers, e.g. caches. With the 'spawn' start method,
+            they are pickled.
+        :param str start_method: How the worker processes are started, see
+            :mod:`multiprocessing`. Spawned workers load the database
+            environment of the profile that is loaded here. Forked workers
+            drop the connection inherited from this process.
+            On Python 2, workers are always forked.
+        """
+        if isinstance(rule, UpdateRule):
+            rule = RuleSpec.from_rule(rule)
+        if not isinstance(rule, RuleSpec) or rule.kind != 'update':
+            raise TypeError("rule has to be an UpdateRule or the RuleSpec of one")
+        self._spec = rule
+        self._mode = rule.to_dict()['mode']
+        # Memberships are stored as (node, group), but belong to the worker that
+        # owns the group if the hop starts from groups:
+        self._from_groups = rule.to_dict()['queryhelp']['path'][0]['type'] == 'group'
+        self._maxiter = rule.max_iterations
+        self._nr_of_workers = nr_of_workers or multiprocessing.cpu_count()
+        self._rule_kwargs = rule_kwargs or {}
+        self._start_method = start_method
+        self._workers = None
+        self._visits = None
+        self._iterations_done = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _start(self):
+        if hasattr(multiprocessing, 'get_context'):
+            context = multiprocessing.get_context(self._start_method)
+        else:
+            context = multiprocessing
+        profile = None
+        if _needs_database(self._rule_kwargs):
+            from aiida.backends import settings
+            profile = settings.AIIDADB_PROFILE
+        self._workers = []
+        inboxes = [context.Queue() for _ in range(self._nr_of_workers)]
+        for index in range(self._nr_of_workers):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target=_work, args=(worker_connection,
+                    self._spec, index, self._nr_of_workers, self._rule_kwargs, profile,
+                    inboxes))
+            process.daemon = True
+            process.start()
+            self._workers.append((process, connection))
+        for _, connection in self._workers:
+            self._receive(connection)
+
+    def _receive(self, connection):
+        status, result = connection.recv()
+        if status == 'error':
+            self.close()
+            raise RuntimeError("A worker failed:\n{}".format(result))
+        return result
+
+    def _call(self, command, args_per_worker):
+        for (_, connection), args in zip(self._workers, args_per_worker):
+            connection.send((command, args))
+        return [self._receive(connection) for _, connection in self._workers]
+
+    def close(self):
+        """
+        Stops the worker processes
+        """
+        if self._workers is None:
+            return
+        for process, connection in self._workers:
+            try:
+                connection.send(('close', ()))
+            except (IOError, OSError):
+                pass
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        self._workers = None
+
+    def get_iterations_done(self):
+        return self._iterations_done
+
+    def get_visits(self):
+        return self._visits
+
+    def run(self, walkers):
+        """
+        :param walkers: A Basket with the entities to start from
+        :returns: A Basket with the results, as UpdateRule.run would return them
+        """
+        if not isinstance(walkers, Basket):
+            raise TypeError("You need to set the walkers with a Basket")
+        if self._workers is None:
+            self._start()
+        incoming = [{} for _ in range(self._nr_of_workers)]
+        for set_key, set_ in walkers.dict.items():
+            for key in set_.get_keys():
+                # Edges belong to the worker that owns where they start from:
+                if isinstance(set_, AiidaEntitySet):
+                    source = key
+                elif set_key == 'nodes_groups' and self._from_groups:
+                    source = key[1]
+                else:
+                    source = key[0]
+                owner = get_owner(source, self._nr_of_workers)
+                incoming[owner].setdefault(set_key, []).append(key)
+        self._call('reset', [(this_incoming,) for this_incoming in incoming])
+        iterations = 0
+        while True:
+            expand = iterations < self._maxiter
+            replies = self._call('step', [(expand,)]*self._nr_of_workers)
+            if not expand or not sum(replies):
+                break
+            iterations += 1
+        self._iterations_done = iterations
+
+        visited = walkers.copy(with_data=False)
+        active = walkers.copy(with_data=False)
+        for visited_keys, active_keys in self._call('collect', [()]*self._nr_of_workers):
+            for basket, keys_by_set in ((visited, visited_keys), (active, active_keys)):
+                for set_key, keys in keys_by_set.items():
+                    basket[set_key]._set_key_set_nocheck(basket[set_key].get_keys().union(
+                            keys.tolist() if isinstance(keys, np.ndarray) else keys))
+        self._visits = visited
+        if self._mode == MODES.APPEND:
+            result = walkers.copy()
+            result += visited
+            return result
+        return active
@@ -0,0 +1,123 @@
+import json
+import time
+
+
+class HopProfiler(object):
+    """
+    Records what happens in every hop of the rules it is set on, with
+    :meth:`~age.rules.Operation.set_profiler`::
+
+        profiler = HopProfiler(explain=True)
+        rule.set_profiler(profiler)
+        rule.run(walkers)
+        profiler.dump('report.json')
+
+    Every run of a rule is reported with the runs of the rules it contains
+    (for a RuleSequence), the number of iterations, the time, and the hops.
+    For every hop, the report gives how it was done (a database query, or one
+    of the caches), the size of the frontier and of the bound parameters,
+    the number of rows, the time and, for queries, the SQL.
+    If explain is set, the plan of the database is added for every query.
+    """
+    def __init__(self, explain=False, analyze=False):
+        """
+        :param bool explain: Whether to capture the plan of every query
+        :param bool analyze: Whether the plan is captured by executing the query
+            again (EXPLAIN ANALYZE, only PostgreSQL), so that it reports the
+            actual times and row counts.
+        """
+        self._explain = explain or analyze
+        self._analyze = analyze
+        self.reset()
+
+    @property
+    def explain(self):
+        return self._explain
+
+    @property
+    def analyze(self):
+        return self._analyze
+
+    def reset(self):
+        """
+        Forget everything recorded so far
+        """
+        self._runs = []
+        # The runs that are not finished, the innermost last:
+        self._stack = []
+
+    def start_run(self, rule):
+        """
+        Called by a rule when a run starts
+        """
+        run = dict(rule=type(rule).__name__, iterations=0, seconds=None,
+                hops=[], runs=[], _start=time.time())
+        if self._stack:
+            self._stack[-1]['runs'].append(run)
+        else:
+            self._runs.append(run)
+        self._stack.append(run)
+
+    def end_run(self, iterations):
+        """
+        Called by a rule when a run is finished
+        """
+        run = self._stack.pop()
+        run['iterations'] = iterations
+        run['seconds'] = time.time() - run.pop('_start')
+
+    def record_hop(self, method, frontier_size, rows, seconds, sql=None,
+            parameter_size=None, plan=None):
+        """
+        Called by an UpdateRule after a hop.
+
+        :param str method: How the hop was done, e.g. 'query'
+        :param int frontier_size: The number of keys the hop started from
+        :param int rows: The number of rows (or targets) returned
+        :param float seconds: The time the hop took
+        :param str sql: The SQL that was executed
+        :param int parameter_size: The number of values bound to the statement
+        :param list plan: The lines of the plan of the database
+        """
+        hop = dict(method=method, frontier_size=frontier_size, rows=rows,
+                seconds=seconds, sql=sql, parameter_size=parameter_size, plan=plan)
+        if self._stack:
+            run = self._stack[-1]
+            hop['iteration'] = len(run['hops'])+1
+            run['hops'].append(hop)
+        else:
+            self._runs.append(dict(rule=None, iterations=None, seconds=None,
+                    hops=[hop], runs=[]))
+
+    def _iter_hops(self, runs):
+        for run in runs:
+            for hop in run['hops']:
+                yield hop
+            for hop in self._iter_hops(run['runs']):
+                yield hop
+
+    def get_report(self):
+        """
+        :returns: A json-compatible dictionary with the runs, and a summary
+            of the hops of every method.
+        """
+        summary = {}
+        for hop in self._iter_hops(self._runs):
+            totals = summary.setdefault(hop['method'], dict(hops=0, rows=0, seconds=0.))
+            totals['hops'] += 1
+            totals['rows'] += hop['rows']
+            totals['seconds'] += hop['seconds']
+        return dict(runs=self._runs, summary=summary)
+
+    def to_json(self, **kwargs):
+        """
+        :param kwargs: Keyword arguments for json.dumps, e.g. indent
+        """
+        return json.dumps(self.get_report(), **kwargs)
+
+    def dump(self, path, **kwargs):
+        """
+        Write the report to a JSON file.
+        """
+        with open(path, 'w') as file_:
+            file_.write(self.to_json(**kwargs))
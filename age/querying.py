@@ -0,0 +1,374 @@
+from copy import deepcopy
+
+from aiida.orm.querybuilder import QueryBuilder
+
+from sqlalchemy import bindparam, func, select
+
+
+def explain(session, statement, params=None, analyze=False):
+    """
+    Asks the database how it plans to execute a statement.
+
+    :param session: The session of the QueryBuilder
+    :param statement: An SQLAlchemy statement
+    :param dict params: Values for bound parameters of the statement
+    :param bool analyze: For PostgreSQL, whether to also execute the statement
+        and report the actual times and row counts (EXPLAIN ANALYZE).
+        SQLite only gives the plan (EXPLAIN QUERY PLAN).
+    :returns: A list with the lines of the plan
+    """
+    dialect = session.get_bind().dialect
+    if dialect.name == 'postgresql':
+        prefix = 'EXPLAIN ANALYZE ' if analyze else 'EXPLAIN '
+    elif dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        raise NotImplementedError("Cannot explain statements for {}".format(dialect.name))
+    compiled = statement.compile(dialect=dialect)
+    parameters = dict(compiled.params)
+    parameters.update(params or {})
+    if compiled.positional:
+        parameters = [parameters[key] for key in compiled.positiontup]
+    # The statement is sent as compiled, through the cursor of the driver:
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.execute(prefix + str(compiled), parameters)
+        return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def get_watermark(with_mtime=False):
+    """
+    A cheap fingerprint of the state of the graph in the database: the largest
+    primary keys of nodes, links, groups and memberships, which grow with
+    every new entry. They come from the primary key indices.
+    Deleted entries, or changed columns of existing nodes, are not detected.
+
+    :param bool with_mtime: Whether to add the last modification time of
+        the nodes, which detects changes of their columns and attributes.
+        This column has no index, the whole table is scanned.
+    :returns: A tuple of numbers, None for empty tables
+    """
+    impl = QueryBuilder()._impl
+    session = impl.get_session()
+    columns = [func.max(impl.Node.id), func.max(impl.Link.id), func.max(impl.Group.id),
+            func.max(impl.table_groups_nodes.c.id)]
+    statements = [select([column]) for column in columns]
+    if with_mtime:
+        statements.append(select([func.max(impl.Node.mtime)]))
+    try:
+        values = [session.execute(statement).scalar() for statement in statements]
+    except Exception as e:
+        # exception was raised. Rollback the session
+        session.rollback()
+        raise e
+    if with_mtime and values[-1] is not None:
+        import calendar
+        values[-1] = calendar.timegm(values[-1].utctimetuple()) + 1e-6*values[-1].microsecond
+    return tuple(values)
+
+
+class PreparedHopQuery(object):
+    """
+    A hop query that is built and compiled only once.
+    The path, the filters and the projections are fixed at instantiation.
+    The frontier (the keys of the entities the hop starts from) is passed as
+    a bound parameter every time the query is executed, so that the same
+    compiled statement can be used for every hop and every run of a rule.
+    """
+    FRONTIER_PARAM = 'frontier'
+    LIMIT_PARAM = 'row_limit'
+
+    def __init__(self, queryhelp, first_tag, identifier, projections):
+        """
+        :param dict queryhelp: The json-compatible queryhelp of the path.
+            It is not changed.
+        :param str first_tag: The tag of the vertex that the frontier binds to.
+        :param str identifier: The column of the first vertex that the
+            frontier is matched against, e.g. 'id'.
+        :param projections: A list of tuples (tag, key).
+            The rows returned by :meth:`execute` are tuples in that order.
+        """
+        queryhelp = deepcopy(queryhelp)
+        # Projections of the original query are ignored, I set mine:
+        queryhelp['project'] = {}
+        querybuilder = QueryBuilder(**queryhelp)
+        projections_by_tag = {}
+        for tag, key in projections:
+            keys = projections_by_tag.setdefault(tag, [])
+            if key not in keys:
+                keys.append(key)
+        for tag, keys in projections_by_tag.items():
+            querybuilder.add_projection(tag, keys)
+        # Only keys are projected, duplicate rows can be dropped by the database:
+        query = querybuilder.distinct().get_query()
+        # Where every projection ends up in the row returned by the database:
+        self._indices = tuple(
+                querybuilder.tag_to_projected_entity_dict[tag][key]
+                for tag, key in projections)
+        self._projections = tuple(projections)
+        self._session = querybuilder._impl.get_session()
+        column = getattr(querybuilder.get_alias(first_tag), identifier)
+        if self._session.get_bind().dialect.name == 'postgresql':
+            # The frontier is sent as an array, the statement
+            # can be compiled now and reused for every hop:
+            self._statement = query.filter(
+                    column == func.any(bindparam(self.FRONTIER_PARAM))).statement
+            self._compiled = self._statement.compile(dialect=self._session.get_bind().dialect)
+        else:
+            # Without arrays, the IN-clause has to be rendered for every frontier.
+            # Still, the path does not need to be rebuilt by the QueryBuilder.
+            self._statement = None
+            self._compiled = None
+        # The statements with a limit, by the projection they are ordered by,
+        # are compiled when they are first needed:
+        self._compiled_limited = {}
+        # The query without the frontier, and the column the frontier binds to:
+        self._query = query
+        self._column = column
+
+    @property
+    def projections(self):
+        return self._projections
+
+    def get_statement(self, frontier):
+        """
+        :returns: The statement that is executed for the frontier,
+            and the values of its bound parameters.
+        """
+        frontier = list(frontier)
+        if self._statement is not None:
+            return self._statement, {self.FRONTIER_PARAM: frontier}
+        return self._query.filter(self._column.in_(frontier)).statement, {}
+
+    def get_sql(self, frontier):
+        """
+        :returns: The SQL that is executed for the frontier, with placeholders
+            for the bound parameters.
+        """
+        if self._compiled is not None:
+            return str(self._compiled)
+        statement, _ = self.get_statement(frontier)
+        return str(statement.compile(dialect=self._session.get_bind().dialect))
+
+    def explain(self, frontier, analyze=False):
+        """
+        :returns: The plan of the database for the frontier, see :func:`explain`
+        """
+        statement, params = self.get_statement(frontier)
+        return explain(self._session, statement, params=params, analyze=analyze)
+
+    def execute(self, frontier, limit=None, order_by=0):
+        """
+        Execute the query for the given frontier.
+
+        :param frontier: An iterable of keys for the first vertex of the path
+        :param int limit: The maximum number of rows the database returns
+        :param int order_by: The index of the projection that the rows are
+            ordered by if they are limited, so that the rows with the smallest
+            values are returned, on every execution the same.
+        :returns: A list of tuples, one per distinct row, in the order given by
+            the projections.
+        """
+        frontier = list(frontier)
+        if not frontier:
+            return []
+        try:
+            if self._compiled is not None and limit is None:
+                results = self._session.connection().execute(
+                        self._compiled, {self.FRONTIER_PARAM: frontier})
+            elif self._compiled is not None:
+                if order_by not in self._compiled_limited:
+                    self._compiled_limited[order_by] = self._statement.order_by(
+                            self._get_column(order_by)).limit(
+                            bindparam(self.LIMIT_PARAM)).compile(
+                            dialect=self._session.get_bind().dialect)
+                results = self._session.connection().execute(self._compiled_limited[order_by],
+                        {self.FRONTIER_PARAM: frontier, self.LIMIT_PARAM: limit})
+            else:
+                results = self._query.filter(self._column.in_(frontier))
+                if limit is not None:
+                    results = results.order_by(self._get_column(order_by)).limit(limit)
+            indices = self._indices
+            return [tuple(row[index] for index in indices) for row in results]
+        except Exception as e:
+            # exception was raised. Rollback the session
+            self._session.rollback()
+            raise e
+
+    def _get_column(self, index):
+        """
+        :returns: The column of the projection at the index
+        """
+        return self._query.column_descriptions[self._indices[index]]['expr']
+
+
+class FusedHopQuery(object):
+    """
+    Several hop queries that are executed as a single statement.
+    The hops are done as if they were executed one after the other, each one
+    starting from its frontier and from the targets of the hops it is fed by.
+    Every hop is a common table expression, the rows of all hops are returned
+    together (UNION ALL), padded to the same width, with the index of the hop
+    in the last column.
+    """
+    def __init__(self, hop_queries, target_indices, feeds):
+        """
+        :param hop_queries: The PreparedHopQuery instances, in order
+        :param target_indices: For every hop, the position of the key
+            of the target in its projections
+        :param feeds: For every hop, the indices of the (earlier) hops whose
+            targets are added to its frontier
+        """
+        from sqlalchemy import Integer, String, cast, literal_column, null, or_, select, union_all
+        self._hop_queries = tuple(hop_queries)
+        self._session = self._hop_queries[0]._session
+        dialect = self._session.get_bind().dialect
+        self._use_arrays = dialect.name == 'postgresql'
+        width = max(len(hop_query.projections) for hop_query in self._hop_queries)
+
+        def get_statement(frontiers):
+            ctes = []
+            selects = []
+            for index, hop_query in enumerate(self._hop_queries):
+                column = hop_query._column
+                if self._use_arrays:
+                    condition = column == func.any(bindparam(self._get_param(index)))
+                else:
+                    condition = column.in_(frontiers[index])
+                conditions = [condition] + [
+                        column.in_(select([list(ctes[fed_by].c)[target_indices[fed_by]]]))
+                        for fed_by in feeds[index]]
+                subquery = hop_query._query.filter(or_(*conditions)).subquery(with_labels=True)
+                subquery_columns = list(subquery.c)
+                cte = select([subquery_columns[position] for position in hop_query._indices]
+                        ).cte('hop_{}'.format(index))
+                ctes.append(cte)
+                # Edges are (id, id, label, type), keys are ids:
+                padding = [cast(null(), Integer if position < 2 else String)
+                        for position in range(len(hop_query.projections), width)]
+                selects.append(select(list(cte.c) + padding + [
+                        literal_column(str(index), Integer)]))
+            return union_all(*selects)
+
+        self._get_statement = get_statement
+        if self._use_arrays:
+            self._statement = get_statement(None)
+            self._compiled = self._statement.compile(dialect=dialect)
+        else:
+            self._statement = None
+            self._compiled = None
+
+    def _get_param(self, index):
+        return '{}_{}'.format(PreparedHopQuery.FRONTIER_PARAM, index)
+
+    def get_statement(self, frontiers):
+        """
+        :returns: The statement executed for the frontiers, and the values of
+            its bound parameters.
+        """
+        frontiers = [list(frontier) for frontier in frontiers]
+        if self._statement is not None:
+            return self._statement, dict((self._get_param(index), frontier)
+                    for index, frontier in enumerate(frontiers))
+        return self._get_statement(frontiers), {}
+
+    def get_sql(self, frontiers):
+        if self._compiled is not None:
+            return str(self._compiled)
+        statement, _ = self.get_statement(frontiers)
+        return str(statement.compile(dialect=self._session.get_bind().dialect))
+
+    def explain(self, frontiers, analyze=False):
+        statement, params = self.get_statement(frontiers)
+        return explain(self._session, statement, params=params, analyze=analyze)
+
+    def execute(self, frontiers):
+        """
+        :param frontiers: For every hop, an iterable of keys
+        :returns: For every hop, a list of tuples in the order given by its projections
+        """
+        statement, params = self.get_statement(frontiers)
+        results = [[] for _ in self._hop_queries]
+        lengths = [len(hop_query.projections) for hop_query in self._hop_queries]
+        try:
+            if self._compiled is not None:
+                rows = self._session.connection().execute(self._compiled, params)
+            else:
+                rows = self._session.connection().execute(statement)
+            for row in rows:
+                index = row[-1]
+                results[index].append(tuple(row[:lengths[index]]))
+        except Exception as e:
+            # exception was raised. Rollback the session
+            self._session.rollback()
+            raise e
+        return results
+
+
+class MembershipQuery(object):
+    """
+    Queries the group memberships directly in the table that associates
+    groups and nodes, without joining the tables of the groups and of the nodes.
+    The keys are sent in chunks, and the rows are fetched in chunks from a
+    server-side cursor, so that expanding huge groups does not buffer
+    the whole result in the database driver.
+    """
+    def __init__(self, chunk_size=10000):
+        """
+        :param int chunk_size: The number of keys per statement, and the
+            number of rows fetched at once.
+        """
+        impl = QueryBuilder()._impl
+        self._session = impl.get_session()
+        self._table = impl.table_groups_nodes
+        self._chunk_size = chunk_size
+
+    def get_statement(self, keys, by_group=True):
+        """
+        :returns: The statement for one chunk of keys
+        """
+        table = self._table
+        column = table.c.dbgroup_id if by_group else table.c.dbnode_id
+        return select([table.c.dbnode_id, table.c.dbgroup_id]).where(column.in_(list(keys)))
+
+    def get_sql(self, keys, by_group=True):
+        """
+        :returns: The SQL executed for the first chunk of keys
+        """
+        statement = self.get_statement(list(keys)[:self._chunk_size], by_group=by_group)
+        return str(statement.compile(dialect=self._session.get_bind().dialect))
+
+    def explain(self, keys, by_group=True, analyze=False):
+        """
+        :returns: The plan of the database for the first chunk of keys,
+            see :func:`explain`
+        """
+        statement = self.get_statement(list(keys)[:self._chunk_size], by_group=by_group)
+        return explain(self._session, statement, analyze=analyze)
+
+    def execute(self, keys, by_group=True):
+        """
+        :param keys: An iterable of group ids, or of node ids
+        :param bool by_group: Whether the keys are group ids (to get the
+            members) or node ids (to get the groups)
+        :returns: A list of tuples (node id, group id)
+        """
+        keys = list(keys)
+        rows = []
+        try:
+            connection = self._session.connection().execution_options(stream_results=True)
+            for start in range(0, len(keys), self._chunk_size):
+                results = connection.execute(self.get_statement(
+                        keys[start:start+self._chunk_size], by_group=by_group))
+                while True:
+                    chunk = results.fetchmany(self._chunk_size)
+                    if not chunk:
+                        break
+                    rows.extend((node_id, group_id) for node_id, group_id in chunk)
+        except Exception as e:
+            # exception was raised. Rollback the session
+            self._session.rollback()
+            raise e
+        return rows
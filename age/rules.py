@@ -1,40 +1,143 @@
 
 from abc import ABCMeta, abstractmethod
+from copy import deepcopy
+import time
 
-from aiida.common.exceptions import InputValidationError
-from aiida.common.extendeddicts import Enumerate
-from aiida.orm import Node, Group
-from aiida.orm.querybuilder import QueryBuilder
+import six
 
-import numpy as np
+from .entities import AiidaEntitySet, Basket, DirectedEdgeSet, VersionedStash
 
-import six
+# Neither aiida nor numpy are imported here, the pieces that need them
+# are imported when they are first used.
+
+
+class Enumerate(frozenset):
+    """
+    Same as aiida.common.extendeddicts.Enumerate, importing aiida is slow.
+    """
+    def __getattr__(self, name):
+        if name in self:
+            return six.text_type(name)
+        raise AttributeError("No attribute '{}' in Enumerate '{}'".format(
+            name, self.__class__.__name__))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Cannot set attribute in Enumerate '{}'".format(
+            self.__class__.__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("Cannot delete attribute in Enumerate '{}'".format(
+            self.__class__.__name__))
 
-from entities import Basket
 
 MODES = Enumerate(('APPEND', 'REPLACE'))
 
+
+def get_membership_hop(queryhelp):
+    """
+    Checks whether the path in the queryhelp is a single hop between groups
+    and their member nodes, that can be answered from the table of memberships
+    alone, i.e. without filters on the groups, the nodes or the edge.
+
+    :returns: 'members' for hops from groups to their nodes, 'groups' for hops
+        from nodes to their groups, None otherwise.
+    """
+    path = queryhelp['path']
+    if len(path) != 2:
+        return None
+    first, second = path
+    if second.get('outerjoin') or second['joining_value'] != first['tag']:
+        return None
+    if first['type'] == 'group' and second['joining_keyword'] == 'member_of':
+        hop = 'members'
+        node_tag, group_tag = second['tag'], first['tag']
+    elif second['type'] == 'group' and second['joining_keyword'] == 'group_of':
+        hop = 'groups'
+        node_tag, group_tag = first['tag'], second['tag']
+    else:
+        return None
+    filters = queryhelp['filters']
+    # The QueryBuilder adds a filter on the type of nodes that matches every node:
+    if filters.get(node_tag) not in (None, {}, {'type': {'like': '%'}}):
+        return None
+    if filters.get(group_tag) or filters.get(second['edge_tag']):
+        return None
+    return hop
+
+
+def _count_entities(basket):
+    """
+    :returns: The number of entities (not edges) in the Basket
+    """
+    return sum(len(set_) for set_ in basket.dict.values() if isinstance(set_, AiidaEntitySet))
+
+
+def _truncate(active_walkers, visited, nr_of_entities):
+    """
+    :returns: A Basket with nr_of_entities of the active walkers (the smallest
+        keys of every set, in order of the sets), and the edges between entities
+        that are kept or were visited.
+    """
+    truncated = active_walkers.copy(with_data=False)
+    for set_key in sorted(active_walkers.dict):
+        set_ = active_walkers[set_key]
+        if isinstance(set_, AiidaEntitySet):
+            keys = sorted(set_.get_keys())[:nr_of_entities]
+            nr_of_entities -= len(keys)
+            truncated[set_key]._set_key_set_nocheck(set(keys))
+    set_keys = {'node': 'nodes', 'group': 'groups'}
+    for set_key, set_ in active_walkers.dict.items():
+        if isinstance(set_, DirectedEdgeSet):
+            keys_from = (visited[set_keys[set_._aiida_cls_from]].get_keys() |
+                    truncated[set_keys[set_._aiida_cls_from]].get_keys())
+            keys_to = (visited[set_keys[set_._aiida_cls_to]].get_keys() |
+                    truncated[set_keys[set_._aiida_cls_to]].get_keys())
+            truncated[set_key]._set_key_set_nocheck(set(edge for edge in set_.get_keys()
+                    if edge[0] in keys_from and edge[1] in keys_to))
+    return truncated
+
+
 @six.add_metaclass(ABCMeta)
 class Operation(object):
-    def __init__(self, mode, max_iterations, track_edges, track_visits):
+    def __init__(self, mode, max_iterations, track_edges, track_visits,
+            dense_visits=False):
         assert mode in MODES, 'You have to pass an option of {}'.format(MODES)
         self._mode = mode
         self.set_max_iterations(max_iterations)
         self._track_edges = track_edges
         self._track_visits = track_visits
+        self._dense_visits = dense_visits
         self._walkers = None
         self._visits = None
         self._iterations_done = None
+        self._profiler = None
+        # The maximum number of rows a hop should return, set during runs
+        # with a maximum number of results, and whether the rows were cut:
+        self._hop_limit = None
+        self._hop_truncated = False
+        self._max_results = None
+        # Whether every hop of a run has to be a single step, because the
+        # run counts the entities or checks them after every hop:
+        self._exact_hops = False
 
     def _init_run(self, entity_set):
         pass
 
+    def _expand_results(self, visited):
+        """
+        Called at the end of a run, with everything visited.
+
+        :returns: A Basket with entities that were visited but not loaded by
+            the hops, None if there are none
+        """
+        return None
+
     def _check(self, entity_set):
         if not isinstance(entity_set, Basket):
             raise TypeError("You need to set the walkers with an AiidaEntitySet")
 
     def set_max_iterations(self, max_iterations):
-        if max_iterations is np.inf:
+        if max_iterations == float('inf'):
             pass
         elif not isinstance(max_iterations, int):
             raise TypeError("max iterations has to be an integer")
@@ -47,6 +150,16 @@ class Operation(object):
     def get_iterations_done(self):
         return self._iterations_done
 
+    def set_profiler(self, profiler):
+        """
+        :param profiler: A HopProfiler that records the runs and hops,
+            or None to stop profiling.
+        """
+        self._profiler = profiler
+
+    def get_profiler(self):
+        return self._profiler
+
     def get_walkers(self):
         return self._walkers #.copy(with_data=True)
 
@@ -57,7 +170,28 @@ class Operation(object):
     def get_visits(self):
         return self._visits
 
-    def run(self, walkers=None, visits=None, iterations=None):
+    def run(self, walkers=None, visits=None, iterations=None, consumer=None,
+            max_results=None, stop=None):
+        """
+        :param walkers: A Basket with the entities to start from
+        :param visits: A Basket with the entities visited so far
+        :param consumer: A callable that is given the walkers, and after every
+            iteration the Basket with the entities and edges visited for the
+            first time, e.g. the write method of an ArchiveWriter.
+            In APPEND mode, these are exactly the results, so that they can be
+            processed while the traversal goes on.
+            The Baskets must not be changed by the consumer.
+        :param int max_results: The maximum number of entities visited,
+            including the walkers. The run stops when it is reached. The
+            entities closest to the walkers are kept, of the last hop only
+            as many as needed (the smallest keys). The queries of the hops
+            are limited accordingly (ordered by the key of the targets), unless
+            edges are tracked. Visits are then tracked in sets, also if
+            dense_visits is set.
+        :param stop: A callable that is given the Basket with the entities and
+            edges visited for the first time after every iteration. If it
+            returns True, the run stops after that iteration.
+        """
         if walkers is not None:
             self.set_walkers(walkers)
         else:
@@ -73,6 +207,7 @@ class Operation(object):
         if iterations is not None:
             self.set_iterations(iterations)
 
+        self._exact_hops = max_results is not None or stop is not None
         self._init_run(self._walkers)
         # The active walkers are all workers where this rule-instance have
         # not been applied, yet
@@ -84,16 +219,72 @@ class Operation(object):
         # with_data is set to True, since the active walkers are of course being visited
         # even before we start the iterations!
         visited_this_rule = self._walkers.copy(with_data=True) # w
+        # Rules in a sequence are limited as well:
+        self._max_results = max_results
+        limited = max_results is not None
+        if limited:
+            nr_of_results = _count_entities(visited_this_rule)
+        use_dense_visits = self._dense_visits and not limited
+        if use_dense_visits:
+            # The visited keys are mapped to dense indices and stored in bitsets:
+            from .indexing import DenseVisits
+            dense_visits = DenseVisits(visited_this_rule)
+        if self._profiler is not None:
+            self._profiler.start_run(self)
         iterations = 0
-        while (active_walkers and iterations < self._maxiter):
-            iterations += 1
-            # loading results into new_results set:
-            self._load_results(new_results, active_walkers)
-            # It depends on the mode, how I update the walkers
-            # I set the active walkers to all results that have not been visited yet.
-            active_walkers = new_results - visited_this_rule
-            # The visited is augmented:
-            visited_this_rule += active_walkers
+        # The run of the profiler is ended also if a hop or stop fails, so
+        # that later runs are not reported inside of it:
+        try:
+            if consumer is not None:
+                consumer(self._walkers)
+            stopped = limited and nr_of_results >= max_results
+            while (active_walkers and iterations < self._maxiter and not stopped):
+                iterations += 1
+                if limited:
+                    needed = max_results - nr_of_results
+                    self._hop_limit = needed
+                    while True:
+                        self._hop_truncated = False
+                        self._load_results(new_results, active_walkers)
+                        new_walkers = new_results - visited_this_rule
+                        # If the rows of the hop were cut, and too few of them are new,
+                        # the hop is repeated with a higher limit:
+                        if not self._hop_truncated or _count_entities(new_walkers) >= needed:
+                            break
+                        self._hop_limit *= 2
+                    self._hop_limit = None
+                    if _count_entities(new_walkers) >= needed:
+                        new_walkers = _truncate(new_walkers, visited_this_rule, needed)
+                        stopped = True
+                    active_walkers = new_walkers
+                    visited_this_rule += active_walkers
+                    nr_of_results += _count_entities(active_walkers)
+                else:
+                    # loading results into new_results set:
+                    self._load_results(new_results, active_walkers)
+                    # It depends on the mode, how I update the walkers
+                    # I set the active walkers to all results that have not been visited yet.
+                    # The visited is augmented:
+                    if use_dense_visits:
+                        active_walkers = dense_visits.update(new_results)
+                    else:
+                        active_walkers = new_results - visited_this_rule
+                        visited_this_rule += active_walkers
+                if consumer is not None:
+                    consumer(active_walkers)
+                if stop is not None and stop(active_walkers):
+                    stopped = True
+            if use_dense_visits:
+                visited_this_rule = dense_visits.load_visited()
+            expanded = self._expand_results(visited_this_rule)
+            if expanded is not None:
+                visited_this_rule += expanded
+                if consumer is not None:
+                    consumer(expanded)
+        finally:
+            self._hop_limit = None
+            if self._profiler is not None:
+                self._profiler.end_run(iterations)
 
         self._iterations_done = iterations
         if self._mode == MODES.APPEND:
@@ -132,7 +323,37 @@ class Operation(object):
 
 class UpdateRule(Operation):
     def __init__(self, querybuilder, mode=MODES.APPEND, max_iterations=1,
-            track_edges=False, track_visits=True):
+            track_edges=False, track_visits=True, adjacency_cache=None,
+            node_cache=None, dense_visits=False, membership_cache=None, store=None,
+            chain_index=None):
+        """
+        :param querybuilder: A QueryBuilder instance. The path defines the hop
+            from the first to the last vertex. Can also be the queryhelp
+            returned by its get_json_compatible_queryhelp method, in which case
+            the ORM is not imported to create the rule.
+        :param mode: One of MODES
+        :param max_iterations: The maximum number of hops, can be np.inf
+        :param bool track_edges: Whether to store the edges that are traversed
+        :param bool track_visits: Whether to store every entity visited
+        :param adjacency_cache: A LinkTypeAdjacencyCache. If given, and the path
+            is a single hop along links that the cache can evaluate, of the
+            link types that it caches, the hops are done in memory instead of
+            querying the database.
+        :param node_cache: A NodeAttributeCache. Used together with the
+            adjacency_cache, allows to do hops in memory also if the
+            vertices of the path are filtered.
+        :param bool dense_visits: Whether to map the keys visited during a run
+            to dense indices and track visits in bitsets, instead of sets.
+        :param membership_cache: A GroupMembershipCache. If given, and the path
+            goes from groups to all their nodes, the members of the groups are
+            taken from the cache.
+        :param store: The GraphStore the hops are done in, by default the
+            database of AiiDA, see :mod:`age.stores`
+        :param chain_index: A ChainIndex of the adjacency_cache. If the hop
+            follows exactly its link types, without filters, and the rule runs in
+            APPEND mode until nothing new is found without tracking edges, the
+            hops jump over the chains, whose internal nodes are added at the end.
+        """
         def get_spec_from_path(queryhelp, idx):
             if (queryhelp['path'][idx]['type'].startswith('node') or
                     queryhelp['path'][idx]['type'].startswith('data') or
@@ -145,42 +366,209 @@ class UpdateRule(Operation):
                         queryhelp['path'][0]['type']))
 
 
-        queryhelp = querybuilder.get_json_compatible_queryhelp()
-        for pathspec in queryhelp['path']:
-            if not pathspec['type']:
-                pathspec['type'] = 'node.Node.'
-        self._querybuilder = QueryBuilder(**queryhelp)
-        queryhelp = self._querybuilder.get_json_compatible_queryhelp()
+        if isinstance(querybuilder, dict):
+            # A queryhelp that is already json-compatible, I only make a copy:
+            queryhelp = deepcopy(querybuilder)
+            for pathspec in queryhelp['path']:
+                if not pathspec['type']:
+                    pathspec['type'] = 'node.Node.'
+        else:
+            from aiida.orm.querybuilder import QueryBuilder
+            queryhelp = querybuilder.get_json_compatible_queryhelp()
+            for pathspec in queryhelp['path']:
+                if not pathspec['type']:
+                    pathspec['type'] = 'node.Node.'
+            queryhelp = QueryBuilder(**queryhelp).get_json_compatible_queryhelp()
+        # The queryhelp is stored and never changed afterwards, the queries
+        # that are actually executed are prepared from it:
+        self._queryhelp = queryhelp
         self._first_tag = queryhelp['path'][0]['tag']
         self._last_tag = queryhelp['path'][-1]['tag']
 
+        if store is None:
+            from .stores import QueryBuilderStore
+            store = QueryBuilderStore()
+        self._store = store
+
         self._entity_from = get_spec_from_path(queryhelp, 0)
         self._entity_to = get_spec_from_path(queryhelp, -1)
+        # The prepared queries, by projections. They are reused between runs:
+        self._prepared_queries = {}
+        self._hop_query = None
+        self._adjacency_cache = adjacency_cache
+        self._node_cache = node_cache
+        if adjacency_cache is None:
+            self._local_hop = None
+        else:
+            from .caches import get_local_hop
+            self._local_hop = get_local_hop(queryhelp, node_cache=node_cache)
+            # A cache of some link types only cannot do hops along others:
+            if (self._local_hop is not None and
+                    not adjacency_cache.covers(self._local_hop['link_types'])):
+                self._local_hop = None
+        self._use_local_hop = False
+        self._chain_index = chain_index
+        self._use_chains = False
+        # The internal nodes of the chains jumped over in a run:
+        self._jumped = []
+        # Hops between groups and their nodes can be done on the table of memberships:
+        self._membership_hop = get_membership_hop(queryhelp)
+        self._membership_cache = membership_cache
+        self._membership_query = None
+        self._use_memberships = False
+        # Memberships are stored as (node, group), whatever the direction of the hop:
+        if set((self._entity_from, self._entity_to)) == set(('nodes', 'groups')):
+            self._edge_set_key = 'nodes_groups'
+        else:
+            self._edge_set_key = '{}_{}'.format(self._entity_from, self._entity_to)
         super(UpdateRule, self).__init__(mode, max_iterations, 
-                track_edges=track_edges, track_visits=track_visits)
+                track_edges=track_edges, track_visits=track_visits,
+                dense_visits=dense_visits)
 
     def _init_run(self, entity_set):
-        # Removing all other projections in the QueryBuilder instance:
-        for tag in self._querybuilder._projections.keys():
-            self._querybuilder._projections[tag] = []
-        # priming querybuilder to add projection on the key I need:
-        self._querybuilder.add_projection(self._last_tag,
-                entity_set[self._entity_to].identifier)
+        self._entity_from_identifier = entity_set[self._entity_from].identifier
         self._entity_to_identifier = entity_set[self._entity_to].identifier
         if self._track_edges:
-            self._querybuilder.add_projection(self._first_tag,
-                entity_set[self._entity_to].identifier)
-            edge_set = entity_set._dict['{}_{}'.format(self._entity_from, self._entity_to)]
+            edge_set = entity_set._dict[self._edge_set_key]
             self._edge_label = '{}--{}'.format(self._first_tag, self._last_tag)
-            self._edge_keys = tuple([
-                (self._first_tag, entity_set[self._entity_from].identifier),
-                (self._last_tag, entity_set[self._entity_to].identifier)] + [
+            vertex_keys = [(self._first_tag, self._entity_from_identifier),
+                    (self._last_tag, self._entity_to_identifier)]
+            # The edge tuples are the rows, the key of the target is the second
+            # entry, unless the hop goes from a group to its nodes:
+            self._target_index = 1
+            if self._entity_from == 'groups' and self._edge_set_key == 'nodes_groups':
+                vertex_keys.reverse()
+                self._target_index = 0
+            self._edge_keys = tuple(vertex_keys + [
                 (self._edge_label, identifier) for identifier in edge_set._additional_identifiers])
-            try:
-                self._querybuilder.add_projection(self._edge_label, edge_set._additional_identifiers)
-            except InputValidationError as e:
-                raise KeyError("The key for the edge is invalid.\n"
-                        "Are the entities really connected, or have you overwritten the edge-tag?")
+            projections = self._edge_keys
+        else:
+            projections = ((self._last_tag, self._entity_to_identifier),)
+            self._target_index = 0
+        # The cached links are indexed by the node ids and store label and type:
+        self._use_local_hop = (self._local_hop is not None and
+                self._entity_from_identifier == 'id' and
+                self._entity_to_identifier == 'id' and (not self._track_edges or
+                edge_set._additional_identifiers == ('label', 'type')))
+        local_hop = self._local_hop
+        self._use_chains = (self._use_local_hop and self._chain_index is not None and
+                not self._exact_hops and not self._track_edges and
+                self._mode == MODES.APPEND and self._maxiter == float('inf') and
+                local_hop['labels'] is None and local_hop['source_filters'] is None and
+                local_hop['target_filters'] is None and
+                local_hop['link_types'] == self._chain_index.link_types)
+        self._jumped = []
+        if self._use_local_hop:
+            return
+        self._use_memberships = (self._membership_hop is not None and
+                self._entity_from_identifier == 'id' and
+                self._entity_to_identifier == 'id')
+        if self._use_memberships:
+            if self._membership_query is None and (self._membership_cache is None or
+                    self._membership_hop == 'groups'):
+                self._membership_query = self._store.get_membership_query()
+            return
+        try:
+            self._hop_query = self._prepared_queries[projections]
+        except KeyError:
+            self._hop_query = self._store.get_hop_query(self._queryhelp, self._first_tag,
+                    self._entity_from_identifier, projections)
+            self._prepared_queries[projections] = self._hop_query
+
+    def _get_local_results(self, primkeys):
+        """
+        Does the hop on the cached links, only the partitions of the
+        link types I follow are touched.
+        Filters on the vertices are evaluated with the node cache.
+
+        :returns: the keys of the targets, and the edges if they are tracked
+        """
+        local_hop = self._local_hop
+        if self._use_chains:
+            targets, jumped = self._chain_index.hop(primkeys, reverse=local_hop['reverse'])
+            self._jumped.extend(jumped)
+            return targets, None
+        if local_hop['source_filters'] is not None:
+            primkeys = self._node_cache.filter_keys(primkeys, local_hop['source_filters'])
+        kwargs = dict(link_types=local_hop['link_types'], labels=local_hop['labels'],
+                reverse=local_hop['reverse'])
+        if self._track_edges:
+            rows = self._adjacency_cache.get_edges(primkeys, **kwargs)
+            targets = set(row[1] for row in rows)
+        else:
+            rows = None
+            targets = self._adjacency_cache.get_neighbors(primkeys, **kwargs)
+        if local_hop['target_filters'] is not None and targets:
+            targets = self._node_cache.filter_keys(targets, local_hop['target_filters'])
+            if rows is not None:
+                rows = [row for row in rows if row[1] in targets]
+        return targets, rows
+
+    def _get_membership_results(self, primkeys):
+        """
+        Does the hop on the table of memberships, or with the membership cache
+        for the members of groups.
+
+        :returns: the keys of the targets, and the memberships as tuples
+            (node id, group id) if edges are tracked
+        """
+        if self._membership_hop == 'members':
+            if self._membership_cache is not None:
+                members = self._membership_cache.get_members(primkeys)
+                targets = set()
+                for node_ids in members.values():
+                    targets.update(node_ids.tolist())
+                rows = None
+                if self._track_edges:
+                    rows = [(node_id, group_id) for group_id, node_ids in members.items()
+                            for node_id in node_ids.tolist()]
+                return targets, rows
+            rows = self._membership_query.execute(primkeys, by_group=True)
+            return set(row[0] for row in rows), rows
+        rows = self._membership_query.execute(primkeys, by_group=False)
+        return set(row[1] for row in rows), rows
+
+    def _expand_results(self, visited):
+        if not self._jumped:
+            return None
+        keys = set()
+        for chain, start, stop in self._jumped:
+            keys.update(chain[start:stop])
+        self._jumped = []
+        expanded = visited.copy(with_data=False)
+        expanded[self._entity_to]._set_key_set_nocheck(
+                keys.difference(visited[self._entity_to].get_keys()))
+        return expanded
+
+    def _record_hop(self, primkeys, targets, rows, seconds):
+        """
+        Reports a hop to the profiler. The plan is queried after the hop,
+        so that it does not count in the time of the hop.
+        """
+        query, sql, parameter_size, plan = None, None, None, None
+        if self._use_chains:
+            method = 'chain_index'
+        elif self._use_local_hop:
+            method = 'adjacency_cache'
+        elif self._use_memberships:
+            if self._membership_hop == 'members' and self._membership_cache is not None:
+                method = 'membership_cache'
+            else:
+                method = 'membership_query'
+                query = self._membership_query
+                kwargs = dict(by_group=(self._membership_hop == 'members'))
+        else:
+            method = 'query'
+            query = self._hop_query
+            kwargs = {}
+        if query is not None:
+            sql = query.get_sql(primkeys, **kwargs)
+            parameter_size = len(primkeys)
+            if self._profiler.explain:
+                plan = query.explain(primkeys, analyze=self._profiler.analyze, **kwargs)
+        self._profiler.record_hop(method, frontier_size=len(primkeys),
+                rows=len(rows) if rows is not None else len(targets), seconds=seconds,
+                sql=sql, parameter_size=parameter_size, plan=plan)
 
     def _load_results(self, target_set, operational_set):
         """
@@ -192,17 +580,29 @@ class UpdateRule(Operation):
         # Empty the target set, so that only these results are inside
         target_set.empty()
         if primkeys:
-            self._querybuilder.add_filter(self._first_tag, {
-                        operational_set[self._entity_from].identifier:{'in':primkeys}})
-            qres = self._querybuilder.dict()
-            # These are the new results returned by the query
-            target_set[self._entity_to].add_entities(
-                        [item[self._last_tag][self._entity_to_identifier] 
-                        for item in qres])
+            if self._profiler is not None:
+                start = time.time()
+            if self._use_local_hop:
+                targets, rows = self._get_local_results(primkeys)
+            elif self._use_memberships:
+                targets, rows = self._get_membership_results(primkeys)
+            else:
+                # The prepared query returns distinct rows, so targets reached via
+                # several paths, or from many walkers, are transferred only once:
+                # With edges, the rows to targets visited before are needed as
+                # well, whatever their key, the hop cannot be limited:
+                limit = None if self._track_edges else self._hop_limit
+                rows = self._hop_query.execute(primkeys, limit=limit,
+                        order_by=self._target_index)
+                self._hop_truncated = limit is not None and len(rows) >= limit
+                targets = [row[self._target_index] for row in rows]
+            if self._profiler is not None:
+                self._record_hop(primkeys, targets, rows, time.time()-start)
+            # These are the new results returned by the query. They come from
+            # the database or the caches, they are valid keys and need no checks:
+            target_set[self._entity_to]._set_key_set_nocheck(set(targets))
             if self._track_edges:
-                target_set['{}_{}'.format(self._entity_to, self._entity_to)].add_entities(
-                    [tuple(item[key1][key2] for (key1, key2) in self._edge_keys) 
-                    for item in qres])
+                target_set[self._edge_set_key]._set_key_set_nocheck(set(rows))
         # Everything is changed in place, no need to return anything
 
 
@@ -210,35 +610,53 @@ class UpdateRule(Operation):
 
 
 class RuleSaveWalkers(Operation):
+    """
+    Adds the walkers to a stash, a Basket or a VersionedStash
+    """
     def __init__(self, stash):
         self._stash = stash
         super(RuleSaveWalkers, self).__init__(mode=MODES.REPLACE, 
                 max_iterations=1, track_edges=True, track_visits=True)
 
     def _load_results(self, target_set, operational_set):
-        self._stash += self._walkers
+        if isinstance(self._stash, VersionedStash):
+            self._stash.save(self._walkers)
+        else:
+            self._stash += self._walkers
 
 class RuleSetWalkers(Operation):
+    """
+    Replaces the walkers with the content of a stash, a Basket or a VersionedStash
+    """
     def __init__(self, stash):
         self._stash = stash
         super(RuleSetWalkers, self).__init__(mode=MODES.REPLACE, 
                 max_iterations=1, track_edges=True, track_visits=True)
 
     def _load_results(self, target_set, operational_set):
-        self._walkers.empty()
-        self._walkers += self._stash
+        if isinstance(self._stash, VersionedStash):
+            self._stash.restore(self._walkers)
+        else:
+            self._walkers.empty()
+            self._walkers += self._stash
 
 class RuleSequence(Operation):
     def __init__(self, rules, mode=MODES.APPEND, max_iterations=1,
-            track_edges=False, track_visits=True):
+            track_edges=False, track_visits=True, dense_visits=False):
         for rule in rules:
             if not isinstance(rule, Operation):
                 print(rule)
                 raise TypeError("rule has to be an instance of Operation-subclass")
         self._rules = rules
         super(RuleSequence, self).__init__(mode, max_iterations, 
-                track_edges=track_edges, track_visits=track_visits)
+                track_edges=track_edges, track_visits=track_visits,
+                dense_visits=dense_visits)
+
 
+    def set_profiler(self, profiler):
+        super(RuleSequence, self).set_profiler(profiler)
+        for rule in self._rules:
+            rule.set_profiler(profiler)
 
     def _load_results(self, target_set, active_walkers):
         target_set.empty()
@@ -247,7 +665,7 @@ class RuleSequence(Operation):
             #rule.set_walkers(active_walkers)
             rule.set_visits(self._visits)
             rule.set_walkers(self._walkers)
-            target_set += rule.run()
+            target_set += rule.run(max_results=self._max_results)
 
 
 
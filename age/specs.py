@@ -0,0 +1,195 @@
+import hashlib
+import json
+from copy import deepcopy
+
+from .entities import VersionedStash
+from .rules import (Operation, UpdateRule, RuleSequence, RuleSaveWalkers,
+        RuleSetWalkers, MODES)
+
+KINDS = ('update', 'sequence', 'save_walkers', 'set_walkers')
+
+
+class RuleSpec(object):
+    """
+    A declarative specification of a rule, that holds no QueryBuilder and no
+    state (walkers, visits, stashes).
+    It is built from the json-compatible queryhelp and the options of a rule,
+    can be serialized to JSON (or pickled) and shipped to other processes,
+    and is hashable, so it can be used as a key for caches.
+    :meth:`build` returns an executable rule. The queryhelp is stored as
+    normalized by the rule, so that building does not repeat the
+    normalization with the QueryBuilder.
+
+    Stashes are referred to by a name. Rules in a sequence that share a stash
+    get the same name, and :meth:`build` creates one VersionedStash per name.
+    """
+    def __init__(self, kind, queryhelp=None, rules=None, stash=None,
+            mode=MODES.APPEND, max_iterations=1, track_edges=False, track_visits=True):
+        """
+        :param str kind: One of KINDS
+        :param dict queryhelp: For kind 'update', the json-compatible queryhelp
+        :param rules: For kind 'sequence', the RuleSpec instances of the rules
+        :param str stash: For kinds 'save_walkers' and 'set_walkers', the name
+            of the stash
+        :param mode: One of MODES
+        :param max_iterations: The maximum number of iterations, can be np.inf
+        :param bool track_edges: Whether to track edges
+        :param bool track_visits: Whether to track visits
+        """
+        if kind not in KINDS:
+            raise ValueError("kind has to be among {}".format(KINDS))
+        spec = dict(kind=kind)
+        if kind == 'update':
+            if not isinstance(queryhelp, dict):
+                raise TypeError("An update rule needs a queryhelp")
+            spec['queryhelp'] = deepcopy(queryhelp)
+        elif kind == 'sequence':
+            for rule in rules:
+                if not isinstance(rule, RuleSpec):
+                    raise TypeError("rules have to be instances of RuleSpec")
+            spec['rules'] = [rule.to_dict() for rule in rules]
+        else:
+            if stash is None:
+                raise ValueError("{} needs the name of a stash".format(kind))
+            spec['stash'] = str(stash)
+        if kind in ('update', 'sequence'):
+            if mode not in MODES:
+                raise ValueError('You have to pass an option of {}'.format(MODES))
+            spec['mode'] = str(mode)
+            # Infinity is not valid JSON:
+            spec['max_iterations'] = (None if max_iterations == float('inf')
+                    else max_iterations)
+            spec['track_edges'] = bool(track_edges)
+            spec['track_visits'] = bool(track_visits)
+        self._spec = spec
+        self._digest = None
+
+    @property
+    def kind(self):
+        return self._spec['kind']
+
+    @property
+    def max_iterations(self):
+        max_iterations = self._spec.get('max_iterations', 1)
+        return float('inf') if max_iterations is None else max_iterations
+
+    @property
+    def rules(self):
+        return [RuleSpec.from_dict(rule) for rule in self._spec.get('rules', [])]
+
+    def to_dict(self):
+        """
+        :returns: A json-compatible dictionary with the specification
+        """
+        return deepcopy(self._spec)
+
+    @classmethod
+    def from_dict(cls, spec):
+        """
+        The inverse of :meth:`to_dict`
+        """
+        spec = dict(spec)
+        rules = spec.pop('rules', None)
+        if rules is not None:
+            rules = [cls.from_dict(rule) for rule in rules]
+        max_iterations = spec.pop('max_iterations', 1)
+        if max_iterations is None:
+            max_iterations = float('inf')
+        return cls(rules=rules, max_iterations=max_iterations, **spec)
+
+    def to_json(self):
+        """
+        :returns: The specification as a JSON string.
+            Raises a TypeError if filters contain values that JSON cannot
+            represent, e.g. datetimes. Pickle the RuleSpec in this case.
+        """
+        return json.dumps(self._spec, sort_keys=True)
+
+    @classmethod
+    def from_json(cls, string):
+        return cls.from_dict(json.loads(string))
+
+    @classmethod
+    def from_rule(cls, rule, _stash_names=None):
+        """
+        Create the specification of a rule.
+
+        :param rule: An UpdateRule, RuleSequence, RuleSaveWalkers or RuleSetWalkers
+        """
+        if not isinstance(rule, Operation):
+            raise TypeError("rule has to be an instance of Operation-subclass")
+        # The stashes are named by order of appearance:
+        if _stash_names is None:
+            _stash_names = {}
+        options = dict(mode=rule._mode, max_iterations=rule._maxiter,
+                track_edges=rule._track_edges, track_visits=rule._track_visits)
+        if isinstance(rule, UpdateRule):
+            return cls('update', queryhelp=rule._queryhelp, **options)
+        elif isinstance(rule, RuleSequence):
+            return cls('sequence', rules=[cls.from_rule(child, _stash_names)
+                    for child in rule._rules], **options)
+        elif isinstance(rule, (RuleSaveWalkers, RuleSetWalkers)):
+            stash = _stash_names.setdefault(id(rule._stash),
+                    'stash-{}'.format(len(_stash_names)))
+            kind = 'save_walkers' if isinstance(rule, RuleSaveWalkers) else 'set_walkers'
+            return cls(kind, stash=stash)
+        else:
+            raise TypeError("Cannot create a specification for {}".format(type(rule)))
+
+    def build(self, stashes=None, **kwargs):
+        """
+        Create the executable rule.
+
+        :param dict stashes: The stashes to use (Baskets or VersionedStash
+            instances), by name. Missing stashes are created as VersionedStash
+            instances and added to the dictionary.
+        :param kwargs: Additional keyword arguments for every UpdateRule, e.g.
+            the caches to use.
+        :returns: An instance of an Operation-subclass
+        """
+        if stashes is None:
+            stashes = {}
+        spec = self._spec
+        kind = spec['kind']
+        if kind == 'update':
+            return UpdateRule(spec['queryhelp'], mode=spec['mode'],
+                    max_iterations=self.max_iterations, track_edges=spec['track_edges'],
+                    track_visits=spec['track_visits'], **kwargs)
+        elif kind == 'sequence':
+            return RuleSequence([rule.build(stashes=stashes, **kwargs) for rule in self.rules],
+                    mode=spec['mode'], max_iterations=self.max_iterations,
+                    track_edges=spec['track_edges'], track_visits=spec['track_visits'])
+        stash = stashes.setdefault(spec['stash'], VersionedStash())
+        if kind == 'save_walkers':
+            return RuleSaveWalkers(stash)
+        return RuleSetWalkers(stash)
+
+    def get_digest(self):
+        """
+        :returns: A canonical hash (hexdigest) of the specification
+        """
+        if self._digest is None:
+            # Values that are not json-compatible (e.g. datetimes in filters)
+            # are hashed by their representation:
+            canonical = json.dumps(self._spec, sort_keys=True, default=repr)
+            self._digest = hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+        return self._digest
+
+    def __hash__(self):
+        return hash(self.get_digest())
+
+    def __eq__(self, other):
+        return isinstance(other, RuleSpec) and self.get_digest() == other.get_digest()
+
+    def __ne__(self, other):
+        return not(self==other)
+
+    def __getstate__(self):
+        return self._spec
+
+    def __setstate__(self, state):
+        self._spec = state
+        self._digest = None
+
+    def __repr__(self):
+        return 'RuleSpec({})'.format(self.to_json())
@@ -0,0 +1,553 @@
+import os
+import sqlite3
+import threading
+from abc import ABCMeta, abstractmethod
+
+import six
+
+# Neither aiida nor sqlalchemy are imported here, a SQLiteStore
+# can be used without an AiiDA profile.
+
+
+@six.add_metaclass(ABCMeta)
+class GraphStore(object):
+    """
+    Where the rules find the graph of nodes, links and groups.
+    A store prepares the queries for the hops of an UpdateRule, fetches
+    entities by their keys, and projects links (e.g. to fill a
+    :class:`~age.caches.LinkTypeAdjacencyCache`).
+    """
+    @abstractmethod
+    def get_hop_query(self, queryhelp, first_tag, identifier, projections):
+        """
+        :param dict queryhelp: The json-compatible queryhelp of the path
+        :param str first_tag: The tag of the vertex that the frontier binds to
+        :param str identifier: The column the frontier is matched against
+        :param projections: A list of tuples (tag, key)
+        :returns: A query with the interface of
+            :class:`~age.querying.PreparedHopQuery`: execute, get_sql,
+            explain and projections.
+        """
+        pass
+
+    @abstractmethod
+    def get_membership_query(self, chunk_size=10000):
+        """
+        :returns: A query with the interface of
+            :class:`~age.querying.MembershipQuery`
+        """
+        pass
+
+    @abstractmethod
+    def get_entities(self, entity_type, identifier, keys, ordered=False):
+        """
+        :param str entity_type: 'node' or 'group'
+        :param str identifier: The column of the keys, e.g. 'id'
+        :param keys: An iterable of keys
+        :param bool ordered: Whether the entities are returned in the order of their keys
+        :returns: An iterable of entities
+        """
+        pass
+
+    @abstractmethod
+    def get_links(self, after_id=0, link_types=None):
+        """
+        :param int after_id: Only links with a larger id are returned
+        :param link_types: An iterable of link types, None for all
+        :returns: An iterable of tuples (input id, output id, link id, label, type)
+        """
+        pass
+
+    @abstractmethod
+    def get_nodes(self, after_id=None, modified_since=None, attributes=()):
+        """
+        :param int after_id: Only nodes with a larger id are returned,
+            or, if modified_since is given, nodes modified since. None for all.
+        :param modified_since: A modification time as returned in earlier rows
+        :param attributes: The names of attributes of the nodes to return
+        :returns: An iterable of tuples (id, mtime, type, ctime, values of the
+            attributes), ordered by id
+        """
+        pass
+
+    @abstractmethod
+    def get_identity(self):
+        """
+        :returns: A string that is the same for stores of the same graph,
+            and different for stores of other graphs
+        """
+        pass
+
+    @abstractmethod
+    def get_watermark(self, with_mtime=False):
+        """
+        :param bool with_mtime: Whether changes of the columns of existing
+            nodes have to change the watermark
+        :returns: A json-compatible fingerprint of the state of the graph,
+            that changes when entries are added
+        """
+        pass
+
+
+class QueryBuilderStore(GraphStore):
+    """
+    The database of the loaded AiiDA profile, queried with the QueryBuilder
+    """
+    def get_hop_query(self, queryhelp, first_tag, identifier, projections):
+        from aiida.common.exceptions import InputValidationError
+        from .querying import PreparedHopQuery
+        try:
+            return PreparedHopQuery(queryhelp, first_tag, identifier, projections)
+        except InputValidationError as e:
+            raise KeyError("The key for the edge is invalid.\n"
+                    "Are the entities really connected, or have you overwritten the edge-tag?")
+
+    def get_membership_query(self, chunk_size=10000):
+        from .querying import MembershipQuery
+        return MembershipQuery(chunk_size=chunk_size)
+
+    def get_entities(self, entity_type, identifier, keys, ordered=False):
+        from aiida.orm.querybuilder import QueryBuilder
+        from .entities import get_aiida_cls
+        qb = QueryBuilder().append(get_aiida_cls(entity_type), project='*', tag='entity',
+                filters={identifier:{'in':list(keys)}})
+        if ordered:
+            qb.order_by({'entity':[identifier]})
+        for entity, in qb.iterall():
+            yield entity
+
+    def get_links(self, after_id=0, link_types=None):
+        from aiida.orm import Node
+        from aiida.orm.querybuilder import QueryBuilder
+        qb = QueryBuilder()
+        qb.append(Node, tag='input', project='id')
+        edge_filters = {'id': {'>': after_id}}
+        if link_types is not None:
+            edge_filters['type'] = {'in': list(link_types)}
+        qb.append(Node, output_of='input', project='id',
+                edge_filters=edge_filters, edge_project=['id', 'label', 'type'])
+        return qb.iterall()
+
+    def get_nodes(self, after_id=None, modified_since=None, attributes=()):
+        from aiida.orm import Node
+        from aiida.orm.querybuilder import QueryBuilder
+        filters = []
+        if after_id is not None:
+            filters.append({'id':{'>':after_id}})
+        if modified_since is not None:
+            filters.append({'mtime':{'>=':modified_since}})
+        qb = QueryBuilder().append(Node, tag='node', filters={'or':filters} if filters else {},
+                project=['id', 'mtime', 'type', 'ctime'] + [
+                'attributes.{}'.format(attribute) for attribute in attributes])
+        qb.order_by({'node':['id']})
+        return qb.all()
+
+    def get_identity(self):
+        from aiida.backends import settings
+        return 'aiida:{}'.format(settings.AIIDADB_PROFILE)
+
+    def get_watermark(self, with_mtime=False):
+        from .querying import get_watermark
+        return list(get_watermark(with_mtime=with_mtime))
+
+
+NODE_COLUMNS = ('id', 'uuid', 'type', 'label', 'ctime', 'mtime')
+LINK_COLUMNS = ('id', 'input_id', 'output_id', 'label', 'type')
+GROUP_COLUMNS = ('id', 'uuid', 'name', 'type')
+MEMBERSHIP_COLUMNS = ('node_id', 'group_id')
+
+# The indices on the links cover the hops in both directions, filtered by
+# type and label, without reading the table:
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS db_nodes (id INTEGER PRIMARY KEY, uuid TEXT, type TEXT,
+        label TEXT, ctime REAL, mtime REAL);
+CREATE TABLE IF NOT EXISTS db_links (id INTEGER PRIMARY KEY, input_id INTEGER NOT NULL,
+        output_id INTEGER NOT NULL, label TEXT, type TEXT);
+CREATE INDEX IF NOT EXISTS db_links_input ON db_links (input_id, type, label, output_id);
+CREATE INDEX IF NOT EXISTS db_links_output ON db_links (output_id, type, label, input_id);
+CREATE TABLE IF NOT EXISTS db_groups (id INTEGER PRIMARY KEY, uuid TEXT, name TEXT, type TEXT);
+CREATE TABLE IF NOT EXISTS db_memberships (node_id INTEGER NOT NULL, group_id INTEGER NOT NULL,
+        PRIMARY KEY (group_id, node_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS db_memberships_node ON db_memberships (node_id, group_id);
+CREATE TABLE IF NOT EXISTS db_version (id INTEGER PRIMARY KEY CHECK (id = 0),
+        version INTEGER NOT NULL);
+INSERT OR IGNORE INTO db_version VALUES (0, 0);
+"""
+
+_SQL_COMPARISONS = {'==':'=', '<':'<', '<=':'<=', '>':'>', '>=':'>='}
+
+
+def _get_condition(alias, filters, params):
+    """
+    Translates the filters of a vertex of a queryhelp into SQL on the
+    table of nodes. The values are appended to params.
+
+    :raises NotImplementedError: for filters that cannot be translated
+    """
+    from .caches import _split_operator, _to_timestamp
+    conditions = []
+    for column, filter_spec in filters.items():
+        if column in ('and', 'or'):
+            conditions.append('({})'.format(' {} '.format(column.upper()).join(
+                    _get_condition(alias, sub_filters, params) for sub_filters in filter_spec)))
+            continue
+        if column not in NODE_COLUMNS:
+            raise NotImplementedError("Cannot filter on column {}".format(column))
+        if not isinstance(filter_spec, dict):
+            filter_spec = {'==':filter_spec}
+        for operator, value in filter_spec.items():
+            operator, negated = _split_operator(operator)
+            name = '{}.{}'.format(alias, column)
+            if column in ('ctime', 'mtime'):
+                value = ([_to_timestamp(val) for val in value] if operator == 'in'
+                        else _to_timestamp(value))
+            if operator in _SQL_COMPARISONS:
+                condition = '{} {} ?'.format(name, _SQL_COMPARISONS[operator])
+                params.append(value)
+            elif operator == 'in':
+                value = list(value)
+                condition = '{} IN ({})'.format(name, ', '.join('?'*len(value)))
+                params.extend(value)
+            elif operator == 'like':
+                # LIKE is case sensitive on my connection, see SQLiteStore
+                condition = "{} LIKE ? ESCAPE '\\'".format(name)
+                params.append(value)
+            elif operator == 'ilike':
+                condition = "lower({}) LIKE lower(?) ESCAPE '\\'".format(name)
+                params.append(value)
+            else:
+                raise NotImplementedError("Operator {} is not supported".format(operator))
+            conditions.append('NOT ({})'.format(condition) if negated else condition)
+    return ' AND '.join(conditions) or '1'
+
+
+class _SQLiteQuery(object):
+    """
+    A statement of a SQLiteStore that starts from the keys in the temporary
+    table of the frontier.
+    """
+    def __init__(self, store, sql, params=(), projections=()):
+        self._store = store
+        self._sql = sql
+        self._params = tuple(params)
+        self._projections = tuple(projections)
+
+    @property
+    def projections(self):
+        return self._projections
+
+    def get_sql(self, frontier=None):
+        return self._sql
+
+    def explain(self, frontier, analyze=False):
+        """
+        :returns: The plan of SQLite (EXPLAIN QUERY PLAN), actual times
+            cannot be given
+        """
+        return [' '.join(str(column) for column in row) for row in
+                self._store._execute_from(frontier, 'EXPLAIN QUERY PLAN ' + self._sql, self._params)]
+
+    def execute(self, frontier, limit=None, order_by=0):
+        """
+        :returns: A list of tuples, one per distinct row. Limited rows are
+            ordered by the projection at the index order_by.
+        """
+        if limit is None:
+            return self._store._execute_from(frontier, self._sql, self._params)
+        return self._store._execute_from(frontier,
+                '{} ORDER BY {} LIMIT ?'.format(self._sql, order_by+1), self._params + (limit,))
+
+
+class _SQLiteMembershipQuery(object):
+    """
+    Same interface as :class:`~age.querying.MembershipQuery`
+    """
+    def __init__(self, store):
+        self._store = store
+
+    def get_statement(self, keys, by_group=True):
+        return ('SELECT m.node_id, m.group_id FROM temp.frontier AS f '
+                'CROSS JOIN db_memberships AS m ON m.{} = f.key'.format(
+                'group_id' if by_group else 'node_id'))
+
+    def get_sql(self, keys, by_group=True):
+        return self.get_statement(keys, by_group=by_group)
+
+    def explain(self, keys, by_group=True, analyze=False):
+        return _SQLiteQuery(self._store, self.get_statement(keys, by_group)).explain(keys)
+
+    def execute(self, keys, by_group=True):
+        return self._store._execute_from(keys, self.get_statement(keys, by_group))
+
+
+class SQLiteStore(GraphStore):
+    """
+    A graph in a SQLite file, that can be used without an AiiDA profile,
+    e.g. to benchmark traversals, or to run them in workers that only open
+    the file::
+
+        store = SQLiteStore('graph.sqlite')
+        store.load_database()  # copies the graph of the loaded AiiDA profile
+        rule = UpdateRule(queryhelp, store=store)
+
+    The store has the ids, UUIDs, types, labels and times of the nodes, the
+    links, the groups and their memberships. Hops are single steps along links
+    (filtered by type and label, and with filters on the columns of the nodes)
+    or between groups and their members.
+    The frontier of a hop is written to a temporary table, which the statement
+    joins first (CROSS JOIN fixes the order of the joins in SQLite), so that
+    only the links of the frontier are read from the indices.
+    The connection is shared by the threads, statements are serialized.
+    Pickled stores open the same file again.
+    """
+    def __init__(self, path=':memory:'):
+        """
+        :param str path: The path of the file, created if it does not exist
+        """
+        self._path = path
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                isolation_level=None)
+        self._connection.execute('PRAGMA case_sensitive_like = ON')
+        self._connection.executescript(_SCHEMA)
+        self._connection.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS frontier (key INTEGER PRIMARY KEY)')
+
+    @property
+    def path(self):
+        return self._path
+
+    def __getstate__(self):
+        if self._path == ':memory:':
+            raise ValueError("A store in memory cannot be pickled")
+        return self._path
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def close(self):
+        self._connection.close()
+
+    def get_nodes(self, after_id=None, modified_since=None, attributes=()):
+        """
+        Times are given in seconds since the epoch. The store has no attributes.
+        """
+        from .caches import _to_timestamp
+        if attributes:
+            raise NotImplementedError("A SQLiteStore has no attributes of nodes")
+        conditions = []
+        params = []
+        if after_id is not None:
+            conditions.append('id > ?')
+            params.append(after_id)
+        if modified_since is not None:
+            conditions.append('mtime >= ?')
+            params.append(_to_timestamp(modified_since))
+        sql = 'SELECT id, mtime, type, ctime FROM db_nodes'
+        if conditions:
+            sql += ' WHERE ' + ' OR '.join(conditions)
+        with self._lock:
+            return [tuple(row) for row in self._connection.execute(
+                    sql + ' ORDER BY id', params).fetchall()]
+
+    def get_identity(self):
+        if self._path == ':memory:':
+            return 'sqlite::memory:{}'.format(id(self))
+        return 'sqlite:{}'.format(os.path.abspath(self._path))
+
+    def get_watermark(self, with_mtime=False):
+        """
+        :returns: The number of changes made through stores of the file, and
+            the largest ids of nodes, links and groups, which also grow with
+            rows added by other writers
+        """
+        with self._lock:
+            return [self._connection.execute(sql).fetchone()[0] for sql in (
+                    'SELECT version FROM db_version', 'SELECT max(id) FROM db_nodes',
+                    'SELECT max(id) FROM db_links', 'SELECT max(id) FROM db_groups')]
+
+    def _execute_from(self, frontier, sql, params=()):
+        """
+        Fills the table of the frontier and executes the statement,
+        in one transaction.
+        """
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN')
+            try:
+                cursor.execute('DELETE FROM temp.frontier')
+                cursor.executemany('INSERT OR IGNORE INTO temp.frontier VALUES (?)',
+                        ((key,) for key in frontier))
+                rows = cursor.execute(sql, params).fetchall()
+            finally:
+                cursor.execute('COMMIT')
+        return [tuple(row) for row in rows]
+
+    def _insert(self, table, columns, rows):
+        sql = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+                table, ', '.join(columns), ', '.join('?'*len(columns)))
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN')
+            try:
+                cursor.executemany(sql, rows)
+                nr_of_rows = cursor.rowcount
+                # Every change, also of existing rows, gives a new watermark:
+                cursor.execute('UPDATE db_version SET version = version + 1')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            return nr_of_rows
+
+    def add_nodes(self, rows):
+        """
+        :param rows: An iterable of tuples with the values of NODE_COLUMNS,
+            times in seconds since the epoch
+        """
+        return self._insert('db_nodes', NODE_COLUMNS, rows)
+
+    def add_links(self, rows):
+        """
+        :param rows: An iterable of tuples with the values of LINK_COLUMNS,
+            the id can be None
+        """
+        return self._insert('db_links', LINK_COLUMNS, rows)
+
+    def add_groups(self, rows):
+        """
+        :param rows: An iterable of tuples with the values of GROUP_COLUMNS
+        """
+        return self._insert('db_groups', GROUP_COLUMNS, rows)
+
+    def add_memberships(self, rows):
+        """
+        :param rows: An iterable of tuples (node id, group id)
+        """
+        return self._insert('db_memberships', MEMBERSHIP_COLUMNS, rows)
+
+    def load_database(self, batch_size=10000):
+        """
+        Copies the graph of the loaded AiiDA profile into the store.
+
+        :returns: The number of rows copied, by table
+        """
+        from aiida.orm import Node, Group
+        from aiida.orm.querybuilder import QueryBuilder
+        from .caches import _to_timestamp
+        counts = {}
+        qb = QueryBuilder().append(Node, project=list(NODE_COLUMNS))
+        counts['nodes'] = self.add_nodes((pk, str(uuid), type_, label,
+                _to_timestamp(ctime), _to_timestamp(mtime))
+                for pk, uuid, type_, label, ctime, mtime in qb.iterall(batch_size=batch_size))
+        counts['links'] = self.add_links((link_id, input_id, output_id, label, link_type)
+                for input_id, output_id, link_id, label, link_type
+                in QueryBuilderStore().get_links())
+        qb = QueryBuilder().append(Group, project=list(GROUP_COLUMNS))
+        counts['groups'] = self.add_groups((pk, str(uuid), name, type_)
+                for pk, uuid, name, type_ in qb.iterall(batch_size=batch_size))
+        qb = QueryBuilder().append(Group, tag='group', project='id').append(
+                Node, member_of='group', project='id')
+        counts['memberships'] = self.add_memberships((node_id, group_id)
+                for group_id, node_id in qb.iterall(batch_size=batch_size))
+        return counts
+
+    def supports(self, filters):
+        """
+        :returns: Whether the filters on a vertex can be translated to SQL
+        """
+        try:
+            _get_condition('n', filters, [])
+        except NotImplementedError:
+            return False
+        return True
+
+    def get_hop_query(self, queryhelp, first_tag, identifier, projections):
+        from .caches import get_local_hop
+        from .rules import get_membership_hop
+        if identifier != 'id':
+            raise NotImplementedError("Hops can only start from ids")
+        last_tag = queryhelp['path'][-1]['tag']
+        membership_hop = get_membership_hop(queryhelp)
+        params = []
+        if membership_hop is not None:
+            source, target = (('group_id', 'node_id') if membership_hop == 'members'
+                    else ('node_id', 'group_id'))
+            columns = {first_tag:{'id':'m.'+source}, last_tag:{'id':'m.'+target}}
+            from_clause = ('temp.frontier AS f CROSS JOIN db_memberships AS m '
+                    'ON m.{} = f.key'.format(source))
+            conditions = []
+        else:
+            # The filters on the vertices are evaluated by me:
+            local_hop = get_local_hop(queryhelp, node_cache=self)
+            if local_hop is None:
+                raise NotImplementedError("The path cannot be evaluated by a SQLiteStore")
+            source, target = ('output_id', 'input_id') if local_hop['reverse'] else (
+                    'input_id', 'output_id')
+            columns = {first_tag:{'id':'l.'+source}, last_tag:{'id':'l.'+target}}
+            from_clause = 'temp.frontier AS f CROSS JOIN db_links AS l ON l.{} = f.key'.format(source)
+            # The nodes are joined if they are filtered or projected:
+            joined = dict((tag, tag == first_tag and local_hop['source_filters'] is not None or
+                    tag == last_tag and local_hop['target_filters'] is not None or
+                    any(key != 'id' for projected_tag, key in projections if projected_tag == tag))
+                    for tag in (first_tag, last_tag))
+            for tag, alias, column in ((first_tag, 's', source), (last_tag, 't', target)):
+                if joined[tag]:
+                    from_clause += ' JOIN db_nodes AS {0} ON {0}.id = l.{1}'.format(alias, column)
+                    columns[tag].update((key, '{}.{}'.format(alias, key)) for key in NODE_COLUMNS
+                            if key != 'id')
+            conditions = []
+            for column, allowed in (('type', local_hop['link_types']),
+                    ('label', local_hop['labels'])):
+                if allowed is not None:
+                    allowed = sorted(allowed)
+                    conditions.append('l.{} IN ({})'.format(column, ', '.join('?'*len(allowed))))
+                    params.extend(allowed)
+            for alias, filters in (('s', local_hop['source_filters']),
+                    ('t', local_hop['target_filters'])):
+                if filters is not None:
+                    conditions.append(_get_condition(alias, filters, params))
+        select = []
+        for tag, key in projections:
+            if tag in columns:
+                column = columns[tag].get(key)
+            elif membership_hop is None and key in ('id', 'label', 'type'):
+                # Everything else is the edge:
+                column = 'l.' + key
+            else:
+                column = None
+            if column is None:
+                raise KeyError("Cannot project {} of {}".format(key, tag))
+            select.append(column)
+        sql = 'SELECT DISTINCT {} FROM {}'.format(', '.join(select), from_clause)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        return _SQLiteQuery(self, sql, params, projections)
+
+    def get_membership_query(self, chunk_size=10000):
+        return _SQLiteMembershipQuery(self)
+
+    def get_entities(self, entity_type, identifier, keys, ordered=False):
+        """
+        :returns: The entities as dictionaries of their columns
+        """
+        table, columns = {'node':('db_nodes', NODE_COLUMNS),
+                'group':('db_groups', GROUP_COLUMNS)}[entity_type]
+        if identifier != 'id':
+            raise NotImplementedError("Entities can only be fetched by id")
+        sql = 'SELECT {} FROM temp.frontier AS f CROSS JOIN {} AS e ON e.{} = f.key'.format(
+                ', '.join('e.'+column for column in columns), table, identifier)
+        if ordered:
+            sql += ' ORDER BY e.{}'.format(identifier)
+        return [dict(zip(columns, row)) for row in self._execute_from(keys, sql)]
+
+    def get_links(self, after_id=0, link_types=None):
+        sql = 'SELECT input_id, output_id, id, label, type FROM db_links WHERE id > ?'
+        params = [after_id]
+        if link_types is not None:
+            link_types = list(link_types)
+            sql += ' AND type IN ({})'.format(', '.join('?'*len(link_types)))
+            params.extend(link_types)
+        with self._lock:
+            return [tuple(row) for row in self._connection.execute(
+                    sql + ' ORDER BY id', params).fetchall()]
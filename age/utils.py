@@ -1,13 +1,17 @@
-from aiida.orm.data import Data
-from aiida.orm.calculation import Calculation
-from aiida.common.links import LinkType
-import numpy as np
-
-
-def create_tree(max_depth=3, branching=3, starting_cls=Data, draw=False):
+def create_tree(max_depth=3, branching=3, starting_cls=None, draw=False):
     """
-    
+    Creates a tree of alternating Data and Calculation nodes in the database.
+
+    :param starting_cls: The class of the root, Data (default) or Calculation
     """
+    # The imports are here, so that importing age.utils does not load the ORM:
+    from aiida.orm.data import Data
+    from aiida.orm.calculation import Calculation
+    from aiida.common.links import LinkType
+    import numpy as np
+
+    if starting_cls is None:
+        starting_cls = Data
     if starting_cls not in (Data, Calculation):
         raise TypeError("The starting_cls has to be either Data or Calculation")
 
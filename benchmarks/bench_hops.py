@@ -0,0 +1,154 @@
+"""
+Benchmark for many small hops.
+
+A linear chain of nodes is created and traversed, one node per hop.
+The prepared hop query of UpdateRule is compared with re-filtering a
+QueryBuilder instance at every hop, which rebuilds the query every time.
+
+Run with a configured AiiDA profile::
+
+    verdi run benchmarks/bench_hops.py
+
+With --visits, the visits are tracked in sets and with dense indices and
+bitsets (dense_visits), for a graph of layers held in a
+LinkTypeAdjacencyCache, so that the hops are in memory and no AiiDA
+profile is needed. Every node links to two random nodes of the next layer.
+Sets copy all visited keys at every hop, so dense visits gain the more
+hops there are::
+
+    python benchmarks/bench_hops.py --visits -l 2000 -w 100
+"""
+from __future__ import print_function
+import argparse
+import random
+import time
+
+
+def create_chain(length):
+    """
+    Creates a chain of alternating Data and Calculation nodes.
+
+    :returns: the pk of the first node of the chain
+    """
+    from aiida.common.links import LinkType
+    from aiida.orm.calculation import Calculation
+    from aiida.orm.data import Data
+
+    first = Data().store()
+    previous = first
+    for idx in range(1, length):
+        if isinstance(previous, Data):
+            new = Calculation().store()
+            new.add_link_from(previous, link_type=LinkType.INPUT, label='in')
+        else:
+            new = Data().store()
+            new.add_link_from(previous, link_type=LinkType.CREATE, label='out')
+        previous = new
+    return first.id
+
+
+def traverse_refiltering(start_id):
+    """
+    The traversal as it was done before hop queries were prepared:
+    the filter of a shared QueryBuilder is changed at every hop.
+    """
+    from aiida.orm import Node
+    from aiida.orm.querybuilder import QueryBuilder
+
+    qb = QueryBuilder().append(Node, tag='a').append(Node, tag='b', project='id')
+    visited = set([start_id])
+    frontier = set([start_id])
+    while frontier:
+        qb.add_filter('a', {'id': {'in': frontier}})
+        frontier = set(item['b']['id'] for item in qb.distinct().dict()) - visited
+        visited.update(frontier)
+    return visited
+
+
+def traverse_prepared(start_id):
+    import numpy as np
+    from aiida.orm import Node
+    from aiida.orm.querybuilder import QueryBuilder
+    from age.entities import get_basket
+    from age.rules import UpdateRule
+
+    qb = QueryBuilder().append(Node).append(Node)
+    rule = UpdateRule(qb, max_iterations=np.inf)
+    return rule.run(get_basket(node_ids=(start_id,)))['nodes'].get_keys()
+
+
+def create_layers(width, length, seed=0):
+    """
+    :returns: A LinkTypeAdjacencyCache with a graph of length layers of
+        width nodes, the first layer has the pks 0...width-1
+    """
+    from age.caches import LinkTypeAdjacencyCache
+    rng = random.Random(seed)
+    cache = LinkTypeAdjacencyCache()
+    for layer in range(length-1):
+        for pk in range(layer*width, (layer+1)*width):
+            for _ in range(2):
+                cache.add_link(pk, (layer+1)*width + rng.randrange(width), 'out', 'createlink')
+    return cache
+
+
+def traverse_visits(cache, width, dense_visits):
+    from age.entities import get_basket
+    from age.rules import UpdateRule
+    queryhelp = {'path':[{'type':'node.Node.', 'tag':'a'}, {'type':'node.Node.', 'tag':'b',
+            'joining_keyword':'output_of', 'joining_value':'a', 'edge_tag':'a--b'}],
+            'filters':{'a--b':{}, 'b':{}}, 'project':{}}
+    rule = UpdateRule(queryhelp, max_iterations=float('inf'), adjacency_cache=cache,
+            dense_visits=dense_visits)
+    return rule.run(get_basket(node_ids=range(width)))['nodes'].get_keys()
+
+
+def time_traversals(traversals, repeat, nr_of_hops):
+    """
+    Times every traversal, and checks that they give the same results
+
+    :param traversals: A list of tuples (name, function without arguments)
+    """
+    results = {}
+    for name, func in traversals:
+        timings = []
+        for _ in range(repeat):
+            t0 = time.time()
+            results[name] = func()
+            timings.append(time.time() - t0)
+        print('{:<12} {:8.4f} s (best of {}), {:8.3f} ms per hop'.format(
+                name, min(timings), repeat, 1e3*min(timings)/nr_of_hops))
+    assert len(set(frozenset(result) for result in results.values())) == 1, \
+            'Traversals differ!'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-l', '--length', type=int, default=200,
+            help='The length of the chain, i.e. the number of hops')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+            help='How often each traversal is timed')
+    parser.add_argument('--visits', action='store_true',
+            help='Compare visits in sets and dense visits, on a graph in memory')
+    parser.add_argument('-w', '--width', type=int, default=100,
+            help='With --visits, the number of nodes per layer, the length '
+            'is the number of layers')
+    args = parser.parse_args()
+    if args.visits:
+        cache = create_layers(args.width, args.length)
+        print('{} layers of {} nodes'.format(args.length, args.width))
+        time_traversals([('sets', lambda: traverse_visits(cache, args.width, False)),
+                ('dense', lambda: traverse_visits(cache, args.width, True))],
+                args.repeat, args.length)
+        return
+
+    from aiida import load_dbenv, is_dbenv_loaded
+    if not is_dbenv_loaded():
+        load_dbenv()
+    start_id = create_chain(args.length)
+    time_traversals([('refiltering', lambda: traverse_refiltering(start_id)),
+            ('prepared', lambda: traverse_prepared(start_id))], args.repeat, args.length)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark for the import time of the age package.
+
+Every module is imported in a fresh interpreter, the time is measured and
+the heavy packages that were loaded by the import are reported.
+Exits with a non-zero status if an import is slower than the given limit,
+or if it loads the AiiDA ORM::
+
+    python benchmarks/bench_import.py --max-seconds 0.5
+"""
+from __future__ import print_function
+import argparse
+import json
+import subprocess
+import sys
+
+MODULES = ('age.entities', 'age.rules', 'age.caches', 'age.indexing', 'age.utils')
+HEAVY_PACKAGES = ('aiida', 'sqlalchemy', 'numpy')
+
+_SCRIPT = """
+import json, sys, time
+t0 = time.time()
+import {module}
+dt = time.time() - t0
+print(json.dumps([dt, sorted(set(m.split('.')[0] for m in sys.modules
+        if m.split('.')[0] in {heavy!r}))]))
+"""
+
+
+def time_import(module, repeat=3):
+    """
+    :returns: the best import time of the module in seconds, and the heavy
+        packages that were loaded with it
+    """
+    best = None
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c',
+                _SCRIPT.format(module=module, heavy=HEAVY_PACKAGES)])
+        seconds, loaded = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        best = seconds if best is None else min(best, seconds)
+    return best, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-m', '--max-seconds', type=float, default=None,
+            help='Fail if importing a module takes longer')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+            help='How often each import is timed')
+    args = parser.parse_args()
+    failed = False
+    for module in MODULES:
+        seconds, loaded = time_import(module, repeat=args.repeat)
+        print('{:<16} {:8.1f} ms  loads: {}'.format(
+                module, 1e3*seconds, ', '.join(loaded) or '-'))
+        if 'aiida' in loaded:
+            print('   {} loads aiida at import!'.format(module))
+            failed = True
+        if args.max_seconds is not None and seconds > args.max_seconds:
+            print('   {} is slower than {} s!'.format(module, args.max_seconds))
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
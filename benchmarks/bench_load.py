@@ -0,0 +1,256 @@
+"""
+Load test for concurrent traversals.
+
+A tree of nodes is created, and many traversals starting from nodes of the
+tree run concurrently, in threads or in processes. Every worker builds its own
+rule from the same RuleSpec, and every process opens its own connection.
+
+--share-rule makes the threads share one rule (and its prepared queries and
+session). This is a stress mode that is not correct: a rule keeps the state
+of its run (walkers, visits, limits, profiler) in its attributes, so threads
+running the same rule race on them and can return wrong results.
+
+Reported are the throughput, the percentiles of the latency, the number of
+connections to the database (PostgreSQL only) and the peak memory of the
+workers.
+
+Run with a configured AiiDA profile::
+
+    verdi run benchmarks/bench_load.py -w 8 -m process -n 400
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import random
+import resource
+import threading
+import time
+
+from aiida import load_dbenv, is_dbenv_loaded
+
+
+def get_spec(rule_kind, max_iterations):
+    """
+    :returns: The RuleSpec of the traversal, following links forward.
+        For 'sequence', the rule goes forward and backward.
+    """
+    from aiida.orm import Node
+    from aiida.orm.querybuilder import QueryBuilder
+    from age.rules import UpdateRule, RuleSequence
+    from age.specs import RuleSpec
+
+    forward = UpdateRule(QueryBuilder().append(Node, tag='n').append(Node, output_of='n'),
+            max_iterations=max_iterations)
+    if rule_kind == 'update':
+        return RuleSpec.from_rule(forward)
+    backward = UpdateRule(QueryBuilder().append(Node, tag='n').append(Node, input_of='n'))
+    return RuleSpec.from_rule(RuleSequence((forward, backward), max_iterations=max_iterations))
+
+
+def get_seeds(instances, nr_of_traversals, distribution, seed=None):
+    """
+    :param instances: The pks of the tree, the root first
+    :param str distribution: 'uniform' over all nodes, 'zipf' for few hot
+        nodes that are used most of the time, or 'root'
+    :returns: The pk to start from, for every traversal
+    """
+    rng = random.Random(seed)
+    if distribution == 'root':
+        return [instances[0]]*nr_of_traversals
+    if distribution == 'uniform':
+        return [rng.choice(instances) for _ in range(nr_of_traversals)]
+    if distribution == 'zipf':
+        weights = [1./rank for rank in range(1, len(instances)+1)]
+        cumulative = []
+        total = 0.
+        for weight in weights:
+            total += weight
+            cumulative.append(total)
+        seeds = []
+        for _ in range(nr_of_traversals):
+            value = rng.random()*total
+            # Bisection on the cumulative weights:
+            low, high = 0, len(cumulative)-1
+            while low < high:
+                middle = (low+high)//2
+                if cumulative[middle] < value:
+                    low = middle+1
+                else:
+                    high = middle
+            seeds.append(instances[low])
+        return seeds
+    raise ValueError("Unknown distribution {}".format(distribution))
+
+
+def get_max_rss():
+    """
+    :returns: The peak resident memory of this process, in MB
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+def run_traversals(spec, seeds, rule=None):
+    """
+    Runs a traversal for every seed.
+
+    :returns: The latency of every traversal
+    """
+    from age.entities import get_basket
+    if rule is None:
+        rule = spec.build()
+    latencies = []
+    for seed in seeds:
+        t0 = time.time()
+        rule.run(get_basket(node_ids=(seed,)))
+        latencies.append(time.time()-t0)
+    return latencies
+
+
+def _init_process(profile):
+    """
+    Called in every process of the pool. Forked processes inherit the loaded
+    database environment, and with it the connection of the parent, which
+    they must not share.
+    """
+    if is_dbenv_loaded():
+        from age.parallel import _reset_connection
+        _reset_connection()
+    else:
+        load_dbenv(profile=profile)
+
+
+def _process_worker(args):
+    spec, seeds = args
+    return run_traversals(spec, seeds), get_max_rss()
+
+
+def _thread_worker(spec, seeds, rule, results, index):
+    results[index] = run_traversals(spec, seeds, rule=rule)
+
+
+class ConnectionMonitor(threading.Thread):
+    """
+    Counts the connections to the database in regular intervals, in its own session.
+    """
+    def __init__(self, interval=0.1):
+        super(ConnectionMonitor, self).__init__()
+        self.daemon = True
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self.counts = []
+
+    def run(self):
+        from aiida.orm.querybuilder import QueryBuilder
+        session = QueryBuilder()._impl.get_session()
+        if session.get_bind().dialect.name != 'postgresql':
+            return
+        from sqlalchemy import text
+        statement = text("SELECT count(*) FROM pg_stat_activity "
+                "WHERE datname = current_database()")
+        while not self._stop_event.is_set():
+            self.counts.append(session.execute(statement).scalar())
+            session.rollback()
+            self._stop_event.wait(self._interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values)-1, max(0, int(round(fraction*(len(values)-1)))))
+    return values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-w', '--workers', type=int, default=4,
+            help='The number of concurrent workers')
+    parser.add_argument('-m', '--mode', choices=('thread', 'process'), default='thread',
+            help='Whether the workers are threads or processes')
+    parser.add_argument('-n', '--traversals', type=int, default=100,
+            help='The total number of traversals')
+    parser.add_argument('-r', '--rule', choices=('update', 'sequence'), default='update',
+            help='Traverse with an UpdateRule, or a RuleSequence')
+    parser.add_argument('-i', '--max-iterations', type=int, default=None,
+            help='The maximum number of iterations, unbounded by default')
+    parser.add_argument('-s', '--seeds', choices=('uniform', 'zipf', 'root'), default='uniform',
+            help='How the nodes to start from are chosen')
+    parser.add_argument('-d', '--depth', type=int, default=5,
+            help='The depth of the tree that is created')
+    parser.add_argument('-b', '--branching', type=int, default=3,
+            help='The branching of the tree that is created')
+    parser.add_argument('--share-rule', action='store_true',
+            help='Share one rule between the threads, a stress mode whose '
+            'results can be wrong')
+    parser.add_argument('--random-seed', type=int, default=None)
+    args = parser.parse_args()
+    if args.share_rule and args.mode == 'process':
+        parser.error('A rule can only be shared between threads')
+    if not is_dbenv_loaded():
+        load_dbenv()
+
+    from age.utils import create_tree
+    instances = create_tree(args.depth, args.branching)['instances'].tolist()
+    spec = get_spec(args.rule, float('inf') if args.max_iterations is None
+            else args.max_iterations)
+    seeds = get_seeds(instances, args.traversals, args.seeds, seed=args.random_seed)
+    chunks = [seeds[index::args.workers] for index in range(args.workers)]
+
+    monitor = ConnectionMonitor()
+    monitor.start()
+    t0 = time.time()
+    if args.mode == 'process':
+        from aiida.backends import settings
+        pool = multiprocessing.Pool(args.workers, initializer=_init_process,
+                initargs=(settings.AIIDADB_PROFILE,))
+        try:
+            replies = pool.map(_process_worker, [(spec, chunk) for chunk in chunks])
+        finally:
+            pool.close()
+            pool.join()
+        latencies_per_worker = [latencies for latencies, _ in replies]
+        memory = [max_rss for _, max_rss in replies]
+    else:
+        shared_rule = None
+        if args.share_rule:
+            print('Warning: threads running a shared rule can return wrong results')
+            shared_rule = spec.build()
+        latencies_per_worker = [None]*args.workers
+        threads = [threading.Thread(target=_thread_worker,
+                args=(spec, chunk, shared_rule, latencies_per_worker, index))
+                for index, chunk in enumerate(chunks)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Threads share the memory of the process:
+        memory = [get_max_rss()]
+    wall_time = time.time() - t0
+    monitor.stop()
+
+    latencies = [latency for latencies in latencies_per_worker
+            for latency in (latencies or ())]
+    if len(latencies) != args.traversals:
+        raise RuntimeError('Only {} of {} traversals finished'.format(
+                len(latencies), args.traversals))
+    print('{} traversals ({}), {} {} workers, seeds: {}, tree of {} nodes'.format(
+            args.traversals, args.rule, args.workers, args.mode+'s', args.seeds,
+            len(instances)))
+    print('throughput     {:10.2f} traversals/s'.format(args.traversals/wall_time))
+    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        print('latency {}    {:10.2f} ms'.format(name, 1e3*percentile(latencies, fraction)))
+    if monitor.counts:
+        print('connections    {:10d} max, {:.1f} mean'.format(max(monitor.counts),
+                float(sum(monitor.counts))/len(monitor.counts)))
+    else:
+        print('connections    not available for this database')
+    print('peak memory    {} MB per {}'.format(
+            ', '.join('{:.0f}'.format(max_rss) for max_rss in memory),
+            'worker' if args.mode == 'process' else 'process'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmark for the partitioned traversal with several worker processes.
+
+A graph of layers is written to a SQLite file, every node links to a few
+random nodes of the next layer. The closure of the first layer is computed
+in a single process, and with a PartitionedTraversal of 1, 2 and 4 workers
+(or the numbers given), which expand their shards of every hop in parallel
+and exchange the keys they found directly. No AiiDA profile is needed::
+
+    python benchmarks/bench_parallel.py -l 50 -w 20000 -n 1 2 4
+
+The speedup is bounded by the number of cores.
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+
+def create_layers(store, width, length, nr_of_links, seed=0):
+    """
+    Adds length layers of width nodes to the store, the first layer has the
+    pks 0...width-1. Every node links to nr_of_links nodes of the next layer.
+    """
+    rng = random.Random(seed)
+    store.add_links((None, pk, (layer+1)*width + rng.randrange(width), 'out', 'createlink')
+            for layer in range(length-1) for pk in range(layer*width, (layer+1)*width)
+            for _ in range(nr_of_links))
+
+
+def main():
+    from age.entities import get_basket
+    from age.parallel import PartitionedTraversal
+    from age.rules import UpdateRule
+    from age.stores import SQLiteStore
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-l', '--length', type=int, default=50,
+            help='The number of layers, i.e. of hops')
+    parser.add_argument('-w', '--width', type=int, default=20000,
+            help='The number of nodes per layer')
+    parser.add_argument('-k', '--links', type=int, default=3,
+            help='The number of links of every node to the next layer')
+    parser.add_argument('-n', '--workers', type=int, nargs='+', default=[1, 2, 4],
+            help='The numbers of workers to run with')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+            help='How often each traversal is timed')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        store = SQLiteStore(os.path.join(folder, 'graph.sqlite'))
+        create_layers(store, args.width, args.length, args.links)
+        queryhelp = {'path':[{'type':'node.Node.', 'tag':'a'}, {'type':'node.Node.', 'tag':'b',
+                'joining_keyword':'output_of', 'joining_value':'a', 'edge_tag':'a--b'}],
+                'filters':{'a--b':{}, 'b':{}}, 'project':{}}
+        rule = UpdateRule(queryhelp, max_iterations=float('inf'), store=store)
+        walkers = get_basket(node_ids=range(args.width))
+        print('{} layers of {} nodes, {} links per node, {} cores'.format(args.length,
+                args.width, args.links, multiprocessing.cpu_count()))
+
+        timings = []
+        for _ in range(args.repeat):
+            t0 = time.time()
+            expected = rule.run(walkers.copy())
+            timings.append(time.time() - t0)
+        single = min(timings)
+        print('{:<12} {:8.3f} s'.format('1 process', single))
+        for nr_of_workers in args.workers:
+            with PartitionedTraversal(rule, nr_of_workers=nr_of_workers,
+                    rule_kwargs=dict(store=store)) as traversal:
+                timings = []
+                for _ in range(args.repeat):
+                    t0 = time.time()
+                    results = traversal.run(walkers.copy())
+                    timings.append(time.time() - t0)
+            assert results == expected, 'Traversals differ!'
+            print('{:<12} {:8.3f} s, {:5.2f}x of 1 process'.format(
+                    '{} workers'.format(nr_of_workers), min(timings), single/min(timings)))
+        store.close()
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
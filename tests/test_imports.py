@@ -0,0 +1,36 @@
+import subprocess
+import sys
+import unittest
+
+
+class TestImports(unittest.TestCase):
+    """
+    The set containers, the rules and the in-memory caches have to be
+    importable without loading the AiiDA ORM, which is slow to import.
+    """
+    def _get_loaded_packages(self, statement):
+        script = ("import sys\n{}\n"
+                "print(' '.join(set(m.split('.')[0] for m in sys.modules)))".format(statement))
+        output = subprocess.check_output([sys.executable, '-c', script])
+        return output.decode('utf-8').split()
+
+    def test_entities(self):
+        loaded = self._get_loaded_packages(
+                'from age.entities import VALID_ENTITY_CLASSES, VALID_ENTITY_TYPES')
+        for package in ('aiida', 'numpy'):
+            self.assertNotIn(package, loaded)
+
+    def test_rules(self):
+        loaded = self._get_loaded_packages('import age.rules')
+        for package in ('aiida', 'numpy', 'sqlalchemy'):
+            self.assertNotIn(package, loaded)
+
+    def test_in_memory(self):
+        loaded = self._get_loaded_packages(
+                'import age.caches, age.indexing, age.stores, age.utils')
+        for package in ('aiida', 'sqlalchemy'):
+            self.assertNotIn(package, loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -29,6 +29,19 @@ class TestNodes(AiidaTestCase):
         # ~ self.test_returns_calls()
         self.test_cycle()
         self.test_stash()
+        self.test_rule_reuse()
+        self.test_dense_visits()
+        self.test_rule_spec()
+        self.test_partitioned_traversal()
+        self.test_estimate_closure()
+        self.test_export_closure()
+        self.test_profiler()
+        self.test_optimize_sequence()
+        self.test_max_results()
+        self.test_bulk_keys()
+        self.test_result_cache()
+        self.test_pages()
+        self.test_sqlite_store()
 
     def test_data_provenance(self):
         """
@@ -64,6 +77,323 @@ class TestNodes(AiidaTestCase):
             self.assertTrue(not(res.difference(should_set) or should_set.difference(res)))
 
 
+    def test_rule_reuse(self):
+        """
+        The hop query is prepared once per rule, running the same rule on
+        different walkers must not leak the frontier of a previous run.
+        """
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        desc_dict = created_dict['depth_dict']
+        qb = QueryBuilder().append(Node).append(Node)
+        rule = UpdateRule(qb, mode=MODES.REPLACE, max_iterations=1)
+        for depth in range(self.DEPTH-1):
+            for pk in desc_dict[depth]:
+                res = rule.run(get_basket(node_ids=(pk,)))['nodes']._set
+                children = set(pk2 for pk2 in desc_dict[depth+1] if
+                        created_dict['adjacency'][
+                                list(created_dict['instances']).index(pk),
+                                list(created_dict['instances']).index(pk2)])
+                self.assertEqual(res, children)
+
+    def test_dense_visits(self):
+        """
+        Tracking visits with dense indices and bitsets has to give the
+        same results as tracking them with sets.
+        """
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        es = get_basket(node_ids=(created_dict['parent'].id,))
+        qb = QueryBuilder().append(Node).append(Node)
+        for mode in (MODES.APPEND, MODES.REPLACE):
+            for max_iterations in (1, self.DEPTH-2, np.inf):
+                results = []
+                for dense_visits in (False, True):
+                    rule = UpdateRule(qb, mode=mode, max_iterations=max_iterations,
+                            track_edges=True, dense_visits=dense_visits)
+                    results.append((rule.run(es.copy()), rule.get_visits()))
+                self.assertEqual(results[0], results[1])
+
+    def test_rule_spec(self):
+        """
+        Rules rebuilt from their (serialized) specification have to give the
+        same results as the original rules.
+        """
+        import pickle
+        from age.specs import RuleSpec
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        es = get_basket(node_ids=(created_dict['parent'].id,))
+        rule_out = UpdateRule(QueryBuilder().append(Node, tag='n').append(Node, output_of='n'),
+                mode=MODES.REPLACE, track_edges=True)
+        rule_in = UpdateRule(QueryBuilder().append(Node, tag='n').append(Node, input_of='n'))
+        stash = es.copy(with_data=False)
+        seq = RuleSequence((rule_out, RuleSaveWalkers(stash), rule_in, RuleSetWalkers(stash)),
+                max_iterations=np.inf)
+        for rule in (rule_out, rule_in, seq):
+            spec = RuleSpec.from_rule(rule)
+            for copied in (RuleSpec.from_json(spec.to_json()), pickle.loads(pickle.dumps(spec))):
+                self.assertEqual(copied, spec)
+                self.assertEqual(hash(copied), hash(spec))
+                self.assertEqual(copied.build().run(es.copy()), rule.run(es.copy()))
+
+    def test_partitioned_traversal(self):
+        """
+        Traversing with several worker processes has to give the same results
+        as traversing in one process.
+        """
+        from age.parallel import PartitionedTraversal
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        es = get_basket(node_ids=(created_dict['parent'].id,))
+        for mode in MODES:
+            for max_iterations in (1, 2, np.inf):
+                rule = UpdateRule(QueryBuilder().append(Node, tag='n').append(Node, output_of='n'),
+                        mode=mode, max_iterations=max_iterations, track_edges=True)
+                with PartitionedTraversal(rule, nr_of_workers=3) as traversal:
+                    self.assertEqual(traversal.run(es.copy()), rule.run(es.copy()))
+                    self.assertEqual(traversal.get_visits(), rule.get_visits())
+                    self.assertEqual(traversal.get_iterations_done(), rule.get_iterations_done())
+
+    def test_estimate_closure(self):
+        """
+        If the frontier fits in the sample, the estimate is exact, otherwise it
+        has to be close to the size of the closure.
+        """
+        from age.estimate import estimate_closure
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        es = get_basket(node_ids=(created_dict['parent'].id,))
+        rule = UpdateRule(QueryBuilder().append(Node, tag='n').append(Node, output_of='n'),
+                max_iterations=np.inf)
+        nr_of_nodes = len(rule.run(es.copy())['nodes'])
+        estimates = estimate_closure(rule, es.copy(), sample_size=1000)
+        self.assertTrue(estimates[-1]['exact'])
+        self.assertEqual(estimates[-1]['total']['nodes'], nr_of_nodes)
+        self.assertEqual(len(estimates), rule.get_iterations_done()+1)
+        estimates = estimate_closure(rule, es.copy(), sample_size=2, nr_of_batches=2, seed=0)
+        self.assertFalse(estimates[-1]['exact'])
+        self.assertTrue(abs(estimates[-1]['total']['nodes'] - nr_of_nodes) <=
+                max(3*estimates[-1]['total_errors']['nodes'], 0.5*nr_of_nodes))
+
+    def test_export_closure(self):
+        """
+        The archive written while the rule runs has to contain the results.
+        """
+        import json, os, shutil, tempfile
+        from age.export import export_closure
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        es = get_basket(node_ids=(created_dict['parent'].id,))
+        rule = UpdateRule(QueryBuilder().append(Node, tag='n').append(Node, output_of='n'),
+                max_iterations=np.inf, track_edges=True)
+        folder = tempfile.mkdtemp()
+        try:
+            for threaded in (True, False):
+                path = os.path.join(folder, 'threaded' if threaded else 'serial')
+                res = export_closure(rule, es.copy(), path, batch_size=3, threaded=threaded)
+                for name, set_key in (('nodes', 'nodes'), ('links', 'nodes_nodes')):
+                    with open(os.path.join(path, '{}.jsonl'.format(name))) as f:
+                        self.assertEqual(len(f.readlines()), len(res[set_key]))
+                with open(os.path.join(path, 'metadata.json')) as f:
+                    self.assertEqual(json.load(f)['counts']['nodes'], len(res['nodes']))
+            # Going back to the inputs, the links are written from input to output:
+            qb = QueryBuilder().append(Node, tag='n').append(Node, output_of='n', project='id')
+            leaf_id = max(pk for pk, in qb.all())
+            path = os.path.join(folder, 'ancestors')
+            res = export_closure(UpdateRule(QueryBuilder().append(Node, tag='n').append(Node,
+                    input_of='n'), max_iterations=np.inf, track_edges=True),
+                    get_basket(node_ids=(leaf_id,)), path, threaded=False)
+            uuids = dict((node.uuid, node.id) for node in res['nodes'].get_entities())
+            with open(os.path.join(path, 'links.jsonl')) as f:
+                links = [json.loads(line) for line in f]
+            self.assertEqual(len(links), len(res['nodes_nodes']))
+            for link in links:
+                qb = QueryBuilder().append(Node, filters={'id':uuids[link['input']]}, tag='i')
+                qb.append(Node, output_of='i', filters={'id':uuids[link['output']]})
+                self.assertEqual(qb.count(), 1)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_profiler(self):
+        """
+        The profiler has to report every hop of the rules in a sequence,
+        with the SQL and the plan of the queries.
+        """
+        import json
+        from age.profiling import HopProfiler
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        es = get_basket(node_ids=(created_dict['parent'].id,))
+        rule = UpdateRule(QueryBuilder().append(Node, tag='n').append(Node, output_of='n'))
+        seq = RuleSequence((rule,), max_iterations=np.inf)
+        profiler = HopProfiler(explain=True)
+        seq.set_profiler(profiler)
+        res = seq.run(es.copy())
+        report = json.loads(profiler.to_json())
+        self.assertEqual(len(report['runs']), 1)
+        run = report['runs'][0]
+        self.assertEqual(run['iterations'], seq.get_iterations_done())
+        hops = [hop for child in run['runs'] for hop in child['hops']]
+        self.assertEqual(len(hops), report['summary']['query']['hops'])
+        for hop in hops:
+            self.assertTrue(hop['sql'])
+            self.assertTrue(hop['plan'])
+        self.assertEqual(hops[0]['frontier_size'], 1)
+        self.assertEqual(hops[0]['rows'], self.NR_OF_CHILDREN)
+        # Without a profiler, nothing is recorded:
+        seq.set_profiler(None)
+        self.assertEqual(seq.run(es.copy()), res)
+        self.assertEqual(len(profiler.get_report()['runs']), 1)
+
+    def test_optimize_sequence(self):
+        """
+        The optimized sequence, with fused and reordered rules, has to give
+        the same results as the original sequence.
+        """
+        from age.optimizer import optimize_sequence, FusedRules
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        es = get_basket(node_ids=(created_dict['parent'].id,))
+        for max_iterations in (1, 2, np.inf):
+            rule_out = UpdateRule(QueryBuilder().append(Node, tag='n').append(Node, output_of='n'),
+                    track_edges=True)
+            rule_in = UpdateRule(QueryBuilder().append(Node, tag='n').append(Node, input_of='n'))
+            seq = RuleSequence((rule_out, rule_in, rule_out), max_iterations=max_iterations,
+                    track_edges=True)
+            optimized = optimize_sequence(seq, walkers=es)
+            plan = optimized.get_plan()
+            self.assertEqual(plan['reordered'], max_iterations == np.inf)
+            self.assertEqual(len(plan['fused']), 1)
+            self.assertEqual(plan['queries_saved_per_iteration'], 2)
+            self.assertTrue(isinstance(optimized._rules[0], FusedRules))
+            self.assertEqual(optimized.run(es.copy()), seq.run(es.copy()))
+            self.assertEqual(optimized.get_visits(), seq.get_visits())
+            self.assertEqual(optimized.get_queries_saved(), 2*optimized.get_iterations_done())
+
+    def test_max_results(self):
+        """
+        Runs with a maximum number of results keep the entities closest to
+        the walkers, runs with a stop predicate stop after the hop it is true.
+        """
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        depth_dict = created_dict['depth_dict']
+        es = get_basket(node_ids=(created_dict['parent'].id,))
+        qb = QueryBuilder().append(Node, tag='n').append(Node, output_of='n')
+        rule = UpdateRule(qb, max_iterations=np.inf, track_edges=True)
+        seq = RuleSequence((UpdateRule(qb),), max_iterations=np.inf)
+        first_two_levels = depth_dict[0].union(depth_dict[1])
+        for nr_of_results in (1, 2, len(first_two_levels)+1, 1000):
+            for operation in (rule, seq):
+                res = operation.run(es.copy(), max_results=nr_of_results)
+                nodes = res['nodes'].get_keys()
+                self.assertEqual(len(nodes), min(nr_of_results, len(created_dict['instances'])))
+                if len(nodes) > len(first_two_levels):
+                    self.assertTrue(first_two_levels.issubset(nodes))
+            for edge in res['nodes_nodes'].get_keys():
+                self.assertTrue(edge[0] in nodes and edge[1] in nodes)
+        res = rule.run(es.copy(), stop=lambda new: bool(new['nodes'].get_keys() & depth_dict[2]))
+        self.assertEqual(rule.get_iterations_done(), 2)
+        self.assertEqual(res['nodes'].get_keys(), first_two_levels.union(depth_dict[2]))
+
+    def test_bulk_keys(self):
+        """
+        Keys given in bulk, as arrays, give the same sets as keys given one by one.
+        """
+        import array
+        from age.entities import AiidaEntitySet, DirectedEdgeSet
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        instances = created_dict['instances']
+        es = get_basket(node_ids=instances.tolist())
+        self.assertEqual(get_basket(node_ids=instances), es)
+        nodes = AiidaEntitySet('node')
+        nodes.set_keys(array.array('l', instances.tolist()))
+        self.assertEqual(nodes, es['nodes'])
+        nodes.set_keys(instances[:1])
+        nodes.add_keys(instances[1:])
+        self.assertEqual(nodes, es['nodes'])
+        for keys in (instances.astype(float), ['a'], instances.reshape(1, -1), 'ab'):
+            with self.assertRaises((TypeError, ValueError)):
+                nodes.set_keys(keys)
+
+        qb = QueryBuilder().append(Node, tag='n').append(Node, output_of='n')
+        res = UpdateRule(qb, max_iterations=np.inf, track_edges=True).run(es.copy())
+        edges = res['nodes_nodes'].get_keys()
+        links = DirectedEdgeSet('node', 'node', ('label', 'type'))
+        links.set_columns(*zip(*edges))
+        self.assertEqual(links.get_keys(), edges)
+        with self.assertRaises(ValueError):
+            links.add_columns([1], [2], ['label'])
+
+    def test_result_cache(self):
+        """
+        Traversals cached on disk give the same results, until the database changes.
+        """
+        import shutil
+        import tempfile
+        from age.caches import ResultCache
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        es = get_basket(node_ids=(created_dict['parent'].id,))
+        qb = QueryBuilder().append(Node, tag='n').append(Node, output_of='n')
+        rule = UpdateRule(qb, max_iterations=np.inf, track_edges=True)
+        folder = tempfile.mkdtemp()
+        try:
+            cache = ResultCache(folder)
+            res = rule.run(es.copy())
+            self.assertEqual(cache.run(rule, es), res)
+            self.assertEqual(cache.run(rule, es), res)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            # A new node changes the watermark:
+            Data().store()
+            self.assertEqual(cache.run(rule, es), res)
+            self.assertEqual((cache.hits, cache.misses, cache.stale), (1, 2, 1))
+            # Other walkers are another entry, the budget keeps only the last one:
+            cache = ResultCache(folder, max_bytes=cache.get_size())
+            cache.run(rule, get_basket(node_ids=created_dict['depth_dict'][1]))
+            self.assertEqual(len(cache), 1)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_pages(self):
+        """
+        Pages of keys and of entities come in the order of the keys, and
+        resume after the last key of the previous page.
+        """
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        es = get_basket(node_ids=created_dict['instances'])
+        qb = QueryBuilder().append(Node, tag='n').append(Node, output_of='n')
+        res = UpdateRule(qb, max_iterations=np.inf, track_edges=True).run(es.copy())
+        for set_ in (res['nodes'], res['nodes_nodes']):
+            pages = list(set_.iter_pages(7))
+            self.assertTrue(all(len(page) == 7 for page in pages[:-1]))
+            self.assertEqual([key for page in pages for key in page], sorted(set_.get_keys()))
+        page, token = res['nodes'].get_entities_page(5)
+        self.assertEqual([node.id for node in page], sorted(res['nodes'].get_keys())[:5])
+        page, _ = res['nodes'].get_entities_page(5, token)
+        self.assertEqual([node.id for node in page], sorted(res['nodes'].get_keys())[5:10])
+        self.assertEqual([node.id for node in res['nodes'].get_entities(page_size=4)],
+                sorted(res['nodes'].get_keys()))
+
+    def test_sqlite_store(self):
+        """
+        Traversals in a copy of the database in SQLite give the same results.
+        """
+        from age.stores import SQLiteStore
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        es = get_basket(node_ids=(created_dict['parent'].id,))
+        store = SQLiteStore()
+        self.assertTrue(store.load_database()['links'] > 0)
+        for qb in (QueryBuilder().append(Node, tag='n').append(Node, output_of='n'),
+                QueryBuilder().append(Node, tag='n').append(Data, output_of='n')):
+            rule = UpdateRule(qb, max_iterations=np.inf, track_edges=True)
+            rule_sqlite = UpdateRule(qb, max_iterations=np.inf, track_edges=True, store=store)
+            self.assertEqual(rule_sqlite.run(es.copy()), rule.run(es.copy()))
+
     def test_cycle(self):
         """
         Creating a cycle: A data-instance is both input to and returned by a WorkFlowNode
@@ -176,6 +506,24 @@ class TestNodes(AiidaTestCase):
         # NOw I test whether the stash does the right thing,
         # namely not including c2 in the results:
         self.assertEqual(is_set, douts.union(dins).union({c.id}))
+
+        # A versioned stash gives the same results, and keeps the versions:
+        from age.entities import VersionedStash
+        stash = VersionedStash()
+        rs3 = RuleSequence((
+                RuleSaveWalkers(stash), rule_in,
+                RuleSetWalkers(stash) ,rule_out))
+        self.assertEqual(rs3.run(es.copy())['nodes']._set, is_set)
+        restored = es.copy(with_data=False)
+        stash.restore(restored, version=0)
+        self.assertEqual(restored, es)
+        # A branch shares the versions, but not what is saved later:
+        branch = stash.branch(version=0)
+        branch.save(get_basket(node_ids=(c2.id,)))
+        stash.restore(restored)
+        self.assertEqual(restored, es)
+        branch.restore(restored)
+        self.assertEqual(restored['nodes']._set, es['nodes']._set.union({c2.id}))
     
         
     def test_returns_calls(self ):
@@ -288,6 +636,22 @@ class TestGroups(AiidaTestCase):
                 (groups_set,res['groups']._set)):
             self.assertEqual(is_set, should_set)
 
+        # The memberships are tracked as edges, in both directions,
+        # also when the members are taken from the membership cache:
+        from age.caches import GroupMembershipCache
+        cache = GroupMembershipCache()
+        memberships_set = set((n.id, g.id) for g in groups for n in nodes
+                if n.id in [member.id for member in g.nodes])
+        for membership_cache in (None, cache, cache):
+            rule1 = UpdateRule(qb1, track_edges=True)
+            rule2 = UpdateRule(qb2, track_edges=True, membership_cache=membership_cache)
+            seq = RuleSequence((rule1, rule2), max_iterations=np.inf, track_edges=True)
+            res = seq.run(es.copy())
+            self.assertEqual(res['nodes']._set, nodes_set)
+            self.assertEqual(res['nodes_groups']._set, memberships_set)
+        self.assertEqual(len(cache), len(groups_set))
+        self.assertTrue(cache.hits > 0)
+
 class TestEdges(AiidaTestCase):
     DEPTH = 4
     NR_OF_CHILDREN = 2
@@ -342,6 +706,90 @@ class TestEdges(AiidaTestCase):
         touples_are = set(zip(*zip(*res['nodes_nodes']._set)[:2]))
         self.assertEqual(touples_are, touples_should)
 
+class TestAdjacencyCache(AiidaTestCase):
+    DEPTH = 4
+    NR_OF_CHILDREN = 2
+
+    def runTest(self):
+        """
+        Testing whether hops done on the cached links give the same results as
+        the hops done in the database, and whether the cache is refreshed
+        with new links.
+        """
+        from age.caches import LinkTypeAdjacencyCache
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        es = get_basket(node_ids=(created_dict['parent'].id,))
+
+        cache = LinkTypeAdjacencyCache()
+        self.assertTrue(cache.refresh() > 0)
+        self.assertEqual(cache.refresh(), 0)
+        self.assertTrue(set([LinkType.CREATE.value, LinkType.INPUT.value]).issubset(
+                cache.link_types))
+
+        for edge_filters in (None, {'type':LinkType.CREATE.value},
+                {'type':{'in':[LinkType.INPUT.value, LinkType.CREATE.value]}}):
+            qb = QueryBuilder().append(Node, tag='a').append(Node,
+                    output_of='a', edge_filters=edge_filters)
+            for track_edges in (False, True):
+                rule_db = UpdateRule(qb, max_iterations=np.inf, track_edges=track_edges)
+                rule_local = UpdateRule(qb, max_iterations=np.inf,
+                        track_edges=track_edges, adjacency_cache=cache)
+                self.assertEqual(rule_db.run(es.copy()), rule_local.run(es.copy()))
+
+        # Only following CREATE links, the parent (a Data instance) has no children:
+        qb = QueryBuilder().append(Node, tag='a').append(Node,
+                output_of='a', edge_filters={'type':LinkType.CREATE.value})
+        rule = UpdateRule(qb, max_iterations=np.inf, adjacency_cache=cache)
+        self.assertEqual(rule.run(es.copy())['nodes']._set, es['nodes']._set)
+
+        # A new link is only seen by the cache after a refresh:
+        c = Calculation().store()
+        c.add_link_from(created_dict['parent'], link_type=LinkType.INPUT, label='new')
+        qb = QueryBuilder().append(Node, tag='a').append(Node, output_of='a')
+        rule = UpdateRule(qb, max_iterations=1, adjacency_cache=cache)
+        self.assertTrue(c.id not in rule.run(es.copy())['nodes']._set)
+        self.assertEqual(cache.refresh(), 1)
+        self.assertTrue(c.id in rule.run(es.copy())['nodes']._set)
+
+
+class TestNodeAttributeCache(AiidaTestCase):
+    DEPTH = 4
+    NR_OF_CHILDREN = 2
+
+    def runTest(self):
+        """
+        Testing whether filters on the vertices, evaluated with the node cache
+        during in-memory hops, give the same results as the database.
+        """
+        from age.caches import LinkTypeAdjacencyCache, NodeAttributeCache
+        from age.utils import create_tree
+        created_dict = create_tree(self.DEPTH, self.NR_OF_CHILDREN)
+        parent = created_dict['parent']
+        es = get_basket(node_ids=(parent.id,))
+
+        adjacency_cache = LinkTypeAdjacencyCache()
+        adjacency_cache.refresh()
+        node_cache = NodeAttributeCache()
+        node_cache.refresh()
+        self.assertEqual(node_cache.filter_keys(created_dict['instances'],
+                {'type':{'like':'calculation.%'}}), created_dict['depth_dict'][1].union(
+                created_dict['depth_dict'][3]))
+
+        for qb in (
+                QueryBuilder().append(Node, tag='a').append(Data, output_of='a'),
+                QueryBuilder().append(Data, tag='a').append(Node, output_of='a',
+                        filters={'ctime':{'>':parent.ctime}}),
+                QueryBuilder().append(Node, tag='a').append(Node, output_of='a',
+                        filters={'or':[{'id':parent.id}, {'type':{'like':'data.%'}}]})):
+            for track_edges in (False, True):
+                rule_db = UpdateRule(qb, max_iterations=np.inf, track_edges=track_edges)
+                rule_local = UpdateRule(qb, max_iterations=np.inf, track_edges=track_edges,
+                        adjacency_cache=adjacency_cache, node_cache=node_cache)
+                self.assertTrue(rule_local._local_hop is not None)
+                self.assertEqual(rule_db.run(es.copy()), rule_local.run(es.copy()))
+
+
 if __name__ == '__main__':
     from unittest import TestSuite, TextTestRunner
     try:
@@ -354,4 +802,6 @@ if __name__ == '__main__':
     test_suite.addTest(TestNodes())
     test_suite.addTest(TestGroups())
     test_suite.addTest(TestEdges())
+    test_suite.addTest(TestAdjacencyCache())
+    test_suite.addTest(TestNodeAttributeCache())
     results = TextTestRunner(failfast=False, verbosity=2).run(test_suite)
@@ -0,0 +1,328 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from age.caches import ChainIndex, LinkTypeAdjacencyCache
+from age.entities import get_basket
+from age.rules import MODES, UpdateRule
+from age.stores import SQLiteStore
+
+
+def get_queryhelp(joining_keyword, edge_filters=None, target_filters=None):
+    return {'path':[{'type':'node.Node.', 'tag':'a'},
+            {'type':'node.Node.', 'tag':'b', 'joining_keyword':joining_keyword,
+            'joining_value':'a', 'edge_tag':'a--b'}],
+            'filters':{'a--b':edge_filters or {}, 'b':target_filters or {}}, 'project':{}}
+
+
+class TestSQLiteStore(unittest.TestCase):
+    """
+    Traversals in a SQLite file, without an AiiDA profile, have to give the
+    same results as the hops on the cached links of the same graph.
+    """
+    NR_OF_NODES = 200
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.store = SQLiteStore()
+        self.store.add_nodes([(pk, 'uuid-{}'.format(pk), 'data.' if pk % 2 else 'calculation.',
+                'label-{}'.format(pk), float(pk), float(pk)) for pk in range(self.NR_OF_NODES)])
+        self.store.add_links([(None, rng.randrange(self.NR_OF_NODES),
+                rng.randrange(self.NR_OF_NODES), 'link-{}'.format(index % 3),
+                'createlink' if index % 2 else 'inputlink') for index in range(600)])
+        self.store.add_groups([(1, 'uuid-g', 'group', '')])
+        self.store.add_memberships([(pk, 1) for pk in range(0, self.NR_OF_NODES, 7)])
+
+    def test_hops(self):
+        cache = LinkTypeAdjacencyCache(store=self.store)
+        self.assertEqual(cache.refresh(), 600)
+        walkers = get_basket(node_ids=(0, 1))
+        for queryhelp in (get_queryhelp('output_of'),
+                get_queryhelp('input_of', edge_filters={'type':'createlink'}),
+                get_queryhelp('output_of', edge_filters={'label':{'in':['link-0', 'link-1']}})):
+            for track_edges in (False, True):
+                res = UpdateRule(queryhelp, max_iterations=float('inf'),
+                        track_edges=track_edges, store=self.store).run(walkers.copy())
+                self.assertEqual(res, UpdateRule(queryhelp, max_iterations=float('inf'),
+                        track_edges=track_edges, adjacency_cache=cache).run(walkers.copy()))
+        res = UpdateRule(get_queryhelp('output_of', target_filters={'type':{'like':'data.%'}}),
+                store=self.store).run(walkers.copy())
+        self.assertTrue(all(pk % 2 for pk in res['nodes'].get_keys() if pk not in (0, 1)))
+
+    def test_restricted_cache(self):
+        """
+        A cache of some link types is not used for hops along other link types.
+        """
+        cache = LinkTypeAdjacencyCache(link_types=('createlink',), store=self.store)
+        cache.refresh()
+        walkers = get_basket(node_ids=(0, 1))
+        for edge_filters in (None, {'type':'inputlink'},
+                {'type':{'in':['createlink', 'inputlink']}}, {'type':'createlink'}):
+            queryhelp = get_queryhelp('output_of', edge_filters=edge_filters)
+            rule = UpdateRule(queryhelp, max_iterations=float('inf'), adjacency_cache=cache,
+                    store=self.store)
+            self.assertEqual(rule._local_hop is not None, edge_filters == {'type':'createlink'})
+            self.assertEqual(rule.run(walkers.copy()), UpdateRule(queryhelp,
+                    max_iterations=float('inf'), store=self.store).run(walkers.copy()))
+
+    def test_max_results(self):
+        """
+        Limited hops in the store keep the same entities and edges as hops
+        that are not limited, the smallest keys.
+        """
+        cache = LinkTypeAdjacencyCache(store=self.store)
+        cache.refresh()
+        for track_edges in (False, True):
+            for nr_of_results in (3, 10, 50):
+                results = [UpdateRule(get_queryhelp('output_of'), max_iterations=float('inf'),
+                        track_edges=track_edges, **kwargs).run(get_basket(node_ids=(0, 1)),
+                        max_results=nr_of_results)
+                        for kwargs in (dict(store=self.store), dict(adjacency_cache=cache))]
+                self.assertEqual(len(results[0]['nodes']), nr_of_results)
+                self.assertEqual(results[0], results[1])
+
+    def test_groups(self):
+        queryhelp = {'path':[{'type':'group', 'tag':'g'}, {'type':'node.Node.', 'tag':'n',
+                'joining_keyword':'member_of', 'joining_value':'g', 'edge_tag':'g--n'}],
+                'filters':{}, 'project':{}}
+        res = UpdateRule(queryhelp, track_edges=True, store=self.store).run(
+                get_basket(group_ids=(1,)))
+        self.assertEqual(res['nodes'].get_keys(), set(range(0, self.NR_OF_NODES, 7)))
+        self.assertEqual(len(res['nodes_groups']), len(res['nodes']))
+
+    def test_chains(self):
+        """
+        Hops that jump over the chains of the cached links reach the same nodes,
+        with fewer iterations, also after the chains are extended.
+        """
+        store = SQLiteStore()
+        store.add_links([(None, pk, pk+1, 'call', 'calllink') for pk in range(100)])
+        store.add_links([(None, 50, 200, 'call', 'calllink'), (None, 201, 50, 'call', 'calllink')])
+        cache = LinkTypeAdjacencyCache(store=store)
+        cache.refresh()
+        chain_index = ChainIndex(cache)
+        self.assertEqual(chain_index.get_chain(10), (0, tuple(range(1, 50)), 50))
+        for pk in range(100, 150):
+            cache.add_link(pk, pk+1, 'call', 'calllink')
+        self.assertEqual(chain_index.get_chain(120), (50, tuple(range(51, 150)), 150))
+        for joining_keyword, node_ids in (('output_of', (0, 201)), ('input_of', (120, 150))):
+            rule = UpdateRule(get_queryhelp(joining_keyword), max_iterations=float('inf'),
+                    adjacency_cache=cache, chain_index=chain_index)
+            res = rule.run(get_basket(node_ids=node_ids))
+            self.assertEqual(res, UpdateRule(get_queryhelp(joining_keyword),
+                    max_iterations=float('inf'), adjacency_cache=cache).run(
+                    get_basket(node_ids=node_ids)))
+            self.assertTrue(rule.get_iterations_done() <= 4)
+
+    def test_partitioned_traversal(self):
+        """
+        Workers traverse a SQLite file without loading AiiDA, with their own
+        connection, whether they are spawned or forked.
+        """
+        from age.parallel import PartitionedTraversal
+        folder = tempfile.mkdtemp()
+        try:
+            store = SQLiteStore(os.path.join(folder, 'graph.sqlite'))
+            store.add_links([(None, pk, (pk*7) % self.NR_OF_NODES, 'link', 'createlink')
+                    for pk in range(self.NR_OF_NODES)])
+            walkers = get_basket(node_ids=(1,))
+            rule = UpdateRule(get_queryhelp('output_of'), max_iterations=float('inf'),
+                    track_edges=True, store=store)
+            for start_method in ('spawn', 'fork'):
+                with PartitionedTraversal(rule, nr_of_workers=2, rule_kwargs=dict(store=store),
+                        start_method=start_method) as traversal:
+                    self.assertEqual(traversal.run(walkers.copy()), rule.run(walkers.copy()))
+            # Keys are exchanged between three workers, in both modes:
+            for mode, max_iterations in ((MODES.APPEND, 5), (MODES.REPLACE, 3)):
+                rule = UpdateRule(get_queryhelp('output_of'), mode=mode,
+                        max_iterations=max_iterations, store=store)
+                with PartitionedTraversal(rule, nr_of_workers=3, rule_kwargs=dict(store=store),
+                        start_method='fork') as traversal:
+                    for node_ids in ((1,), (2, 3, 4)):
+                        self.assertEqual(traversal.run(get_basket(node_ids=node_ids)),
+                                rule.run(get_basket(node_ids=node_ids)))
+                        self.assertEqual(traversal.get_iterations_done(),
+                                rule.get_iterations_done())
+            store.close()
+        finally:
+            shutil.rmtree(folder)
+
+    def test_estimate_closure(self):
+        """
+        A child shared by the walkers is counted once in the exact estimate.
+        """
+        from age.estimate import estimate_closure
+        store = SQLiteStore()
+        store.add_links([(None, 1, 3, 'link', 'createlink'), (None, 2, 3, 'link', 'createlink'),
+                (None, 3, 4, 'link', 'createlink')])
+        rule = UpdateRule(get_queryhelp('output_of'), max_iterations=float('inf'), store=store)
+        estimates = estimate_closure(rule, get_basket(node_ids=(1, 2)), nr_of_batches=2,
+                store=store)
+        self.assertTrue(estimates[-1]['exact'])
+        self.assertEqual(estimates[1]['new']['nodes'], 1)
+        self.assertEqual(estimates[-1]['total']['nodes'],
+                len(rule.run(get_basket(node_ids=(1, 2)))['nodes']))
+
+    def test_failed_run(self):
+        """
+        A run that fails is ended in the profiler, later runs are not inside it.
+        """
+        from age.profiling import HopProfiler
+        profiler = HopProfiler()
+        rule = UpdateRule(get_queryhelp('output_of'), max_iterations=float('inf'),
+                store=self.store)
+        rule.set_profiler(profiler)
+
+        def fail(basket):
+            raise KeyError('stop')
+
+        self.assertRaises(KeyError, rule.run, get_basket(node_ids=(0,)), stop=fail)
+        rule.run(get_basket(node_ids=(0,)))
+        runs = profiler.get_report()['runs']
+        self.assertEqual(len(runs), 2)
+        self.assertEqual(runs[0]['iterations'], 1)
+        self.assertTrue(all(run['seconds'] is not None for run in runs))
+
+    def test_result_cache(self):
+        """
+        Cached results are kept per store, keep labels that are None, and are
+        stale after links were added to the store.
+        """
+        from age.caches import ResultCache
+        folder = tempfile.mkdtemp()
+        try:
+            cache = ResultCache(folder)
+            store = SQLiteStore()
+            store.add_links([(None, 1, 2, None, 'createlink'), (None, 2, 3, 'link', None)])
+            rule = UpdateRule(get_queryhelp('output_of'), max_iterations=float('inf'),
+                    track_edges=True, store=store)
+            walkers = get_basket(node_ids=(1,))
+            self.assertNotEqual(cache.get_path(rule, walkers), cache.get_path(UpdateRule(
+                    get_queryhelp('output_of'), max_iterations=float('inf'),
+                    track_edges=True, store=self.store), walkers))
+            expected = rule.run(walkers.copy())
+            self.assertEqual(cache.run(rule, walkers.copy()), expected)
+            # A hit restores the iterations and visits of the stored run:
+            other_rule = UpdateRule(get_queryhelp('output_of'), max_iterations=float('inf'),
+                    track_edges=True, track_visits=True, store=store)
+            other_rule.run(get_basket(node_ids=(3,)))
+            self.assertEqual(cache.run(other_rule, walkers.copy()), expected)
+            self.assertEqual((cache.misses, cache.hits), (1, 1))
+            self.assertEqual(other_rule.get_iterations_done(), rule.get_iterations_done())
+            self.assertEqual(other_rule.get_visits(), expected)
+            store.add_links([(None, 3, 4, 'link', 'createlink')])
+            self.assertEqual(cache.run(rule, walkers.copy()), rule.run(walkers.copy()))
+            self.assertEqual(cache.stale, 1)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_node_cache(self):
+        """
+        The node cache is loaded from the store, and a refresh reloads a node
+        modified at the same time as the last refresh.
+        """
+        from age.caches import NodeAttributeCache
+        node_cache = NodeAttributeCache(store=self.store)
+        self.assertEqual(node_cache.refresh(), self.NR_OF_NODES)
+        self.assertEqual(node_cache.refresh(), 0)
+        last_mtime = float(self.NR_OF_NODES-1)
+        self.store.add_nodes([(0, 'uuid-0', 'data.', 'label-0', 0., last_mtime)])
+        self.assertEqual(node_cache.refresh(), 1)
+        self.assertEqual(node_cache.filter_keys((0, 1, 2), {'type':'data.'}), set([0, 1]))
+        walkers = get_basket(node_ids=(0, 1))
+        queryhelp = get_queryhelp('output_of', target_filters={'type':{'like':'data.%'}})
+        cache = LinkTypeAdjacencyCache(store=self.store)
+        cache.refresh()
+        rule = UpdateRule(queryhelp, max_iterations=float('inf'), adjacency_cache=cache,
+                node_cache=node_cache)
+        self.assertTrue(rule._local_hop is not None)
+        self.assertEqual(rule.run(walkers.copy()), UpdateRule(queryhelp,
+                max_iterations=float('inf'), store=self.store).run(walkers.copy()))
+
+    def test_pages_of_edges(self):
+        """
+        Edges that tie on their first fields are sorted also if their labels
+        or types are None.
+        """
+        store = SQLiteStore()
+        store.add_links([(None, 1, 2, None, 'createlink'), (None, 1, 2, 'link', 'createlink'),
+                (None, 1, 2, None, None), (None, 1, 3, 'link', None)])
+        edges = UpdateRule(get_queryhelp('output_of'), track_edges=True, store=store).run(
+                get_basket(node_ids=(1,)))['nodes_nodes']
+        self.assertEqual(edges.get_sorted_keys(), [(1, 2, None, None),
+                (1, 2, None, 'createlink'), (1, 2, 'link', 'createlink'), (1, 3, 'link', None)])
+        self.assertEqual([key for page in edges.iter_pages(1) for key in page],
+                edges.get_sorted_keys())
+
+    def test_versioned_stash(self):
+        """
+        A branch and a small save share the saved keys, and do not copy them.
+        """
+        from age.entities import VersionedStash
+        stash = VersionedStash()
+        stash.save(get_basket(node_ids=range(100000)))
+        stash.save(get_basket(node_ids=range(50000, 100001)))
+        base = stash._segments['nodes'][0]
+        self.assertEqual([len(segment) for segment in stash._segments['nodes']], [100000, 1])
+        branch = stash.branch(version=0)
+        walkers = get_basket()
+        branch.restore(walkers)
+        self.assertIs(walkers['nodes'].get_keys(), base)
+        walkers['nodes'].add_entities((200000,))
+        branch.save(walkers)
+        self.assertIs(branch._segments['nodes'][0], base)
+        self.assertEqual(branch._segments['nodes'][1], frozenset([200000]))
+        self.assertEqual(len(branch), 100001)
+        restored = get_basket()
+        stash.restore(restored, version=0)
+        self.assertIs(restored['nodes'].get_keys(), base)
+        stash.restore(restored)
+        self.assertEqual(restored['nodes'].get_keys(), set(range(100001)))
+        branch.restore(restored)
+        self.assertEqual(restored['nodes'].get_keys(), set(range(100000)).union([200000]))
+        # Restored walkers that were not changed add nothing:
+        branch.save(restored)
+        self.assertEqual(len(branch._segments['nodes']), 2)
+        self.assertEqual(branch.version, 2)
+
+    def test_dense_visits(self):
+        """
+        Keys keep their dense index while new keys are merged into the index,
+        and dense visits give the same results as sets.
+        """
+        import numpy as np
+        from age.indexing import DenseIndex
+        rng = random.Random(0)
+        index = DenseIndex()
+        expected = {}
+        for _ in range(50):
+            keys = [rng.randrange(10**6) for _ in range(rng.randrange(1, 300))]
+            indices = index.encode(keys)
+            for key, dense_index in zip(keys, indices.tolist()):
+                self.assertEqual(expected.setdefault(key, len(expected)), dense_index)
+            self.assertTrue(np.array_equal(index.decode(indices), keys))
+        self.assertEqual(len(index), len(expected))
+        for queryhelp in (get_queryhelp('output_of'), get_queryhelp('input_of')):
+            for track_edges in (False, True):
+                results = [UpdateRule(queryhelp, max_iterations=float('inf'),
+                        track_edges=track_edges, dense_visits=dense_visits,
+                        store=self.store).run(get_basket(node_ids=(0, 1)))
+                        for dense_visits in (False, True)]
+                self.assertEqual(results[0], results[1])
+
+    def test_numpy_keys(self):
+        import numpy as np
+        self.assertEqual(get_basket(node_ids=np.int64(3))['nodes'].get_keys(), set([3]))
+        self.assertEqual(get_basket(node_ids=np.arange(3))['nodes'].get_keys(), set([0, 1, 2]))
+        self.assertRaises(TypeError, get_basket, node_ids=np.array([0.5]))
+
+    def test_entities(self):
+        nodes = get_basket(node_ids=(5, 3, 4))['nodes']
+        self.assertEqual([node['uuid'] for node in nodes.get_entities(page_size=2,
+                store=self.store)], ['uuid-3', 'uuid-4', 'uuid-5'])
+
+
+if __name__ == '__main__':
+    unittest.main()